@@ -7,13 +7,22 @@ We there recommend to use a reiz-marker-Server as an independent process. You ca
 
 Alternatively, :meth:`~.reiz._marker.safeguard.start` starts such a process from within Python, and you can kill it later with :meth:`~.reiz._marker.safeguard.stop`.
 
+While idle, the MarkerServer sleeps and uses no CPU. Stopping it with Ctrl+C, SIGTERM or `reiz-marker --kill` pushes all markers still queued before it quits.
+
 This MarkerServer opens an Outlet that can be detected independently from the experiments you are running. When you then run an experiment, it receives messages from this experiment, and redistributes them in LSL-format.
 
 run from terminal with
 
 .. code-block:: bash
 
-    usage: reiz-marker [-h] [--port PORT] [--host HOST] [--name NAME] [--ping] [--kill]
+    usage: reiz-marker [-h] [--port PORT] [--host HOST] [--name NAME]
+                       [--transport {tcp,unix,udp,shm} [{tcp,unix,udp,shm} ...]]
+                       [--format {binary,json}] [--journal JOURNAL]
+                       [--queue-size QUEUE_SIZE]
+                       [--policy {block,drop-oldest,drop-newest,coalesce}]
+                       [--codes [CODES]] [--code-format {int32,double}]
+                       [--replay REPLAY] [--rate RATE] [--notify-fd NOTIFY_FD]
+                       [--ping] [--stats] [--kill]
 
     Reiz Marker Server
 
@@ -22,18 +31,59 @@ run from terminal with
     --port PORT  Marker Server port.
     --host HOST  Marker Server host ip.
     --name NAME  Marker Server name.
+    --transport {tcp,unix,udp,shm} [{tcp,unix,udp,shm} ...]
+                 transports to listen on, or to ping and kill with
+    --format {binary,json}
+                 offer the binary format to clients, or make them use json
+    --journal JOURNAL
+                 record markers in a write-ahead journal, and push
+                 markers left unacknowledged by a crash again
+    --queue-size QUEUE_SIZE
+                 queue at most this many markers per priority lane of
+                 each outlet, 0 for no bound
+    --policy {block,drop-oldest,drop-newest,coalesce}
+                 what to do with markers once the queue is full
+    --codes [CODES]
+                 open an outlet of numeric event codes next to each
+                 marker outlet, optionally loading markers and their
+                 codes from a json file
+    --code-format {int32,double}
+                 the channel format of the code outlets
+    --replay REPLAY
+                 replay a journal, csv or json file through an outlet
+                 called NAME, and report the timing error
+    --rate RATE  how much faster than recorded to replay
+    --notify-fd NOTIFY_FD
+                 write 'ready' to this inherited file descriptor as soon
+                 as the outlet and listeners are up
     --ping       test connection to Markerserver
+    --stats      print statistics of a running Markerserver
     --kill       send a poison pill to the Markerserver
 
 """
 
+import os
 import sys
-import time
+import json
+import signal
 from reiz._marker.mitm import Server
-from reiz._marker.client import available, kill
+from reiz._marker.client import available, kill, stats
+from reiz._marker.protocol import TRANSPORTS, FORMATS
+from reiz._marker.bounded import POLICIES
+from reiz._marker.codes import Codes, CODE_FORMATS
+from reiz._marker import replay
 import argparse
 
 
+def notify(fd: int):
+    "tell the process waiting on fd that the MarkerServer is ready"
+    try:
+        os.write(fd, b"ready\n")
+        os.close(fd)
+    except OSError as e:
+        print(f"Could not notify readiness: {e}")
+
+
 def main():
 
     parser = argparse.ArgumentParser(description="Reiz Marker Server")
@@ -43,43 +93,99 @@ def main():
                         help="Marker Server host ip.", default="127.0.0.1")
     parser.add_argument("--name", dest="name",
                         help="Marker Server name.", default='reiz-marker')
+    parser.add_argument("--transport", dest="transport", nargs="+",
+                        choices=TRANSPORTS, default=["tcp"],
+                        help="transports to listen on, or to ping and kill with")
+    parser.add_argument("--format", dest="format", choices=FORMATS,
+                        default="binary", help="offer the binary format to "
+                        "clients, or make them use json")
+    parser.add_argument("--journal", dest="journal", default=None,
+                        help="record markers in a write-ahead journal, and "
+                        "push markers left unacknowledged by a crash again")
+    parser.add_argument("--queue-size", dest="queue_size", type=int,
+                        default=0, help="queue at most this many markers per "
+                        "priority lane of each outlet, 0 for no bound")
+    parser.add_argument("--policy", dest="policy", choices=POLICIES,
+                        default="block", help="what to do with markers once "
+                        "the queue is full")
+    parser.add_argument("--codes", dest="codes", nargs="?", const="",
+                        default=None, help="open an outlet of numeric event "
+                        "codes next to each marker outlet, optionally loading "
+                        "markers and their codes from a json file")
+    parser.add_argument("--code-format", dest="code_format",
+                        choices=CODE_FORMATS, default="int32",
+                        help="the channel format of the code outlets")
+    parser.add_argument("--replay", dest="replay", default=None,
+                        help="replay a journal, csv or json file through an "
+                        "outlet called NAME, and report the timing error")
+    parser.add_argument("--rate", dest="rate", type=float, default=1.0,
+                        help="how much faster than recorded to replay")
+    parser.add_argument("--notify-fd", dest="notify_fd", type=int,
+                        default=None, help="write 'ready' to this inherited "
+                        "file descriptor as soon as the outlet and listeners "
+                        "are up")
     parser.add_argument("--ping", action="store_true",
                         help="test connection to Markerserver")
+    parser.add_argument("--stats", action="store_true",
+                        help="print statistics of a running Markerserver")
     parser.add_argument("--kill", action="store_true",
                         help="send a poison pill to the Markerserver")
 
     args = parser.parse_args()
+    transport = args.transport[0]
+    if args.replay:
+        markers = replay.load(args.replay)
+        name = 'reiz-replay' if args.name == 'reiz-marker' else args.name
+        errors = replay.replay(markers, rate=args.rate, name=name)
+        print(json.dumps({"timing_error": replay.summarize(errors)},
+                         indent=2))
+        return
     if args.kill:
-        if available(host=args.host, port=args.port):
-            kill(host=args.host, port=args.port)
+        if available(host=args.host, port=args.port, transport=transport):
+            kill(host=args.host, port=args.port, transport=transport)
         return
     if args.ping:
-        response = available(host=args.host, port=args.port)
+        response = available(host=args.host, port=args.port,
+                             transport=transport)
         if response:
             print(f"Markerserver is available at {args.host}:{args.port}")
             sys.exit(0)
         else:
             sys.exit(1)
+    if args.stats:
+        if not available(host=args.host, port=args.port, transport=transport):
+            sys.exit(1)
+        print(json.dumps(stats(host=args.host, port=args.port,
+                               transport=transport), indent=2))
+        sys.exit(0)
 
-    server = Server(port=args.port, name=args.name)
+    codes = None
+    if args.codes is not None:
+        codes = (Codes.load(args.codes, args.code_format) if args.codes
+                 else Codes(format=args.code_format))
+    server = Server(port=args.port, name=args.name, host=args.host,
+                    transports=args.transport, journal=args.journal,
+                    formats=FORMATS if args.format == "binary" else ["json"],
+                    maxsize=args.queue_size, policy=args.policy,
+                    codes=codes)
     try:
         server.start()
-        while not server.is_running.is_set():
-            pass
+        server.is_running.wait()
         if not server.singleton.is_set():
             raise ConnectionAbortedError()
-        time.sleep(1)
+        if args.notify_fd is not None:
+            notify(args.notify_fd)
         print("Server initialized")
-        while server.is_running.is_set():
-            try:
-                pass
-            except KeyboardInterrupt:
-                break
 
-        server.stop()
+        def shutdown(signum, frame):
+            "stop the server, which pushes all queued markers before it quits"
+            server.stop()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, shutdown)
+        while server.is_alive():  # sleeps, but wakes up for signals
+            server.join(timeout=1)
         print("\nStreaming stopped.\n")
-        server.join()
-        print("\nStreaming joined.\n")
         sys.exit(0)
 
     except ConnectionAbortedError as e:  # erver already connected
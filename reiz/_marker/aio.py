@@ -0,0 +1,237 @@
+"""Asyncio interface to the MarkerServer to send markers
+
+Kept apart from :mod:`~reiz._marker.client`, so that the MarkerServer does
+not pay for importing asyncio when it starts.
+"""
+import pylsl
+import socket
+import asyncio
+from sys import platform
+from reiz._marker.protocol import encode, decode, unix_path, FORMATS
+from reiz._marker.protocol import HEADER, MAX_FRAME, BINARY, ProtocolError
+from reiz._marker.client import sanitize_string
+
+
+async def push_async(
+    marker: str = "",
+    tstamp: float = None,
+    sanitize=True,
+    port: int = 7654,
+    transport: str = "tcp",
+    stream: str = None,
+    host: str = "127.0.0.1",
+):
+    """push a marker from within a coroutine without blocking the event loop
+
+    The timestamp is taken when the coroutine is called, not when the marker
+    was sent. Many coroutines can push concurrently over the same persistent
+    connection.
+
+    args
+    ----
+
+    marker: str
+        an ascii-encodable string describing an event, see :func:`~.push`
+    tstamp: float
+        the timestamp of the event. We recommend to use timestamps received
+        from pylsl.local_clock
+    sanitize: bool
+        whether the string is to be sanitized, see :func:`~.sanitize_string`
+    port: int
+        the port of the MarkerServer
+    transport: str
+        how to reach the MarkerServer, either "tcp" or "unix"
+    stream: str
+        the name of the outlet to push to, see :func:`~.push`
+    host: str
+        the ip of the MarkerServer
+    """
+    if tstamp is None:
+        tstamp = pylsl.local_clock()
+    if sanitize:
+        marker = sanitize_string(marker)
+    c = _AsyncClient.get(host=host, port=port, transport=transport)
+    await c.push(marker, tstamp, stream)
+
+
+async def available_async(
+    port: int = 7654, host: str = "127.0.0.1", verbose=True, transport: str = "tcp"
+) -> bool:
+    """test from within a coroutine whether a markerserver is available
+
+    see :func:`~.available` for the arguments
+    """
+    c = _AsyncClient.get(host=host, port=port, transport=transport)
+    try:
+        await asyncio.wait_for(c.request({"cmd": "health"}), timeout=1)
+        return True
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+        if verbose:
+            print(e)
+            print(f"Markerserver at {host}:{port} is not available")
+        await c.close()
+        return False
+
+
+class _AsyncClient:
+    """Persistent asyncio client communicating with the MarkerServer
+
+    Keeps one stream per event loop and server open, and reconnects on its
+    own if the connection was lost. Use :meth:`~.get` to receive the pooled
+    client for the running event loop. Clients of loops which were closed
+    meanwhile, e.g. by :func:`asyncio.run`, are dropped from the pool.
+    """
+
+    instance = dict()
+
+    @classmethod
+    def get(cls, host="127.0.0.1", port: int = 7654, transport: str = "tcp"):
+        "get the pooled client of the running loop, creating it if necessary"
+        loop = asyncio.get_running_loop()
+        key = (loop, host, port, transport)
+        if cls.instance.get(key, None) is None:
+            for stale in [k for k in cls.instance if k[0].is_closed()]:
+                del cls.instance[stale]
+            cls.instance[key] = cls(host=host, port=port, transport=transport)
+        return cls.instance[key]
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port: int = 7654,
+        verbose=True,
+        transport="tcp",
+        format="binary",
+    ):
+        if transport not in ("tcp", "unix"):
+            raise ValueError(f"Unknown transport {transport}, use tcp or unix")
+        if format not in FORMATS:
+            raise ValueError(f"Unknown format {format}, use {FORMATS}")
+        self.host = host
+        self.port = port
+        self.verbose = verbose
+        self.transport = transport
+        self.format = format
+        self.binary = False
+        self.reader = None
+        self.writer = None
+        self.lock = None  # created within the loop, guards connect and drain
+        self.replies = None  # guards a request and its reply
+        self.backpressure = None  #: the latest notice of backpressure
+
+    @property
+    def connected(self) -> bool:
+        "whether the stream is open and was not closed by the server"
+        return not (
+            self.writer is None
+            or self.writer.is_closing()
+            or self.reader.at_eof()
+        )
+
+    async def connect(self):
+        "connect wth the remote server, unless another coroutine already did"
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+            self.replies = asyncio.Lock()
+        async with self.lock:
+            if self.connected:
+                return
+            if self.transport == "unix":
+                connection = asyncio.open_unix_connection(unix_path(self.port))
+            else:
+                connection = asyncio.open_connection(self.host, self.port)
+            self.reader, self.writer = await connection
+            sock = self.writer.get_extra_info("socket")
+            if self.transport == "tcp" and sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.binary = False
+            if self.format == "binary":
+                await self.negotiate()
+
+    async def negotiate(self):
+        "agree with the MarkerServer whether to use the binary format"
+        self.writer.write(encode({"cmd": "hello", "formats": list(FORMATS)}))
+        try:
+            reply = await asyncio.wait_for(self.receive(), timeout=1)
+        except asyncio.TimeoutError:  # the MarkerServer only supports json
+            return
+        self.binary = reply.get("format", "json") == "binary"
+
+    async def send(self, msg: dict):
+        "send a message, reconnecting once if the connection was lost"
+        for attempt in (0, 1):
+            if not self.connected:
+                await self.connect()
+            try:
+                self.writer.write(encode(msg, self.binary))
+                if self.writer.transport.get_write_buffer_size():
+                    async with self.lock:
+                        await self.writer.drain()
+                return
+            except OSError:
+                await self.close()
+                if attempt:
+                    raise
+
+    async def push(self, marker: str = "", tstamp: float = None,
+                   stream: str = None):
+        "send a marker over the persistent stream"
+        if self.verbose:
+            print(f"Sending {marker} at {tstamp}")
+        msg = {"cmd": "push", "marker": marker, "tstamp": tstamp}
+        if stream is not None:
+            msg["stream"] = stream
+        await self.send(msg)
+
+    async def request(self, msg: dict) -> dict:
+        "send a message and wait for the reply of the MarkerServer"
+        if not self.connected:
+            await self.connect()
+        async with self.replies:
+            await self.send(msg)
+            return await self.receive()
+
+    async def receive(self) -> dict:
+        "return the next reply of the MarkerServer, keeping notices aside"
+        while True:
+            header = await self.reader.readexactly(HEADER.size)
+            (length,) = HEADER.unpack(header)
+            binary = length & BINARY
+            length &= ~BINARY
+            if length > MAX_FRAME:
+                raise ProtocolError(
+                    f"Frame of {length} bytes exceeds {MAX_FRAME}")
+            msg = decode(await self.reader.readexactly(length), binary)
+            if msg.get("cmd", None) != "backpressure":
+                return msg
+            self.backpressure = msg
+
+    async def close(self):
+        "closes the stream"
+        if self.writer is None:
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (OSError, AttributeError):  # wait_closed requires Python 3.7
+            pass
+        self.reader = self.writer = None
+
+
+if "darwin" in platform:  # pragma no cover
+    from reiz._marker.client import push as fake_push
+
+    async def fake_push_async(
+        marker: str = "",
+        tstamp: float = None,
+        sanitize=True,
+        port: int = 7654,
+        transport: str = "tcp",
+        stream: str = None,
+        host: str = "127.0.0.1",
+    ):
+        fake_push(marker, tstamp, sanitize=sanitize, stream=stream)
+
+    fake_push_async.__doc__ = push_async.__doc__
+    push_async = fake_push_async
+
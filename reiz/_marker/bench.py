@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the MarkerServer
+-------------------------------
+
+Run from terminal with
+
+.. code-block:: bash
+
+    python -m reiz._marker.bench --clients 1 2 4 8 --count 2000
+
+Each client runs in its own process, connects to a local
+:class:`~reiz._marker.mitm.Server`, pushes `count` markers as fast as possible
+and finally waits for the reply to a ping. Because the server handles the
+messages of a connection in order, the reply confirms that all markers of
+this client were received. The aggregate throughput is the total number of
+markers divided by the time until the last client got its reply.
+
+Afterwards, a single client pushes markers at a slow pace, so that the
+MarkerStreamer is idle whenever a marker arrives. This reports the
+distribution of delays between receiving a marker and pushing it to the
+outlet.
+
+Finally, a load test runs every combination of clients, marker sizes and
+rates. Each client pushes markers of the given size at the given rate per
+client, and a :class:`pylsl.StreamInlet` subscribes to the outlet on
+loopback. Each marker carries the number of its client and its sequence
+number, so the inlet measures the latency from pushing the marker until
+it was received, and counts samples that were dropped or arrived out of
+order.
+
+Before all that, the benchmark measures how long it takes until a
+throw-away MarkerServer started with :func:`~reiz._marker.safeguard.start`
+signals that it is ready. While this MarkerServer idles, a loop waking up
+every millisecond, like the loop presenting stimuli, measures how late it
+wakes up, and the CPU time used by the idle MarkerServer is reported. As a
+baseline, the same loop runs once more next to a process spinning like the
+main loop of `reiz-marker` did before it slept while idle.
+
+Store the results as json for tracking regressions between releases with
+
+.. code-block:: bash
+
+    python -m reiz._marker.bench --sizes 16 256 --rates 0 1000 --json bench.json
+
+Functions
+.........
+"""
+import argparse
+import json
+import multiprocessing
+import threading
+import time
+from typing import List
+
+
+def _client(port: int, count: int, start, done):
+    "push count markers as fast as possible, then confirm with a ping"
+    from pylsl import local_clock
+    from reiz._marker.client import _Client
+
+    c = _Client(port=port, verbose=False)
+    c.connect()
+    start.wait()
+    for i in range(count):
+        c.push("bench", local_clock())
+    c.request({"cmd": "ping"})
+    done.put(time.perf_counter())
+    c.close()
+
+
+def throughput(clients: int = 1, count: int = 1000, port: int = 7654) -> float:
+    """measure the aggregate throughput of a running MarkerServer
+
+    args
+    ----
+    clients: int
+        the number of concurrent clients, each running in its own process
+    count: int
+        the number of markers each client pushes
+    port: int
+        the port of the MarkerServer
+
+    returns
+    -------
+    rate: float
+        the aggregate number of markers per second received by the server
+    """
+    ctx = multiprocessing.get_context("spawn")
+    start = ctx.Event()
+    done = ctx.Queue()
+    procs = [
+        ctx.Process(target=_client, args=(port, count, start, done))
+        for i in range(clients)
+    ]
+    for p in procs:
+        p.start()
+    time.sleep(0.5 + 0.1 * clients)  # let all clients connect
+    t0 = time.perf_counter()
+    start.set()
+    t1 = max(done.get() for p in procs)
+    for p in procs:
+        p.join()
+    return clients * count / (t1 - t0)
+
+
+def _load_client(port: int, client: int, count: int, size: int, rate: float,
+                 start, done):
+    "push count markers of size bytes at rate per second, 0 for unpaced"
+    from pylsl import local_clock
+    from reiz._marker.client import _Client
+    from reiz._marker.replay import wait_until
+
+    c = _Client(port=port, verbose=False)
+    c.connect()
+    start.wait()
+    t0 = local_clock()
+    for seq in range(count):
+        if rate > 0:
+            wait_until(t0 + seq / rate)
+        marker = f"{client}:{seq}:"
+        c.push(marker + "x" * (size - len(marker)), local_clock())
+    c.request({"cmd": "ping"})
+    done.put(time.perf_counter())
+    c.close()
+
+
+class _Subscriber(threading.Thread):
+    """pulls the markers of a load test from an inlet on loopback
+
+    Counts the samples per client, and records the latency from pushing a
+    marker until it was pulled.
+    """
+
+    def __init__(self, name: str, timeout: float = 5.0):
+        import pylsl
+
+        threading.Thread.__init__(self, daemon=True)
+        infos = pylsl.resolve_byprop("name", name, timeout=timeout)
+        if not infos:
+            raise ConnectionError(f"Could not resolve the outlet {name}")
+        self.inlet = pylsl.StreamInlet(infos[0])
+        self.inlet.open_stream(timeout=timeout)
+        self.last = dict()
+        self.seen = set()
+        self.is_done = threading.Event()
+        self.expect(0)
+
+    def expect(self, count: int):
+        "prepare for a test pushing count markers in total"
+        from reiz._marker.stats import Histogram
+
+        self.latency = Histogram()
+        self.expected = count
+        self.received = self.reordered = self.duplicates = 0
+        self.last.clear()
+        self.seen.clear()
+        self.is_done.clear()
+
+    def run(self):
+        from pylsl import local_clock
+
+        while True:
+            sample, tstamp = self.inlet.pull_sample(timeout=0.1)
+            if sample is None:
+                continue
+            now = local_clock()
+            try:
+                client, seq = (int(x) for x in sample[0].split(":")[:2])
+            except ValueError:  # not a marker of the load test
+                continue
+            if (client, seq) in self.seen:
+                self.duplicates += 1
+                continue
+            self.seen.add((client, seq))
+            if seq < self.last.get(client, -1):
+                self.reordered += 1
+            self.last[client] = max(seq, self.last.get(client, -1))
+            self.latency.add(now - tstamp)
+            self.received += 1
+            if self.received >= self.expected:
+                self.is_done.set()
+
+
+def load(subscriber: _Subscriber, clients: int = 1, count: int = 1000,
+         size: int = 16, rate: float = 0, port: int = 7654,
+         timeout: float = 10.0) -> dict:
+    """measure push-to-inlet latency and losses under load
+
+    args
+    ----
+    subscriber: _Subscriber
+        the running subscriber to the outlet of the MarkerServer
+    clients: int
+        the number of concurrent clients, each running in its own process
+    count: int
+        the number of markers each client pushes
+    size: int
+        the size of each marker in bytes
+    rate: float
+        markers per second pushed by each client, or 0 for as fast as
+        possible
+    port: int
+        the port of the MarkerServer
+    timeout: float
+        how many seconds to wait for the inlet after the last push
+
+    returns
+    -------
+    result: dict
+        the configuration, the throughput, the latency distribution in
+        seconds, and the number of dropped, reordered and duplicate samples
+    """
+    subscriber.expect(clients * count)
+    ctx = multiprocessing.get_context("spawn")
+    start = ctx.Event()
+    done = ctx.Queue()
+    procs = [
+        ctx.Process(target=_load_client,
+                    args=(port, i, count, size, rate, start, done))
+        for i in range(clients)
+    ]
+    for p in procs:
+        p.start()
+    time.sleep(0.5 + 0.1 * clients)  # let all clients connect
+    t0 = time.perf_counter()
+    start.set()
+    t1 = max(done.get() for p in procs)
+    for p in procs:
+        p.join()
+    subscriber.is_done.wait(timeout)
+    return {
+        "clients": clients,
+        "count": count,
+        "size": size,
+        "rate": rate,
+        "markers_per_second": clients * count / (t1 - t0),
+        "latency": subscriber.latency.as_dict(),
+        "received": subscriber.received,
+        "dropped": clients * count - subscriber.received,
+        "reordered": subscriber.reordered,
+        "duplicates": subscriber.duplicates,
+    }
+
+
+def startup(count: int = 5, port: int = 7698) -> dict:
+    """measure how long a throw-away MarkerServer takes to become ready
+
+    args
+    ----
+    count: int
+        how often to start and kill the MarkerServer
+    port: int
+        the port for the MarkerServer
+
+    returns
+    -------
+    durations: dict
+        the mean, minimum and maximum time in seconds from spawning the
+        process until it signalled readiness
+    """
+    from reiz._marker.client import kill
+    from reiz._marker.safeguard import _launch
+
+    durations = []
+    for i in range(count):
+        t0 = time.perf_counter()
+        process, ready = _launch(port=port, name="reiz-marker-startup")
+        durations.append(time.perf_counter() - t0)
+        if not ready:
+            process.kill()
+            raise RuntimeError("The MarkerServer did not signal readiness")
+        kill(port=port)
+        process.wait()
+    return {
+        "mean": sum(durations) / count,
+        "min": min(durations),
+        "max": max(durations),
+    }
+
+
+def _spin(stop):
+    "busy-wait like the main loop of reiz-marker did before it slept"
+    while not stop.is_set():
+        pass
+
+
+def jitter(duration: float = 5.0, period: float = 0.001,
+           port: int = 7698, spinning: bool = False) -> dict:
+    """measure the wake-up jitter of a periodic loop next to an idle server
+
+    args
+    ----
+    duration: float
+        how many seconds to run the periodic loop
+    period: float
+        the period of the loop in seconds
+    port: int
+        the port for the MarkerServer
+    spinning: bool
+        whether to additionally run a process busy-waiting like the old main
+        loop, as a baseline
+
+    returns
+    -------
+    jitter: dict
+        the distribution of how many seconds the loop woke up late, and the
+        share of one core used by the MarkerServer, including its startup,
+        and by the spinning process. The share is None where the CPU time of
+        child processes is not available, e.g. on Windows
+    """
+    import os
+    from pylsl import local_clock
+    from reiz._marker.client import kill
+    from reiz._marker.safeguard import _launch
+    from reiz._marker.stats import Histogram
+
+    process, ready = _launch(port=port, name="reiz-marker-jitter")
+    if spinning:
+        stop = multiprocessing.Event()
+        spinner = multiprocessing.Process(target=_spin, args=(stop,))
+        spinner.start()
+    before = os.times()
+    lateness = Histogram()
+    deadline = local_clock()
+    end = deadline + duration
+    while deadline < end:
+        deadline += period
+        time.sleep(max(0.0, deadline - local_clock()))
+        lateness.add(local_clock() - deadline)
+    if spinning:
+        stop.set()
+        spinner.join()
+    kill(port=port)
+    process.wait()
+    after = os.times()
+    cpu = (after.children_user + after.children_system
+           - before.children_user - before.children_system)
+    summary = lateness.as_dict()
+    result = {k: summary[k] for k in ("p50", "p90", "p99", "max")}
+    result["server_cpu"] = cpu / duration if os.name == "posix" else None
+    return result
+
+
+def latency(server, count: int = 1000, interval: float = 0.002) -> dict:
+    """measure the delay between receiving a marker and pushing it to LSL
+
+    args
+    ----
+    server: :class:`~reiz._marker.mitm.Server`
+        a running server started within this process
+    count: int
+        the number of markers to push
+    interval: float
+        the pause in seconds between two markers
+
+    returns
+    -------
+    percentiles: dict
+        the median, 90th and 99th percentile and maximum of the delay in
+        seconds
+    """
+    from reiz._marker.client import _Client
+
+    from pylsl import local_clock
+    from reiz._marker.stats import Histogram
+
+    c = _Client(port=server.port, verbose=False)
+    histogram = server.stats.latency["queue"] = Histogram()
+    for i in range(count):
+        c.push("bench", local_clock())
+        time.sleep(interval)
+    c.request({"cmd": "ping"})
+    c.close()
+    server.markerstreamer.queue.join()
+    summary = histogram.as_dict()
+    return {k: summary[k] for k in ("p50", "p90", "p99", "max")}
+
+
+def main(argv: List[str] = None):
+    from reiz._marker.mitm import Server
+
+    parser = argparse.ArgumentParser(description="Reiz Marker Benchmark")
+    parser.add_argument("--port", type=int, default=7699,
+                        help="port for the benchmarked Marker Server.")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8],
+                        help="numbers of concurrent clients to test.")
+    parser.add_argument("--count", type=int, default=2000,
+                        help="markers pushed by each client.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[16],
+                        help="marker sizes in bytes for the load test.")
+    parser.add_argument("--rates", type=float, nargs="+", default=[0],
+                        help="markers/s per client for the load test, "
+                        "0 for as fast as possible.")
+    parser.add_argument("--startup", type=int, default=5,
+                        help="how often to measure the startup time.")
+    parser.add_argument("--jitter", type=float, default=5.0,
+                        help="seconds to measure the jitter next to an idle "
+                        "server.")
+    parser.add_argument("--json", dest="json", default=None,
+                        help="write all results as json to this file.")
+    args = parser.parse_args(argv)
+
+    from reiz._marker.mitm import get_version
+
+    results = {"version": get_version(), "throughput": [], "load": []}
+    if args.startup > 0:
+        results["startup"] = startup(args.startup, port=args.port - 1)
+        print("startup until ready in ms: " + ", ".join(
+            f"{k}={v * 1e3:.0f}" for k, v in results["startup"].items()))
+    if args.jitter > 0:
+        results["jitter"] = jitter(args.jitter, port=args.port - 1)
+        results["jitter_spinning"] = jitter(args.jitter, port=args.port - 1,
+                                            spinning=True)
+        for key, label in (("jitter", "an idle server"),
+                           ("jitter_spinning", "a spinning server")):
+            print(f"loop lateness next to {label} in µs: " + ", ".join(
+                f"{k}={results[key][k] * 1e6:.0f}"
+                for k in ("p50", "p90", "p99", "max")))
+            if results[key]["server_cpu"] is not None:
+                print(f"{label[2:]} CPU usage: "
+                      f"{results[key]['server_cpu']:.1%}")
+    server = Server(port=args.port, name="reiz-marker-bench", verbose=False)
+    server.start()
+    server.is_running.wait()
+    print(f"{'clients':>8} {'markers/s':>12}")
+    for clients in args.clients:
+        rate = throughput(clients=clients, count=args.count, port=args.port)
+        results["throughput"].append({"clients": clients, "count": args.count,
+                                      "markers_per_second": rate})
+        print(f"{clients:>8} {rate:>12.0f}")
+    delays = latency(server, count=args.count)
+    results["latency"] = delays
+    print("receive-to-outlet latency in µs: " + ", ".join(
+        f"{k}={v * 1e6:.0f}" for k, v in delays.items()))
+
+    subscriber = _Subscriber(server.name)
+    subscriber.start()
+    print(f"{'clients':>8} {'size':>6} {'rate':>8} {'markers/s':>12} "
+          f"{'p50 µs':>8} {'p99 µs':>8} {'dropped':>8} {'reordered':>9}")
+    for clients in args.clients:
+        for size in args.sizes:
+            for rate in args.rates:
+                result = load(subscriber, clients=clients, count=args.count,
+                              size=size, rate=rate, port=args.port)
+                results["load"].append(result)
+                p50, p99 = (result["latency"][k] for k in ("p50", "p99"))
+                print(f"{clients:>8} {size:>6} {rate:>8.0f} "
+                      f"{result['markers_per_second']:>12.0f} "
+                      f"{(p50 or 0) * 1e6:>8.0f} {(p99 or 0) * 1e6:>8.0f} "
+                      f"{result['dropped']:>8} {result['reordered']:>9}")
+    server.stop()
+    server.join()
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
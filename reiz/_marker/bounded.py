@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded marker queue
+--------------------
+
+Every outlet of the MarkerServer queues markers until its MarkerStreamer
+pushed them. If the outlet stalls while a client keeps pushing, e.g. a
+marker for every frame, an unbounded queue grows without limit. Start the
+MarkerServer with `reiz-marker --queue-size N` to bound each queue to N
+markers, and select with `--policy` what happens once it is full:
+
+- `block`: the MarkerServer stops reading from the connection which pushed
+  the marker, until the queue is half empty again. The client blocks once
+  the buffers of its connection are full, and markers received as
+  datagrams are dropped.
+- `drop-oldest`: the oldest queued markers are dropped
+- `drop-newest`: the arriving markers are dropped
+- `coalesce`: an arriving marker replaces the latest queued marker with the
+  same key, i.e. the text before the first colon, e.g. `feedback:0.53`
+  replaces `feedback:0.51`. If no queued marker has the same key, the
+  arriving marker is dropped.
+
+Dropped and coalesced markers are counted, and reported with
+`reiz-marker --stats`. Clients are notified with
+
+.. code-block:: python
+
+    {"cmd": "backpressure", "policy": "block", "stream": "reiz-marker",
+     "blocked": True}
+    {"cmd": "backpressure", "policy": "drop-newest", "dropped": 12,
+     "coalesced": 0, "blocked": False}
+
+Messages carry one of the priority classes :data:`PRIORITIES`, e.g.
+`{"cmd": "push", "marker": "trial_onset", "priority": "critical"}`, and
+default to `normal`. Each class is queued in its own lane, bounded and
+counted separately, and the MarkerStreamer always pushes the markers of the
+most urgent lane first. A client flooding the outlet with `bulk` markers,
+e.g. feedback for every frame, therefore neither delays nor displaces the
+`critical` markers of the main script. Within a lane, markers keep their
+order. Each lane holds up to `--queue-size` markers, so that every class,
+including the default `normal`, keeps the full bound, see :class:`~.Lanes`.
+The latencies of each class are reported with `reiz-marker --stats`.
+
+Classes
+.......
+"""
+import threading
+from collections import deque
+from queue import Full
+from typing import Tuple
+
+POLICIES = ("block", "drop-oldest", "drop-newest", "coalesce")
+PRIORITIES = ("critical", "normal", "bulk")  #: most urgent first
+
+
+def key(marker: str) -> str:
+    "the key by which markers are coalesced"
+    return marker.partition(":")[0]
+
+
+class MarkerQueue:
+    """a queue of chunks of markers, bounded by the number of markers
+
+    Each item is a tuple of samples, tstamps, the time it was received and
+    the sequence numbers of their records in the journal. Markers which are
+    dropped or replaced are acknowledged in the journal, so that they are not
+    pushed again after a restart. Like :class:`queue.Queue`, it supports
+    :meth:`~.task_done` and :meth:`~.join`.
+
+    Items are numbered in the order they were enqueued, and :attr:`tickets`
+    is the number of the latest. Once :attr:`processed` reaches the number of
+    an item, all items up to it were processed or dropped. While it has not
+    yet reached :attr:`wanted`, every processed item calls :attr:`on_done`.
+
+    args
+    ----
+    maxsize: int
+        the maximal number of queued markers, or 0 for no bound
+    policy: str
+        what to do once the queue is full, one of :data:`POLICIES`
+    journal: :class:`~reiz._marker.journal.Journal`
+        the journal recording the queued markers, or None
+    mutex: threading.Lock
+        the lock guarding the queue, shared by the lanes of :class:`~.Lanes`
+    not_empty: threading.Condition
+        the condition on mutex notified for every enqueued item
+    """
+
+    def __init__(self, maxsize: int = 0, policy: str = "block", journal=None,
+                 mutex: threading.Lock = None,
+                 not_empty: threading.Condition = None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy}, use {POLICIES}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.journal = journal
+        self.items = deque()
+        self.depth = 0  #: the number of queued markers
+        self.unfinished = 0
+        self.blocked = False
+        self.dropped = 0
+        self.coalesced = 0
+        self.on_space = None  #: called once a blocked queue has room again
+        self.tickets = 0  #: the number of items enqueued so far
+        self.processed = 0  #: the number of items processed or dropped
+        self.wanted = 0
+        self.on_done = None
+        self.mutex = threading.Lock() if mutex is None else mutex
+        if not_empty is None:
+            not_empty = threading.Condition(self.mutex)
+        self.not_empty = not_empty
+        self.all_done = threading.Condition(self.mutex)
+
+    def qsize(self) -> int:
+        "the number of queued markers"
+        return self.depth
+
+    def check(self, count: int, name: str = None):
+        """make sure that count markers can be put without blocking
+
+        raises
+        ------
+        queue.Full
+            with the policy `block`, if the markers do not fit anymore.
+            A single chunk larger than the bound fits into an empty queue.
+            Its arguments are the name and the queue, which stays
+            :attr:`blocked` until it is half empty again
+        """
+        if self.policy != "block" or not self.maxsize:
+            return
+        with self.mutex:
+            if self.depth and self.depth + count > self.maxsize:
+                self.blocked = True
+                raise Full(name, self)
+
+    def put(self, item, force: bool = False) -> Tuple[int, int]:
+        """enqueue an item, applying the policy if the queue is full
+
+        args
+        ----
+        item:
+            the chunk of markers, or None to stop the MarkerStreamer
+        force: bool
+            enqueue all markers, even if that exceeds the bound
+
+        returns
+        -------
+        dropped: int
+            how many markers were dropped
+        coalesced: int
+            how many queued markers were replaced
+        """
+        discarded = []
+        dropped = coalesced = 0
+        with self.mutex:
+            if item is not None and self.maxsize and not force:
+                item, dropped, coalesced = self._apply(item, discarded)
+            if item is not None and not item[0]:
+                item = False  # nothing left to enqueue
+            if item is not False:
+                self.items.append(item)
+                self.depth += 0 if item is None else len(item[0])
+                self.unfinished += 1
+                self.tickets += 1
+                self.not_empty.notify()
+        if self.journal is not None:
+            for record in discarded:
+                self.journal.ack(record)
+        return dropped, coalesced
+
+    def _apply(self, item, discarded: list):
+        "apply the policy to an item, returning what is left to enqueue"
+        samples, tstamps, received, records = item
+        room = max(self.maxsize - self.depth, 0)
+        if len(samples) <= room or self.policy == "block":
+            return item, 0, 0
+        if self.policy == "drop-oldest":
+            dropped = 0
+            if len(samples) > self.maxsize:  # keep the newest of the chunk
+                excess = len(samples) - self.maxsize
+                dropped += excess
+                discarded.extend(records[:excess])
+                samples, tstamps = samples[excess:], tstamps[excess:]
+                records = records[excess:]
+            dropped += self._evict(len(samples) - room, discarded)
+            self.dropped += dropped
+            return (samples, tstamps, received, records), dropped, 0
+        fits = (samples[:room], tstamps[:room], received, records[:room])
+        dropped = coalesced = 0
+        for i in range(room, len(samples)):
+            record = records[i] if records else None
+            if self.policy == "coalesce" and \
+                    self._replace(samples[i], tstamps[i], record, discarded):
+                coalesced += 1
+            else:
+                dropped += 1
+                if record is not None:
+                    discarded.append(record)
+        self.dropped += dropped
+        self.coalesced += coalesced
+        return fits, dropped, coalesced
+
+    def _evict(self, count: int, discarded: list) -> int:
+        "drop count of the oldest queued markers"
+        evicted = 0
+        while evicted < count and self.items and self.items[0] is not None:
+            samples, tstamps, received, records = self.items[0]
+            n = min(count - evicted, len(samples))
+            discarded.extend(records[:n])
+            del samples[:n], tstamps[:n], records[:n]
+            evicted += n
+            if not samples:
+                self.items.popleft()
+                self.unfinished -= 1
+                self.processed += 1
+        self.depth -= evicted
+        return evicted
+
+    def _replace(self, sample: str, tstamp: float, record: int,
+                 discarded: list) -> bool:
+        "replace the latest queued marker with the same key"
+        wanted = key(sample)
+        for item in reversed(self.items):
+            if item is None:
+                continue
+            samples, tstamps, received, records = item
+            for i in range(len(samples) - 1, -1, -1):
+                if key(samples[i]) == wanted:
+                    samples[i], tstamps[i] = sample, tstamp
+                    if records:
+                        discarded.append(records[i])
+                        records[i] = record
+                    elif record is not None:
+                        discarded.append(record)
+                    return True
+        return False
+
+    def get(self):
+        "remove and return the next item, blocking until there is one"
+        with self.not_empty:
+            while not self.items:
+                self.not_empty.wait()
+            item, notify = self._take()
+        if notify and self.on_space is not None:
+            self.on_space()
+        return item
+
+    def _take(self):
+        "remove the next item, and whether the queue has room again"
+        item = self.items.popleft()
+        if item is not None:
+            self.depth -= len(item[0])
+        if self.blocked and self.depth <= self.maxsize // 2:
+            self.blocked = False
+            return item, True
+        return item, False
+
+    def task_done(self):
+        "indicate that an item returned by :meth:`~.get` was processed"
+        with self.all_done:
+            self.unfinished -= 1
+            self.processed += 1
+            if self.unfinished <= 0:
+                self.all_done.notify_all()
+            notify = self.processed <= self.wanted
+        if notify and self.on_done is not None:
+            self.on_done()
+
+    def join(self):
+        "block until all items were processed"
+        with self.all_done:
+            while self.unfinished:
+                self.all_done.wait()
+
+
+class Lanes:
+    """one :class:`~.MarkerQueue` per priority class, served most urgent first
+
+    All lanes share one lock, so that :meth:`~.get` blocks until any lane
+    has an item. Each lane keeps its own bound, counters and tickets, so
+    that a flooded lane can not hold back the others.
+
+    args
+    ----
+    maxsize: int
+        the maximal number of queued markers of each lane, or 0 for no bound.
+        All lanes together hold at most three times as many markers
+    policy: str
+        what to do once a lane is full, one of :data:`POLICIES`
+    journal: :class:`~reiz._marker.journal.Journal`
+        the journal recording the queued markers, or None
+    """
+
+    def __init__(self, maxsize: int = 0, policy: str = "block", journal=None):
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.lanes = {
+            priority: MarkerQueue(maxsize, policy, journal, self.mutex,
+                                  self.not_empty)
+            for priority in PRIORITIES
+        }
+
+    def lane(self, priority: str = "normal") -> MarkerQueue:
+        "the queue of a priority class"
+        return self.lanes[priority]
+
+    def qsize(self) -> int:
+        "the number of queued markers of all lanes"
+        return sum(lane.depth for lane in self.lanes.values())
+
+    @property
+    def dropped(self) -> int:
+        "the number of markers dropped by all lanes"
+        return sum(lane.dropped for lane in self.lanes.values())
+
+    @property
+    def coalesced(self) -> int:
+        "the number of markers replaced in all lanes"
+        return sum(lane.coalesced for lane in self.lanes.values())
+
+    def check(self, count: int, name: str = None, priority: str = "normal"):
+        "make sure that count markers fit into a lane, see MarkerQueue.check"
+        self.lanes[priority].check(count, name)
+
+    def put(self, item, force: bool = False,
+            priority: str = "normal") -> Tuple[int, int]:
+        "enqueue an item into a lane, see MarkerQueue.put"
+        return self.lanes[priority].put(item, force)
+
+    def get(self) -> Tuple[str, tuple]:
+        """remove the next item of the most urgent lane, blocking until there
+        is one
+
+        returns
+        -------
+        priority: str
+            the priority class of the item, to be passed to :meth:`~.task_done`
+        item:
+            the item
+        """
+        with self.not_empty:
+            while True:
+                for priority, lane in self.lanes.items():
+                    if lane.items:
+                        break
+                else:
+                    self.not_empty.wait()
+                    continue
+                item, notify = lane._take()
+                break
+        if notify and lane.on_space is not None:
+            lane.on_space()
+        return priority, item
+
+    def task_done(self, priority: str):
+        "indicate that an item returned by :meth:`~.get` was processed"
+        self.lanes[priority].task_done()
+
+    def join(self):
+        "block until the items of all lanes were processed"
+        for lane in self.lanes.values():
+            lane.join()
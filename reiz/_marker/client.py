@@ -1,12 +1,26 @@
 """Client interface to the MarkerServer to send markers"""
 import pylsl
 import socket
+import select
+import threading
+import time
+import uuid
 import json
 from logging import getLogger
 from sys import platform
+from reiz._marker.protocol import encode, Reader, TRANSPORTS, unix_path
+from reiz._marker.protocol import FORMATS
+from reiz._marker.ring import Ring
+from reiz._marker.clock import Estimator
+from reiz._marker.codes import INT32
+from collections import deque
+from typing import List, Tuple
 
 log = getLogger()
 
+#: replaces umlaute and spaces, built once instead of on every sanitization
+TRANSLATION = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", " ": "_"})
+
 
 def sanitize_string(marker: str) -> str:
     """sanitize a string
@@ -24,8 +38,7 @@ def sanitize_string(marker: str) -> str:
     sanitized:str
         the sanitized string
     """
-    translation = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue", " ": "_"})
-    marker = marker.lower().strip().translate(translation)
+    marker = marker.lower().strip().translate(TRANSLATION)
 
     if marker.lower() == "ping":
         marker = json.dumps({"msg": marker})
@@ -41,7 +54,17 @@ def sanitize_string(marker: str) -> str:
     return marker
 
 
-def push(marker: str = "", tstamp: float = None, sanitize=True, port: int = 7654):
+def push(
+    marker: str = "",
+    tstamp: float = None,
+    sanitize=True,
+    port: int = 7654,
+    transport: str = "tcp",
+    stream: str = None,
+    host: str = "127.0.0.1",
+    reliable: bool = False,
+    priority: str = None,
+):
     """push a marker to the MarkerServer for redistribution as LSL
 
     args
@@ -57,6 +80,27 @@ def push(marker: str = "", tstamp: float = None, sanitize=True, port: int = 7654
         whether the string is to be sanitized, see :func:`~.sanitize_string`
     port: int
         the port of the MarkerServer
+    transport: str
+        how to reach the MarkerServer, either "tcp", "unix" for a unix domain
+        socket, "udp" for fire-and-forget datagrams or "shm" for a
+        shared-memory ring
+    stream: str
+        the name of the outlet to push to. Defaults to None, i.e. the outlet
+        named when the MarkerServer was started. Other outlets are created
+        by the MarkerServer when the first marker arrives
+    host: str
+        the ip of the MarkerServer. If it runs on another machine, the
+        timestamp is mapped onto its clock, see :mod:`~reiz._marker.clock`
+    reliable: bool
+        whether to number the marker and keep it until the MarkerServer
+        acknowledged that it was pushed. It is retransmitted if the
+        connection was lost meanwhile. Wait for the acknowledgement with
+        :func:`~.confirm`. Not available with the transport "udp"
+    priority: str
+        the priority class of the marker, one of "critical", "normal" and
+        "bulk". Critical markers overtake the others queued in the
+        MarkerServer, see :mod:`~reiz._marker.bounded`. Defaults to None,
+        i.e. "normal"
 
     """
     if tstamp is None:
@@ -64,8 +108,158 @@ def push(marker: str = "", tstamp: float = None, sanitize=True, port: int = 7654
     if sanitize:
         marker = sanitize_string(marker)
 
-    c = _Client(port=port)
-    c.push(marker, tstamp)
+    c = _Client.get(host=host, port=port, transport=transport,
+                    reliable=reliable)
+    c.push(marker, tstamp, stream, priority)
+
+
+def push_many(
+    markers: List[Tuple[str, float]],
+    sanitize=True,
+    port: int = 7654,
+    transport: str = "tcp",
+    stream: str = None,
+    host: str = "127.0.0.1",
+    reliable: bool = False,
+    priority: str = None,
+):
+    """push a batch of markers to the MarkerServer in a single message
+
+    The MarkerServer forwards the whole batch as one chunk, with a timestamp
+    for each marker. Use it to publish related markers belonging to the same
+    event, e.g. the trial id, the condition and the stimulus parameters.
+
+    args
+    ----
+
+    markers: List[Tuple[str, float]]
+        a list of (marker, tstamp). A tstamp of None is replaced by the
+        timestamp of the call
+    sanitize: bool
+        whether the strings are to be sanitized, see :func:`~.sanitize_string`
+    port: int
+        the port of the MarkerServer
+    transport: str
+        how to reach the MarkerServer, see :func:`~.push`
+    stream: str
+        the name of the outlet to push to, see :func:`~.push`
+    host: str
+        the ip of the MarkerServer, see :func:`~.push`
+    reliable: bool
+        whether to deliver the batch reliably, see :func:`~.push`
+    priority: str
+        the priority class of the batch, see :func:`~.push`
+    """
+    now = pylsl.local_clock()
+    markers = [
+        (sanitize_string(m) if sanitize else m, now if t is None else t)
+        for m, t in markers
+    ]
+    c = _Client.get(host=host, port=port, transport=transport,
+                    reliable=reliable)
+    c.push_many(markers, stream, priority)
+
+
+def confirm(
+    timeout: float = 1.0,
+    port: int = 7654,
+    transport: str = "tcp",
+    host: str = "127.0.0.1",
+) -> bool:
+    """wait until all markers pushed with `reliable=True` were pushed
+
+    args
+    ----
+    timeout: float
+        how many seconds to wait for the acknowledgements of the MarkerServer
+    port: int
+        the port of the MarkerServer
+    transport: str
+        how to reach the MarkerServer, see :func:`~.push`
+    host: str
+        the ip of the MarkerServer, see :func:`~.push`
+
+    returns
+    -------
+    confirmed: bool
+        whether the MarkerServer acknowledged all markers in time
+    """
+    c = _Client.get(host=host, port=port, transport=transport, reliable=True)
+    return c.confirm(timeout)
+
+
+def push_code(
+    code: int,
+    tstamp: float = None,
+    port: int = 7654,
+    transport: str = "tcp",
+    stream: str = None,
+    host: str = "127.0.0.1",
+    reliable: bool = False,
+    priority: str = None,
+):
+    """push a numeric event code to the MarkerServer
+
+    Sends only the timestamp and the code, which is pushed to the code outlet
+    of the MarkerServer. The marker outlet receives the marker registered
+    for the code, or the code as text. See :mod:`~reiz._marker.codes`.
+
+    args
+    ----
+    code: int
+        the event code, an int32
+    tstamp: float
+        the timestamp of the event, see :func:`~.push`
+
+    All other arguments are the same as for :func:`~.push`.
+    """
+    if isinstance(code, bool) or not isinstance(code, int) or \
+            not INT32[0] <= code <= INT32[1]:
+        raise ValueError(f"Code {code!r} is not an int32")
+    if tstamp is None:
+        tstamp = pylsl.local_clock()
+    c = _Client.get(host=host, port=port, transport=transport,
+                    reliable=reliable)
+    c.push_code(code, tstamp, stream, priority)
+
+
+def register_code(
+    marker: str,
+    code: int,
+    sanitize=True,
+    port: int = 7654,
+    transport: str = "tcp",
+    host: str = "127.0.0.1",
+):
+    """register the numeric event code of a marker with the MarkerServer
+
+    Whenever the marker is pushed afterwards, its code is pushed to the code
+    outlet, too. See :mod:`~reiz._marker.codes`.
+
+    args
+    ----
+    marker: str
+        the marker
+    code: int
+        its event code, an int32
+    sanitize: bool
+        whether to sanitize the marker like :func:`~.push` does, so that it
+        matches the pushed markers
+
+    All other arguments are the same as for :func:`~.push`.
+
+    raises
+    ------
+    ValueError
+        if the MarkerServer has no code outlets, or if marker or code were
+        registered differently before
+    """
+    if sanitize:
+        marker = sanitize_string(marker)
+    c = _Client.get(host=host, port=port, transport=transport)
+    reply = c.request({"cmd": "register", "marker": marker, "code": code})
+    if reply.get("cmd", None) != "register":
+        raise ValueError(reply.get("error", reply))
 
 
 def push_json(marker: dict = {"key": "value"}, tstamp: float = None):
@@ -85,7 +279,13 @@ def push_json(marker: dict = {"key": "value"}, tstamp: float = None):
     push(json.dumps(marker), tstamp, sanitize=False)
 
 
-def available(port: int = 7654, host: str = "127.0.0.1", verbose=True) -> bool:
+def available(
+    port: int = 7654,
+    host: str = "127.0.0.1",
+    verbose=True,
+    transport: str = "tcp",
+    max_age: float = 0,
+) -> bool:
     """test whether a markerserver is already available at port
 
     args
@@ -97,65 +297,570 @@ def available(port: int = 7654, host: str = "127.0.0.1", verbose=True) -> bool:
     port: int
         the port number of the markerserver (defaults to 7654)
 
+    transport: str
+        the transport to test, either "tcp", "unix" or "udp". The health of
+        "shm" is checked over its tcp connection, without attaching a ring
+
+    max_age: float
+        reuse a positive result if it is at most max_age seconds old, instead
+        of asking the markerserver again. Defaults to 0, i.e. always ask
+
     returns
     -------
 
     status: bool
         True if available, False if not
     """
-    c = _Client(host=host, port=port)
+    c = _control(host, port, transport)
+    if max_age > 0 and pylsl.local_clock() - c.healthy <= max_age:
+        return True
     try:
-        c.push("ping", pylsl.local_clock())
+        health(host=host, port=port, transport=transport)
         return True
-    except ConnectionRefusedError as e:
+    except OSError as e:
         if verbose:
             print(e)
             print(f"Markerserver at {host}:{port} is not available")
         return False
 
 
-def kill(host: str = "127.0.0.1", port: int = 7654):
-    c = _Client(port=port, host=host)
-    c.push("poison-pill", pylsl.local_clock())
+def health(host: str = "127.0.0.1", port: int = 7654, transport: str = "tcp") -> dict:
+    """query the health of a running MarkerServer
+
+    The health check never reaches the outlet, and is answered right away
+    from the current state of the MarkerServer.
+
+    returns
+    -------
+
+    health: dict
+        the name of the outlet, the uptime in seconds, the number of markers
+        queued for all outlets, the number of connections and the version
+
+    raises
+    ------
+
+    OSError
+        if the MarkerServer is not available
+    """
+    c = _control(host, port, transport)
+    try:
+        reply = c.request({"cmd": "health"})
+    except OSError:
+        c.healthy = float("-inf")
+        raise
+    c.healthy = pylsl.local_clock()
+    return reply
+
+
+def kill(host: str = "127.0.0.1", port: int = 7654, transport: str = "tcp"):
+    "send a poison pill to the MarkerServer at host:port"
+    c = _control(host, port, transport)
+    c.send({"cmd": "kill"})
+    c.close()
+
+
+def stats(host: str = "127.0.0.1", port: int = 7654, transport: str = "tcp") -> dict:
+    """query counters and latency statistics from a running MarkerServer
+
+    See :mod:`~reiz._marker.stats` for a description of the statistics.
+
+    returns
+    -------
+
+    stats: dict
+        the statistics, with all latencies in seconds
+    """
+    c = _control(host, port, transport)
+    return c.request({"cmd": "stats"})["stats"]
+
+
+def _control(host: str, port: int, transport: str) -> "_Client":
+    "the pooled client for requests, which never need a shared-memory ring"
+    if transport == "shm":
+        transport = "tcp"
+    return _Client.get(host=host, port=port, transport=transport)
+
+
+def _is_local(host: str) -> bool:
+    "whether host is this machine, i.e. shares the clock with the client"
+    return host in ("localhost", "::1") or host.startswith("127.")
 
 
 class _Client:
-    "Basic Client communicating with the MarkerServer"
+    """Persistent client communicating with the MarkerServer
+
+    Keeps a long-lived connection open and reconnects on its own if the
+    connection was lost, e.g. because the MarkerServer was restarted. Use
+    :meth:`~.get` to receive the pooled client for a host, port and transport.
+
+    After connecting, the client offers the binary format to the
+    MarkerServer, and falls back to json if the server declines, see
+    :mod:`~reiz._marker.protocol`. Set `format` to "json" to always use json.
+
+    If the MarkerServer runs on another machine, the client estimates the
+    offset of its clock on every connect, and every ten seconds in a
+    background thread which never holds back a marker, so that the
+    MarkerServer can map timestamps onto its own clock, see
+    :mod:`~reiz._marker.clock`.
+
+    Notices of backpressure sent by the MarkerServer are logged, and the
+    latest one is kept as :attr:`backpressure`, see
+    :mod:`~reiz._marker.bounded`.
+
+    A reliable client numbers its messages, and keeps up to `window` of them
+    until the MarkerServer acknowledged them. After reconnecting, it resumes
+    its session and retransmits the messages which did not arrive, see
+    :mod:`~reiz._marker.protocol`. If the MarkerServer was restarted,
+    markers it recovered from its journal may be pushed twice.
+    """
 
-    def __init__(self, host="127.0.0.1", port: int = 7654, verbose=True):
+    instance = dict()
+    _lock = threading.Lock()
+    check_interval = 0.25  #: seconds between checks of the connection
+
+    @classmethod
+    def get(cls, host="127.0.0.1", port: int = 7654, transport: str = "tcp",
+            reliable: bool = False):
+        "get the pooled client for host:port, creating it if necessary"
+        key = (host, port, transport, reliable)
+        with cls._lock:
+            if cls.instance.get(key, None) is None:
+                cls.instance[key] = cls(host=host, port=port,
+                                        transport=transport, reliable=reliable)
+            return cls.instance[key]
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port: int = 7654,
+        verbose=True,
+        transport="tcp",
+        format="binary",
+        reliable: bool = False,
+        window: int = 1024,
+    ):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Unknown transport {transport}, use {TRANSPORTS}")
+        if format not in FORMATS:
+            raise ValueError(f"Unknown format {format}, use {FORMATS}")
+        if reliable and transport == "udp":
+            raise ValueError("Datagrams can not be delivered reliably")
         self.host = host
         self.port = port
         self.verbose = verbose
+        self.transport = transport
+        self.format = format
+        self.binary = False
+        self.interface = None
+        self.reader = Reader()
+        self.inbox = deque()
+        self.ring = None
+        self.doorbell = None
+        self.frames = 0  #: frames sent since attaching the ring
+        self.checked = float("-inf")  #: when the ring's connection was checked
+        self.healthy = float("-inf")  #: when the last health check succeeded
+        self.backpressure = None  #: the latest notice of backpressure
+        self.reliable = reliable
+        self.window = window
+        self.id = uuid.uuid4().hex  #: identifies the session of the client
+        self.seq = 0  #: the sequence number of the latest message
+        self.unacked = deque()  #: numbered messages not yet acknowledged
+        self.announced = dict()  #: the announcements of used templates
+        self.clock = None
+        if transport == "tcp" and not _is_local(host):
+            self.clock = Estimator()
+        self.resync = None  #: the thread updating the clock estimate
+        self.lock = threading.RLock()
+
+    def push(self, marker: str = "", tstamp: float = None, stream: str = None,
+             priority: str = None):
+        "send a marker over the persistent connection"
+        with self.lock:
+            self.write(marker, tstamp, stream, priority)
+
+    def push_many(self, markers: List[Tuple[str, float]], stream: str = None,
+                  priority: str = None):
+        "send a batch of (marker, tstamp) as a single message"
+        if self.verbose:
+            print(f"Sending batch of {len(markers)} markers")
+        msg = {"cmd": "batch", "markers": markers}
+        if stream is not None:
+            msg["stream"] = stream
+        if priority is not None:
+            msg["priority"] = priority
+        with self.lock:
+            if self.reliable:
+                self._number(msg)
+            self.send(msg)
+
+    def synchronize(self, count: int = 1):
+        """exchange timestamps with the MarkerServer to estimate the offset
+        of its clock, and send the updated estimate
+
+        args
+        ----
+        count: int
+            the number of exchanges
+        """
+        with self.lock:
+            for i in range(count):
+                t0 = pylsl.local_clock()
+                try:
+                    reply = self.request({"cmd": "time", "t0": t0})
+                except socket.timeout:  # the MarkerServer can not map clocks
+                    self.clock = None
+                    return  # and the connection is closed
+                self.clock.add(t0, reply["t1"], reply["t2"], pylsl.local_clock())
+            self.send(dict(cmd="clock", **self.clock.fit()))
+
+    def _resync(self):
+        """update the clock estimate every interval in the background
+
+        The exchanges run over a connection of their own, so that pushing
+        never waits for a round trip. Only the updated estimate is sent over
+        the connection of the markers.
+        """
+        probe = _Client(host=self.host, port=self.port, verbose=False,
+                        format=self.format)
+        probe.clock = None  # it only relays the exchanges
+        try:
+            while True:
+                clock = self.clock
+                if clock is None or self.interface is None:
+                    return  # closed, the next connect resumes the updates
+                time.sleep(clock.interval)
+                t0 = pylsl.local_clock()
+                try:
+                    reply = probe.request({"cmd": "time", "t0": t0})
+                except OSError:  # e.g. the MarkerServer restarted
+                    probe.close()
+                    continue
+                t3 = pylsl.local_clock()
+                with self.lock:
+                    if self.clock is None or self.interface is None:
+                        return
+                    self.clock.add(t0, reply["t1"], reply["t2"], t3)
+                    try:
+                        self.send(dict(cmd="clock", **self.clock.fit()))
+                    except OSError:  # connecting again synchronizes anyways
+                        pass
+        finally:
+            probe.close()
+
+    def write(self, marker, tstamp, stream: str = None, priority: str = None):
+        "frame the marker and send all bytes"
+        if self.verbose:
+            print(f"Sending {marker} at {tstamp}")
+        msg = {"cmd": "push", "marker": marker, "tstamp": tstamp}
+        if priority is not None:
+            msg["priority"] = priority
+        if stream is not None:  # the ring only carries the default outlet
+            msg["stream"] = stream
+        elif (  # nor does it carry sequence numbers or priorities
+            self.transport == "shm"
+            and not self.reliable
+            and priority is None
+            and self.write_ring(marker, tstamp)
+        ):
+            return
+        if self.reliable:
+            self._number(msg)
+        self.send(msg)
+
+    def push_code(self, code: int, tstamp: float, stream: str = None,
+                  priority: str = None):
+        "send a numeric event code"
+        if self.verbose:
+            print(f"Sending code {code} at {tstamp}")
+        msg = {"cmd": "code", "code": code, "tstamp": tstamp}
+        if stream is not None:
+            msg["stream"] = stream
+        if priority is not None:
+            msg["priority"] = priority
+        with self.lock:
+            if self.reliable:
+                self._number(msg)
+            self.send(msg)
+
+    def push_template(self, template, values: list, tstamp: float,
+                      stream: str = None, priority: str = None):
+        "send the id of a template and the values of its slots"
+        if self.transport == "udp":  # datagrams share no state
+            return self.write(template.expand(values), tstamp, stream,
+                              priority)
+        if self.verbose:
+            print(f"Sending template {template.id} with {values} at {tstamp}")
+        msg = {"cmd": "push", "template": template.id, "values": values,
+               "tstamp": tstamp}
+        if stream is not None:
+            msg["stream"] = stream
+        if priority is not None:
+            msg["priority"] = priority
+        with self.lock:
+            if template.id not in self.announced:
+                self.announced[template.id] = template.announcement
+                if self.connected:  # otherwise announced when connecting
+                    self.send(template.announcement)
+            if self.reliable:
+                self._number(msg)
+            self.send(msg)
+
+    def _number(self, msg: dict):
+        "number a message, and keep it until the MarkerServer acknowledged it"
+        if len(self.unacked) >= self.window and not self.confirm(
+            pending=self.window - 1
+        ):
+            log.warning(
+                f"MarkerServer acknowledged none of the last {self.window} messages"
+            )
+        self.seq += 1
+        msg["seq"] = self.seq
+        self.unacked.append(msg)
+
+    def _acknowledge(self, seq: int):
+        "forget all messages the MarkerServer acknowledged"
+        while self.unacked and self.unacked[0]["seq"] <= seq:
+            self.unacked.popleft()
+
+    def confirm(self, timeout: float = 1.0, pending: int = 0) -> bool:
+        """wait until the MarkerServer acknowledged all but pending messages
+
+        returns whether it did within timeout seconds. Reconnects and
+        retransmits if the connection was lost meanwhile.
+        """
+        deadline = pylsl.local_clock() + timeout
+        with self.lock:
+            while len(self.unacked) > pending:
+                remaining = deadline - pylsl.local_clock()
+                if remaining <= 0:
+                    return False
+                try:
+                    if not self.connected:
+                        self.connect()
+                    readable, _, _ = select.select([self.interface], [], [], remaining)
+                    if readable:
+                        data = self.interface.recv(65536)
+                        if not data:
+                            raise ConnectionResetError
+                        self._dispatch(self.reader.feed(data))
+                except (OSError, ValueError):  # e.g. the server restarts
+                    self.close()
+                    time.sleep(min(remaining, 0.05))
+            return True
+
+    def resume(self):
+        "learn which numbered messages arrived, and retransmit the others"
+        try:
+            reply = self.request({"cmd": "resume", "client": self.id})
+        except socket.timeout:
+            log.warning("MarkerServer does not acknowledge, delivering unreliably")
+            self.reliable = False
+            self.unacked.clear()
+            return
+        self._acknowledge(reply.get("acked", 0))
+        received = reply.get("received", 0)
+        for msg in self.unacked:
+            if msg["seq"] > received:
+                self.interface.sendall(encode(msg, self.binary))
+
+    def write_ring(self, marker: str, tstamp: float) -> bool:
+        """write the marker into the shared-memory ring
+
+        rings the doorbell if the MarkerServer waits for markers, and returns
+        False if the marker has to be sent over the connection instead. The
+        connection is checked at most every :attr:`check_interval` seconds,
+        not to spend a system call on every marker.
+        """
+        now = time.monotonic()
+        if self.ring is None or now - self.checked > self.check_interval:
+            if not self.connected:
+                self.connect()
+            self.checked = now
+        if self.ring is None or not self.ring.write(
+            marker.encode("utf-8"), tstamp, self.frames
+        ):
+            return False
+        if self.ring.waiting:  # only ring once until the server drained
+            self.ring.waiting = False
+            self.doorbell.send(b"\0")
+        return True
 
-    def push(self, marker: str = "", tstamp: float = None):
-        "connects, sends a message, and close the connection"
-        self.connect()
-        self.write(marker, tstamp)
-        self.close()
+    def attach(self):
+        "create a shared-memory ring and attach it to the MarkerServer"
+        try:
+            ring = Ring.create()
+        except (RuntimeError, OSError) as e:
+            log.warning(f"Falling back to tcp: {e}")
+            return
+        reply = self.request({"cmd": "attach", "ring": ring.name})
+        if reply.get("cmd", None) != "attached":
+            log.warning(f"Falling back to tcp: {reply.get('error', reply)}")
+            ring.close()
+            return
+        self.doorbell = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.doorbell.connect(("127.0.0.1", reply["doorbell"]))
+        self.ring = ring
+        self.frames = 0
+
+    def send(self, msg: dict):
+        "send a message, reconnecting once if the connection was lost"
+        with self.lock:
+            if not self.connected:
+                self.connect()
+                if self.reliable and "seq" in msg:
+                    return  # retransmitted when resuming
+            try:
+                self.interface.sendall(encode(msg, self.binary))
+            except OSError:
+                self.close()
+                self.connect()
+                if self.reliable and "seq" in msg:
+                    return
+                self.interface.sendall(encode(msg, self.binary))
+            self.frames += 1
+
+    def request(self, msg: dict) -> dict:
+        """send a message and wait for the reply of the MarkerServer
+
+        If the reply does not arrive in time, the connection is closed, so
+        that a late reply can not be taken for the reply to the next request.
+        """
+        with self.lock:
+            self.send(msg)
+            try:
+                return self.receive()
+            except socket.timeout:
+                self.close()
+                raise
+
+    def receive(self) -> dict:
+        "return the next message sent by the MarkerServer"
+        with self.lock:
+            while not self.inbox:
+                data = self.interface.recv(65536)
+                if not data:
+                    self.close()
+                    raise ConnectionResetError(
+                        "MarkerServer closed the connection")
+                self._dispatch(self.reader.feed(data))
+            return self.inbox.popleft()
+
+    def _dispatch(self, msgs: List[dict]):
+        "keep the replies in the inbox, and handle notices right away"
+        for msg in msgs:
+            cmd = msg.get("cmd", None)
+            if cmd == "ack":
+                self._acknowledge(msg.get("seq", 0))
+                continue
+            if cmd != "backpressure":
+                self.inbox.append(msg)
+                continue
+            if msg.get("blocked", False) or msg.get("dropped", 0):
+                log.warning(f"MarkerServer applies backpressure: {msg}")
+            self.backpressure = msg
+
+    @property
+    def connected(self) -> bool:
+        "whether the connection is open and was not closed by the server"
+        if self.interface is None:
+            return False
+        if self.transport == "udp":  # connectionless
+            return True
+        try:
+            readable, _, _ = select.select([self.interface], [], [], 0)
+            if readable:  # a notice, or the server closed the connection
+                data = self.interface.recv(65536)
+                if not data:
+                    raise ConnectionResetError
+                self._dispatch(self.reader.feed(data))
+        except (OSError, ValueError):
+            self.close()
+            return False
+        return True
 
     def connect(self):
         "connect wth the remote server"
-        self.interface = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.interface.connect((self.host, self.port))
+        self.reader = Reader()
+        self.inbox.clear()
+        if self.transport == "unix":
+            self.interface = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = unix_path(self.port)
+        elif self.transport == "udp":
+            self.interface = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            address = (self.host, self.port)
+        else:
+            self.interface = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.interface.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            address = (self.host, self.port)
+        try:
+            self.interface.connect(address)
+        except OSError:
+            self.interface.close()
+            self.interface = None
+            raise
         self.interface.settimeout(1)
-
-    def write(self, marker, tstamp):
-        "encode message into ascii and send all bytes"
-        msg = json.dumps((marker, tstamp)).encode("ascii")
-        if self.verbose:
-            print(f"Sending {marker} at {tstamp}")
-        self.interface.sendall(msg)
+        self.binary = False
+        if self.format == "binary" and self.transport != "udp":
+            self.negotiate()
+            if self.interface is None:  # the request timed out, and closed it
+                return self.connect()
+        if self.clock is not None:  # the new connection needs the estimate
+            self.synchronize(1 if self.clock.exchanges else 8)
+            if self.interface is None:
+                return self.connect()
+        if self.clock is not None and (
+            self.resync is None or not self.resync.is_alive()
+        ):
+            self.resync = threading.Thread(target=self._resync, daemon=True)
+            self.resync.start()
+        for announcement in self.announced.values():
+            self.interface.sendall(encode(announcement))
+        if self.reliable:
+            self.resume()
+            if self.interface is None:
+                return self.connect()
+        if self.transport == "shm":
+            self.attach()
+
+    def negotiate(self):
+        "agree with the MarkerServer whether to use the binary format"
+        try:
+            reply = self.request({"cmd": "hello", "formats": list(FORMATS)})
+        except socket.timeout:  # the MarkerServer only supports json
+            self.format = "json"  # and does not need to be asked again
+            return
+        self.binary = reply.get("format", "json") == "binary"
 
     def close(self):
         "closes the connection"
-        self.interface.shutdown(1)
+        if self.ring is not None:
+            self.ring.close()
+            self.doorbell.close()
+            self.ring = self.doorbell = None
+        if self.interface is None:
+            return
+        try:
+            if self.transport != "udp":
+                self.interface.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.interface.close()
+        self.interface = None
 
 
 if "darwin" in platform:  # pragma no cover
 
     def fake_push(
-        marker: str = "", tstamp: float = None, sanitize=True, port: int = 7654
+        marker: str = "",
+        tstamp: float = None,
+        sanitize=True,
+        port: int = 7654,
+        transport: str = "tcp",
+        stream: str = None,
+        host: str = "127.0.0.1",
+        reliable: bool = False,
+        priority: str = None,
     ):
 
         if tstamp is None:
@@ -167,3 +872,18 @@ if "darwin" in platform:  # pragma no cover
     fake_push.__doc__ = push.__doc__
     push = fake_push
 
+    def fake_push_many(
+        markers: List[Tuple[str, float]],
+        sanitize=True,
+        port: int = 7654,
+        transport: str = "tcp",
+        stream: str = None,
+        host: str = "127.0.0.1",
+        reliable: bool = False,
+        priority: str = None,
+    ):
+        for marker, tstamp in markers:
+            fake_push(marker, tstamp, sanitize=sanitize)
+
+    fake_push_many.__doc__ = push_many.__doc__
+    push_many = fake_push_many
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Clock offsets of remote clients
+-------------------------------
+
+Clients timestamp their markers with :func:`pylsl.local_clock` of their own
+machine. If the MarkerServer listens on a public address, these timestamps
+come from another clock. Clients connecting to a remote MarkerServer
+therefore estimate the offset of their clock, similar to NTP. Each exchange
+records four timestamps
+
+.. code-block:: none
+
+    t0: the client sends {"cmd": "time", "t0": t0}
+    t1: the server receives it
+    t2: the server replies {"cmd": "time", "t0": t0, "t1": t1, "t2": t2}
+    t3: the client receives the reply
+
+and yields the round-trip time `(t3 - t0) - (t2 - t1)` and the offset
+`((t1 - t0) + (t2 - t3)) / 2`, which is exact if both directions took the
+same time. Exchanges delayed by queueing have a large round-trip time and
+are discarded, and a line through the remaining offsets estimates offset
+and drift. The client sends this model to the MarkerServer
+
+.. code-block:: python
+
+    {"cmd": "clock", "offset": 0.12, "drift": 1e-6, "tref": 1234.5,
+     "rtt": 0.0003, "residual": 2e-5}
+
+which maps all further timestamps of this connection onto its own clock
+before they are pushed. The residual is the root mean square deviation of
+the kept offsets from the line, and is reported with `reiz-marker --stats`.
+
+Classes and Functions
+.....................
+"""
+import math
+from collections import deque
+
+
+def to_local(model: dict, tstamp: float) -> float:
+    "map a timestamp of the client onto the clock of the MarkerServer"
+    return tstamp + model["offset"] + model["drift"] * (tstamp - model["tref"])
+
+
+class Estimator:
+    """estimates offset and drift of the clock of a MarkerServer
+
+    args
+    ----
+    window: int
+        how many of the latest exchanges to consider
+    interval: float
+        seconds between two exchanges, see :meth:`~.due`
+    """
+
+    def __init__(self, window: int = 32, interval: float = 10.0):
+        self.exchanges = deque(maxlen=window)  #: (time, offset, rtt)
+        self.interval = interval
+        self.last = float("-inf")
+
+    def add(self, t0: float, t1: float, t2: float, t3: float):
+        "record the four timestamps of an exchange"
+        rtt = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        self.exchanges.append(((t0 + t3) / 2, offset, rtt))
+        self.last = t3
+
+    def due(self, now: float) -> bool:
+        "whether the last exchange is more than interval seconds old"
+        return now - self.last >= self.interval
+
+    def fit(self) -> dict:
+        """fit offset and drift to the exchanges with the shortest round trip
+
+        returns
+        -------
+        model: dict
+            offset and drift at the reference time tref, the shortest
+            round-trip time and the residual, all in seconds. None if there
+            were no exchanges yet
+        """
+        if not self.exchanges:
+            return None
+        rtts = sorted(e[2] for e in self.exchanges)
+        limit = max(rtts[len(rtts) // 4], 1.5 * rtts[0])
+        kept = [e for e in self.exchanges if e[2] <= limit]
+        tref = kept[-1][0]
+        times = [t - tref for t, o, r in kept]
+        offsets = [o for t, o, r in kept]
+        mean_t = sum(times) / len(times)
+        mean_o = sum(offsets) / len(offsets)
+        spread = sum((t - mean_t) ** 2 for t in times)
+        if len(kept) < 3 or times[-1] - times[0] < 1.0:
+            drift = 0.0  # too short to tell drift from noise
+        else:
+            drift = sum((t - mean_t) * (o - mean_o)
+                        for t, o in zip(times, offsets)) / spread
+        offset = mean_o - drift * mean_t
+        residual = math.sqrt(
+            sum((o - offset - drift * t) ** 2 for t, o in zip(times, offsets))
+            / len(kept))
+        return {
+            "offset": offset,
+            "drift": drift,
+            "tref": tref,
+            "rtt": rtts[0],
+            "residual": residual,
+        }
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Numeric event codes
+-------------------
+
+Many analysis pipelines only need integer event codes, and string samples
+are costly to record and to parse. Start the MarkerServer with
+`reiz-marker --codes codes.json` to open a second outlet with the channel
+format `int32` next to each marker outlet, called e.g. `reiz-marker-codes`.
+The file maps markers to their codes, e.g.
+
+.. code-block:: json
+
+    {"trial_onset": 1, "left": 10, "right": 11}
+
+Whenever a registered marker is pushed, its code is pushed to the code
+outlet with the same timestamp. Clients register further codes with
+:func:`~reiz._marker.client.register_code`, and push codes directly with
+:func:`~reiz._marker.client.push_code`, which sends only a timestamp and the
+code. The marker outlet receives the registered marker for such a code, or
+the code as text if it was not registered, so it remains complete.
+
+Use `--code-format double` for pipelines expecting floating point codes.
+
+Classes
+.......
+"""
+import json
+import threading
+
+CODE_FORMATS = ("int32", "double")  #: supported channel formats of codes
+INT32 = (-(2 ** 31), 2 ** 31 - 1)
+
+
+class Codes:
+    """a registry of markers and their numeric codes
+
+    Lookups are lock-free, so that MarkerStreamers can look up codes while
+    the MarkerServer registers new ones.
+
+    args
+    ----
+    mapping: dict
+        markers and their codes to register initially
+    format: str
+        the channel format of the code outlets, one of :data:`CODE_FORMATS`
+    """
+
+    def __init__(self, mapping: dict = None, format: str = "int32"):
+        if format not in CODE_FORMATS:
+            raise ValueError(f"Unknown code format {format}, use {CODE_FORMATS}")
+        self.format = format
+        self.codes = dict()  #: the code of each marker
+        self.markers = dict()  #: the marker of each code
+        self.lock = threading.Lock()
+        for marker, code in (mapping or {}).items():
+            self.register(marker, code)
+
+    @classmethod
+    def load(cls, path: str, format: str = "int32") -> "Codes":
+        "load the markers and their codes from a json file"
+        with open(path, "r", encoding="utf-8") as f:
+            mapping = json.load(f)
+        if not isinstance(mapping, dict):
+            raise ValueError(f"{path} does not map markers to codes")
+        return cls(mapping, format)
+
+    def register(self, marker: str, code: int):
+        """register the code of a marker
+
+        raises
+        ------
+        ValueError
+            if the code is not an int32, or if marker or code were already
+            registered differently
+        """
+        if not isinstance(marker, str) or not marker:
+            raise ValueError(f"Invalid marker {marker!r}")
+        if isinstance(code, bool) or not isinstance(code, int) or \
+                not INT32[0] <= code <= INT32[1]:
+            raise ValueError(f"Code {code!r} of {marker} is not an int32")
+        with self.lock:
+            if self.codes.get(marker, code) != code or \
+                    self.markers.get(code, marker) != marker:
+                raise ValueError(f"{marker} or {code} is already registered")
+            self.codes[marker] = code
+            self.markers[code] = marker
+
+    def get(self, marker: str) -> int:
+        "the code of a marker, or None if it was not registered"
+        return self.codes.get(marker, None)
+
+    def marker(self, code: int) -> str:
+        "the marker of a code, or the code as text if it was not registered"
+        marker = self.markers.get(code, None)
+        if marker is None:
+            marker = str(code)
+            try:
+                self.register(marker, code)
+            except ValueError:  # e.g. the text is registered for another code
+                pass
+        return marker
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Write-ahead marker journal
+--------------------------
+
+Start the MarkerServer with `reiz-marker --journal PATH` to record every
+accepted marker with its timestamp in an append-only, memory-mapped journal
+before it is pushed to LSL. Once the marker was pushed, its record is
+acknowledged in place.
+
+Because the journal is memory-mapped, a record is safe as soon as it was
+written, even if the MarkerServer crashes immediately afterwards. The
+journal is additionally synced to disk in regular intervals, which protects
+against a crash of the whole machine without paying for a sync per marker.
+
+After a restart with the same journal, all records that were never
+acknowledged are pushed again. The journal starts from scratch if all
+records were acknowledged. While the MarkerServer runs, the journal is
+compacted whenever it is full and at least half of it holds acknowledged
+records: the pending records are moved to its front, and the acknowledged
+ones are discarded. The journal therefore only grows if many markers are
+pending at once, e.g. while LSL stalls.
+
+Each record has a fixed-size header followed by the utf-8 encoded name of
+the outlet and the utf-8 encoded marker
+
+.. code-block:: none
+
+    uint32 length of the marker, uint64 sequence number, float64 timestamp,
+    uint8 acked, uint8 length of the outlet name
+
+Classes and Functions
+.....................
+"""
+import mmap
+import os
+import struct
+import threading
+from typing import Iterator, List, Tuple
+from pylsl import local_clock
+
+MAGIC = b"RZJ1\0\0\0\0"
+RECORD = struct.Struct("<IQdBB2x")  #: length, seq, timestamp, acked, stream
+ACKED = 20  #: offset of the acked flag within a record
+CHUNK = 2 ** 20  #: the journal grows in chunks of 1MiB
+
+
+def _records(buf, size: int) -> Iterator[Tuple[int, int, str, float, bool, str]]:
+    "yield offset, seq, marker, tstamp, acked and stream of complete records"
+    offset = len(MAGIC)
+    while offset + RECORD.size <= size:
+        length, seq, tstamp, acked, named = RECORD.unpack_from(buf, offset)
+        start = offset + RECORD.size
+        end = start + named + length
+        if length == 0 or end > size:
+            return  # the end of the journal, or a record cut off by a crash
+        stream = bytes(buf[start:start + named]).decode("utf-8")
+        marker = bytes(buf[start + named:end]).decode("utf-8")
+        yield offset, seq, marker, tstamp, acked == 1, stream
+        offset = end
+
+
+def read_journal(path: str) -> List[Tuple[int, str, float, bool, str]]:
+    """read all records of a journal
+
+    args
+    ----
+    path: str
+        the path to the journal
+
+    returns
+    -------
+    records: List[Tuple[int, str, float, bool, str]]
+        the sequence number, marker, timestamp, whether it was pushed to LSL
+        and the name of its outlet for each record. The name is empty for
+        the default outlet
+    """
+    with open(path, "rb") as f:
+        buf = f.read()
+    if not buf.startswith(MAGIC):
+        raise ValueError(f"{path} is not a marker journal")
+    return [r[1:] for r in _records(buf, len(buf))]
+
+
+class Journal:
+    """an append-only, memory-mapped journal of markers
+
+    args
+    ----
+    path: str
+        the path to the journal. It is created if it does not exist yet
+    sync_interval: float
+        the journal is synced to disk at most once per sync_interval seconds
+    """
+
+    def __init__(self, path: str, sync_interval: float = 0.05):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.last_sync = local_clock()
+        self.file = open(path, "a+b")
+        self.file.seek(0, os.SEEK_END)
+        size = self.file.tell()
+        if size < len(MAGIC):
+            size = self._reset()
+        self.map = mmap.mmap(self.file.fileno(), size)
+        if self.map[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a marker journal")
+        self._pending = []
+        self.unacked = dict()  #: seq to offset and size of pending records
+        self.end = len(MAGIC)
+        self.seq = 0
+        for offset, seq, marker, tstamp, acked, stream in _records(self.map,
+                                                                   size):
+            end = offset + RECORD.size + len(stream.encode("utf-8")) \
+                + len(marker.encode("utf-8"))
+            if not acked:
+                self._pending.append((seq, marker, tstamp, stream))
+                self.unacked[seq] = (offset, end - offset)
+            self.end = end
+            self.seq = seq + 1
+        if not self._pending:  # everything was pushed, start from scratch
+            self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self._reset())
+            self.end = len(MAGIC)
+
+    def _reset(self) -> int:
+        "truncate the file to a fresh journal, returning its size"
+        self.file.truncate(0)
+        self.file.write(MAGIC)
+        self.file.truncate(CHUNK)
+        self.file.flush()
+        return CHUNK
+
+    def pending(self) -> List[Tuple[int, str, float, str]]:
+        "seq, marker, timestamp and stream of records not acknowledged"
+        return list(self._pending)
+
+    def append(self, marker: str, tstamp: float, stream: str = "") -> int:
+        """write a record for the marker
+
+        args
+        ----
+        marker: str
+            the marker
+        tstamp: float
+            its timestamp
+        stream: str
+            the name of its outlet, at most 255 bytes. Empty for the default
+            outlet
+
+        returns
+        -------
+        seq: int
+            the sequence number of the record, used to acknowledge it
+        """
+        name = stream.encode("utf-8")
+        payload = name + marker.encode("utf-8")
+        if len(name) > 255:
+            raise ValueError(f"The name of the outlet {stream} is too long")
+        size = RECORD.size + len(payload)
+        with self.lock:
+            if self.end + size + RECORD.size > len(self.map):
+                self._compact()
+            if self.end + size + RECORD.size > len(self.map):
+                self._grow(self.end + size + RECORD.size)
+            offset, seq = self.end, self.seq
+            end = offset + size
+            self.map[offset + RECORD.size:end] = payload
+            self.map[end:end + RECORD.size] = bytes(RECORD.size)
+            RECORD.pack_into(self.map, offset, len(payload) - len(name),
+                             seq, tstamp, 0, len(name))
+            self.unacked[seq] = (offset, size)
+            self.seq += 1
+            self.end = end
+            self.dirty = True
+        return seq
+
+    def _compact(self):
+        "move the pending records to the front if most records were acked"
+        live = sum(size for offset, size in self.unacked.values())
+        if 2 * live > self.end - len(MAGIC):
+            return
+        end = len(MAGIC)
+        for seq, (offset, size) in self.unacked.items():
+            if offset != end:
+                self.map.move(end, offset, size)
+            self.unacked[seq] = (end, size)
+            end += size
+        self.map[end:end + RECORD.size] = bytes(RECORD.size)
+        self.end = end
+        self.dirty = True
+
+    def _grow(self, size: int):
+        "remap the journal with at least size bytes"
+        size = (size // CHUNK + 1) * CHUNK
+        self.map.flush()
+        self.map.close()
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def ack(self, seq: int):
+        "mark the record with the sequence number seq as pushed to LSL"
+        with self.lock:
+            offset, size = self.unacked.pop(seq)
+            self.map[offset + ACKED] = 1
+            self.dirty = True
+
+    @property
+    def idle(self) -> bool:
+        "whether all records were pushed and synced, so no sync is due"
+        with self.lock:
+            return not self.dirty and not self.unacked
+
+    def sync(self, force: bool = False):
+        "sync to disk, unless that was done less than sync_interval ago"
+        now = local_clock()
+        if not self.dirty or (not force and now - self.last_sync < self.sync_interval):
+            return
+        with self.lock:
+            self.map.flush()
+            self.dirty = False
+        self.last_sync = now
+
+    def close(self):
+        "sync and close the journal"
+        self.sync(force=True)
+        with self.lock:
+            self.map.close()
+            self.file.close()
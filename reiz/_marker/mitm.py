@@ -13,21 +13,64 @@ Functions and Classes
 
 import pylsl
 import threading
-import queue
-import time
+from queue import Full
+from typing import List, Tuple
 import socket
-import json
+import selectors
+from collections import deque
 from reiz._marker.client import available
-import pkg_resources
-version = pkg_resources.get_distribution("reiz").version
+from reiz._marker.protocol import encode, Reader, ProtocolError
+from reiz._marker.protocol import TRANSPORTS, FORMATS, unix_path
+from reiz._marker.stats import Stats
+from reiz._marker.ring import Ring
+from reiz._marker.journal import Journal
+from reiz._marker.clock import to_local
+from reiz._marker.bounded import Lanes, POLICIES, PRIORITIES
+from reiz._marker.templates import expand
+from reiz._marker.codes import Codes
+import os
 # %%
 
 
+def get_version() -> str:
+    "the installed version of reiz, looked up on first use"
+    global version
+    if version is None:
+        try:
+            from importlib.metadata import version as lookup  # Python 3.8
+        except ImportError:  # pragma no cover
+            from pkg_resources import get_distribution
+
+            def lookup(name):
+                return get_distribution(name).version
+        try:
+            version = lookup("reiz")
+        except Exception:  # e.g. running from a source tree
+            version = "unknown"
+    return version
+
+
+version = None  #: cached by :func:`~.get_version`
+
+
+def _is_tstamp(tstamp) -> bool:
+    "whether tstamp is a number, or None to stamp the marker on receipt"
+    return tstamp is None or (isinstance(tstamp, (int, float))
+                              and not isinstance(tstamp, bool))
+
+
+def _is_batch(markers) -> bool:
+    "whether markers is a list of (marker, tstamp)"
+    return isinstance(markers, (list, tuple)) and all(
+        isinstance(m, (list, tuple)) and len(m) == 2
+        and isinstance(m[0], str) and _is_tstamp(m[1]) for m in markers)
+
+
 class _Outlet():
     "LSL based marker outlet as a singleton, to prevent name-stealing"
     instance = dict()
     @classmethod
-    def get(cls, name='reiz-marker'):
+    def get(cls, name='reiz-marker', channel_format='string'):
         import socket
         import weakref
         source_id = '_at_'.join((name, socket.gethostname()))
@@ -36,9 +79,10 @@ class _Outlet():
                                     type='Markers',
                                     channel_count=1,
                                     nominal_srate=0,
-                                    channel_format='string', source_id=source_id)
+                                    channel_format=channel_format,
+                                    source_id=source_id)
 
-            info.desc().append_child_value("version", version)
+            info.desc().append_child_value("version", get_version())
             print(info.as_xml())
             outlet = pylsl.StreamOutlet(info)
             cls.instance[name] = weakref.ref(outlet)
@@ -48,37 +92,152 @@ class _Outlet():
 
 
 class _MarkerStreamer(threading.Thread):
+    """forwards queued markers to the LSL outlet
+
+    The thread blocks on the queue, and wakes up as soon as a marker is
+    enqueued. Received and pushed markers are recorded in :attr:`stats`.
+    With a :class:`~reiz._marker.journal.Journal`, each marker is recorded
+    before it is enqueued, and acknowledged once it was pushed. The journal
+    is shared by the MarkerStreamers of all outlets, and labels each record
+    with `stream`.
+
+    Each priority lane of the queue holds at most `maxsize` markers, and
+    applies the `policy` once it is full, see :mod:`~reiz._marker.bounded`.
+    Pushing raises :class:`queue.Full` if the policy is to block, unless
+    `force` is set.
+
+    With :class:`~reiz._marker.codes.Codes`, the codes of registered markers
+    are pushed to a second outlet, see :mod:`~reiz._marker.codes`.
+
+    Each priority class has its own lane of the queue, and markers of the
+    most urgent lane are pushed first.
+    """
 
-    def __init__(self, name: str = None):
+    _STOP = None  #: enqueued by :meth:`~.stop` to end the thread
+
+    def __init__(self, name: str = None, verbose=True, stats: Stats = None,
+                 journal: Journal = None, stream: str = '',
+                 maxsize: int = 0, policy: str = 'block',
+                 codes: Codes = None):
         threading.Thread.__init__(self)
-        self.queue = queue.Queue(maxsize=0)  # indefinite size
+        self.queue = Lanes(maxsize, policy, journal)
         self.is_running = threading.Event()
         self.name = name
+        self.verbose = verbose
+        self.stats = Stats() if stats is None else stats
+        self.journal = journal
+        self.stream = stream
+        self.codes = codes
+        self.code_outlet = None
 
-    def push(self, marker: str = '', tstamp: float = None):
+    def _record(self, samples, tstamps) -> List[int]:
+        'write markers to the journal, returning the seqs of their records'
+        if self.journal is None:
+            return []
+        return [self.journal.append(m, t, self.stream)
+                for m, t in zip(samples, tstamps)]
+
+    def push(self, marker: str = '', tstamp: float = None,
+             force: bool = False,
+             priority: str = 'normal') -> Tuple[int, int]:
+        'enqueue a marker, returning how many markers were dropped and coalesced'
         if marker == '':
-            return
+            return 0, 0
+        if not force:
+            self.queue.check(1, self.name, priority)
+        received = pylsl.local_clock()
         if tstamp is None:
-            tstamp = pylsl.local_clock()
+            tstamp = received
+
+        self.stats.on_receive([tstamp], received)
+        records = self._record([marker], [tstamp])
+        return self.queue.put(([marker], [tstamp], received, records), force,
+                              priority)
+
+    def push_many(self, markers: List[Tuple[str, float]],
+                  force: bool = False,
+                  priority: str = 'normal') -> Tuple[int, int]:
+        'enqueue a batch of (marker, tstamp) to be pushed as a single chunk'
+        received = pylsl.local_clock()
+        markers = [(m, received if t is None else t)
+                   for m, t in markers if m != '']
+        if not markers:
+            return 0, 0
+        if not force:
+            self.queue.check(len(markers), self.name, priority)
+        samples, tstamps = zip(*markers)
+        self.stats.on_receive(tstamps, received)
+        records = self._record(samples, tstamps)
+        return self.queue.put((list(samples), list(tstamps), received,
+                               records), force, priority)
+
+    def recover(self, pending: List[Tuple[int, str, float]]):
+        'enqueue (seq, marker, tstamp) recorded but never acknowledged'
+        if not pending:
+            return
+        print(f"Recovering {len(pending)} markers for {self.name}")
+        records, samples, tstamps = zip(*pending)
+        self.queue.put((list(samples), list(tstamps), pylsl.local_clock(),
+                        list(records)), force=True)
 
-        self.queue.put_nowait((marker, tstamp))
+    def _push_chunk(self, samples: List[str], tstamps: List[float]):
+        'push a chunk with a timestamp per sample'
+        if len(samples) == 1:
+            self.outlet.push_sample(samples, tstamps[0])
+            return
+        try:
+            self.outlet.push_chunk([[s] for s in samples], tstamps)
+        except TypeError:  # pylsl without per-sample timestamps for chunks
+            for sample, tstamp in zip(samples, tstamps):
+                self.outlet.push_sample([sample], tstamp)
+
+    def _push_codes(self, samples: List[str], tstamps: List[float]):
+        'push the codes of all registered markers'
+        codes = self.codes.codes
+        coded = [([codes[s]], t) for s, t in zip(samples, tstamps) if s in codes]
+        if len(coded) == 1:
+            self.code_outlet.push_sample(*coded[0])
+        elif coded:
+            samples, tstamps = zip(*coded)
+            try:
+                self.code_outlet.push_chunk(list(samples), list(tstamps))
+            except TypeError:  # pylsl without per-sample timestamps
+                for sample, tstamp in coded:
+                    self.code_outlet.push_sample(sample, tstamp)
 
     def stop(self):
+        'push all markers still in the queue, then stop the thread'
+        self.queue.put(self._STOP, priority=PRIORITIES[-1])
         self.queue.join()
-        self.is_running.clear()
 
     def run(self):
         self.outlet = _Outlet.get(name=self.name)
+        if self.codes is not None:
+            self.code_outlet = _Outlet.get(name=f'{self.name}-codes',
+                                           channel_format=self.codes.format)
         self.is_running.set()
-        while self.is_running.is_set():
+        while True:
+            priority, item = self.queue.get()
+            if item is self._STOP:
+                self.queue.task_done(priority)
+                break
+            samples, tstamps, received, records = item
             try:
-                marker, tstamp = self.queue.get(block=False)
-                self.outlet.push_sample([marker], tstamp)
-                self.queue.task_done()
-                print(
-                    f'Pushed {marker} from {tstamp} at {pylsl.local_clock()}')
-            except queue.Empty:
-                time.sleep(0.001)
+                self._push_chunk(samples, tstamps)
+                if self.code_outlet is not None:
+                    self._push_codes(samples, tstamps)
+                self.stats.on_push(tstamps, received, pylsl.local_clock(),
+                                   self.queue.qsize(), priority)
+            except Exception as e:  # keep serving, and never miss task_done
+                print(f'Pushing {samples} failed: {e!r}')
+            for record in records:  # pushing them again would fail again
+                self.journal.ack(record)
+            self.queue.task_done(priority)
+            if self.verbose:
+                for marker, tstamp in zip(samples, tstamps):
+                    print(f'Pushed {marker} from {tstamp} at '
+                          f'{pylsl.local_clock()}')
+        self.is_running.clear()
         print(f"Shutting down MarkerStreamer: {self.name}")
 # %%
 
@@ -94,25 +253,61 @@ def myip() -> str:
 
 
 # -----------------------------------------------------------------------------
-def _read_msg(client):
-    'receive byte for byte to read the header telling the message length'
-    # parse the message until it is a valid json
-    msg = bytearray(b' ')
-    while True:
+class _Connection():
+    """state of a single non-blocking client connection
+
+    Clients keep their connection open, and each connection buffers its own
+    partially received frames and its not yet sent replies. Legacy clients,
+    which send a single unframed json and close the connection, are
+    supported, too.
+    """
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.reader = Reader()
+        self.outbox = bytearray()
+        self.ring = None
+        self.frames = 0  #: frames handled since the ring was attached
+        self.held = []  #: markers read from the ring, held back by a full queue
+        self.clock = None  #: maps timestamps of a remote client
+        self.pending = deque()  #: messages held back by backpressure
+        self.blocked = None  #: the stream whose queue holds them back
+        self.lane = None  #: the lane of that queue which was full
+        self.registered = False
+        self.dropped = 0  #: markers dropped since the last notice
+        self.coalesced = 0
+        self.notified = float('-inf')
+        self.session = None  #: set if the client numbers its messages
+        self.templates = dict()  #: the templates announced by the client
+
+    def close(self):
+        'close the connection to the client'
+        if self.ring is not None:
+            self.ring.close()
         try:
-            prt = client.recv(1)
-            msg += prt
-            # because the first byte is b' '
-            marker, tstamp = json.loads(msg.decode('ascii'))
-            print(f'Received {marker} for {tstamp} at {pylsl.local_clock()}')
-            return marker, tstamp
-        except json.decoder.JSONDecodeError:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
             pass
-        except Exception as e:
-            print(e)
-            break
+        self.sock.close()
+
+
+class _Session():
+    """delivery state of a client sending numbered messages
+
+    Sessions outlive connections, so that a reconnecting client learns which
+    of its messages arrived, and retransmits only the others. A session
+    which was not resumed within :attr:`Server.session_timeout` after its
+    connection closed is forgotten.
+    """
 
-    return ('', None)
+    def __init__(self, client: str):
+        self.client = client
+        self.conn = None  #: the latest connection of the client
+        self.closed = None  #: when that connection closed, if it did
+        self.received = 0  #: the highest sequence number received
+        self.acked = 0  #: the highest sequence number acknowledged
+        self.outstanding = deque()  #: (queue, ticket, seq) not yet pushed
 
 
 class Server(threading.Thread):
@@ -122,21 +317,702 @@ class Server(threading.Thread):
     running at that port. If this is the case, it returns and lets the old one
     keep control. This ensures that subscribers to the old MarkerServer
     don't experience any hiccups.
+
+    All connections are multiplexed with a selector in a single thread, and
+    sockets are non-blocking. A slow or stalled client therefore never blocks
+    any of the other clients.
+
+    The server can listen on several transports at once, e.g. `tcp` for
+    remote and legacy clients and `unix`, `udp` or `shm` for cheaper delivery
+    on the same host. See :mod:`~reiz._marker.protocol`.
+
+    With a journal, every accepted marker is written to disk before it is
+    pushed, and markers left unacknowledged by a crash are pushed again after
+    the restart. See :mod:`~reiz._marker.journal`.
+
+    Clients may send binary frames, if the server offers the binary format
+    in its `formats`. Otherwise, they fall back to json.
+
+    Markers are pushed to the outlet called `name`, unless a message names
+    another outlet as its `stream`. The outlet is created on first use, and
+    each outlet has its own MarkerStreamer and queue, so a busy outlet does
+    not delay the markers of the others.
+
+    Each priority lane of a queue holds at most `maxsize` markers, and
+    applies the `policy` once it is full. With the policy `block`, the server
+    stops reading from the connection until the lane drained. Clients are notified whenever
+    markers are dropped or held back. See :mod:`~reiz._marker.bounded`.
+
+    Clients may number their messages to deliver them reliably. The server
+    ignores messages it already received, and acknowledges cumulatively once
+    the markers were pushed to their outlet, see
+    :mod:`~reiz._marker.protocol`.
+
+    With `codes`, each outlet is mirrored by an outlet of numeric event
+    codes, and clients may push codes instead of markers, see
+    :mod:`~reiz._marker.codes`.
+
+    Messages may name a priority class. Critical markers overtake normal and
+    bulk markers queued for the same outlet, and the latencies of each class
+    are reported separately, see :mod:`~reiz._marker.bounded`.
     """
 
+    notice_interval = 1.0  #: minimal seconds between two notices of drops
+    session_timeout = 60.0  #: seconds to keep a session without connection
+
     def __init__(self, port: int = 7654, name='reiz-marker',
-                 timeout=.05, verbose=True):
+                 timeout=.05, verbose=True, host: str = "127.0.0.1",
+                 transports=("tcp",), journal: str = None,
+                 formats=FORMATS, maxsize: int = 0, policy: str = 'block',
+                 codes: Codes = None):
         threading.Thread.__init__(self)
-        self.host = "127.0.0.1"
+        for transport in transports:
+            if transport not in TRANSPORTS:
+                raise ValueError(
+                    f"Unknown transport {transport}, use {TRANSPORTS}")
+        if 'shm' in transports and 'tcp' not in transports:
+            raise ValueError("The shm transport is attached over tcp")
+        for format in formats:
+            if format not in FORMATS:
+                raise ValueError(f"Unknown format {format}, use {FORMATS}")
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown policy {policy}, use {POLICIES}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.codes = codes
+        self.host = host
+        self.transports = tuple(transports)
+        self.formats = tuple(formats)
         self.port = port
         self.name = name
         self.is_running = threading.Event()
         self.singleton = threading.Event()
         self.verbose = verbose
+        self.connections = set()
+        self.rings = dict()
+        self.doorbell = None
+        self.stats = Stats()
+        self.journal = journal
+        self.streamers = dict()
+        self.paused = set()
+        self.dropped_datagrams = 0
+        self.sessions = dict()
+        self.unacked = set()  #: sessions waiting for acknowledgements
+        self.duplicates = 0
+        self._wakeup, self._waker = socket.socketpair()
 
     def stop(self):
         'stop the server'
         self.is_running.clear()
+        self.wakeup()
+
+    def wakeup(self):
+        'interrupt the selector, e.g. to notice that the server was stopped'
+        try:
+            self._waker.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass  # a wakeup is already pending, or the server is closed
+
+    def _close_wakeup(self):
+        'close both ends of the socket pair interrupting the selector'
+        self._wakeup.close()
+        self._waker.close()
+
+    def status(self) -> dict:
+        'the statistics of the server and its current state'
+        streams = {
+            name: {'received': s.stats.received, 'pushed': s.stats.pushed,
+                   'queue': s.queue.qsize(), 'dropped': s.queue.dropped,
+                   'coalesced': s.queue.coalesced,
+                   'priorities': s.stats.by_priority()}
+            for name, s in list(self.streamers.items())
+        }
+        return self.stats.as_dict(
+            name=self.name,
+            queue=self.markerstreamer.queue.qsize(),
+            maxsize=self.maxsize,
+            policy=self.policy,
+            dropped=sum(s['dropped'] for s in streams.values()),
+            coalesced=sum(s['coalesced'] for s in streams.values()),
+            dropped_datagrams=self.dropped_datagrams,
+            paused=len(self.paused),
+            sessions=len(self.sessions),
+            duplicates=self.duplicates,
+            connections=len(self.connections),
+            ring_overflows=sum(r.overflows for r in self.rings.values()),
+            streams=streams,
+            clocks=[dict(address=str(c.address), **c.clock)
+                    for c in list(self.connections) if c.clock is not None],
+        )
+
+    def health(self) -> dict:
+        'a cheap summary of the current state, without any statistics'
+        return {
+            'cmd': 'health',
+            'name': self.name,
+            'uptime': pylsl.local_clock() - self.stats.started,
+            'queue': sum(s.queue.qsize() for s in list(self.streamers.values())),
+            'connections': len(self.connections),
+            'version': get_version(),
+        }
+
+    def streamer(self, stream: str = None) -> _MarkerStreamer:
+        """the MarkerStreamer of an outlet, started on first use
+
+        args
+        ----
+        stream: str
+            the name of the outlet. Defaults to None, i.e. the outlet of the
+            server
+
+        returns
+        -------
+        streamer: _MarkerStreamer
+            the MarkerStreamer, or None if stream is not a valid name
+        """
+        if stream is None or stream == self.name:
+            return self.markerstreamer
+        streamer = self.streamers.get(stream, None)
+        if streamer is None:
+            if not isinstance(stream, str) or not stream or \
+                    len(stream.encode('utf-8')) > 255:
+                print(f'Received invalid stream name {stream!r}')
+                return None
+            streamer = self._start_streamer(
+                name=stream, journal=self.markerstreamer.journal,
+                stream=stream)
+            self.streamers[stream] = streamer
+        return streamer
+
+    def _start_streamer(self, **kwargs) -> _MarkerStreamer:
+        'start a MarkerStreamer with the bound and policy of the server'
+        streamer = _MarkerStreamer(verbose=self.verbose, maxsize=self.maxsize,
+                                   policy=self.policy, codes=self.codes,
+                                   **kwargs)
+        for lane in streamer.queue.lanes.values():
+            lane.on_space = self.wakeup
+            lane.on_done = self.wakeup
+        streamer.start()
+        return streamer
+
+    def handle(self, msg: dict, conn: _Connection = None,
+               force: bool = False) -> dict:
+        """handle a single message received from a client
+
+        args
+        ----
+        msg: dict
+            the message
+        conn: _Connection
+            the connection which received the message
+        force: bool
+            enqueue markers even if that exceeds the bound of the queue
+
+        returns
+        -------
+        reply: dict
+            the message to send back to the client, or None
+
+        raises
+        ------
+        queue.Full
+            if the markers have to wait until the queue drained
+        """
+        address = None if conn is None else conn.address
+        cmd = msg.get('cmd', None)
+        if cmd in ('push', 'batch', 'code'):
+            streamer = self.streamer(msg.get('stream', None))
+            session = None if conn is None else conn.session
+            seq = msg.get('seq', None)
+            if session is not None and seq is not None and \
+                    seq <= session.received:
+                self.duplicates += 1  # retransmitted after a reconnect
+                return None
+            if streamer is None:
+                return self._reject(session, seq)
+            priority = msg.get('priority', None) or 'normal'
+            if priority not in PRIORITIES:
+                print(f'Received unknown priority {priority!r} from {address}')
+                priority = 'normal'
+        clock = None if conn is None else conn.clock
+        if cmd in ('push', 'code'):
+            marker, tstamp = msg.get('marker', ''), msg.get('tstamp', None)
+            if 'template' in msg:
+                marker = self._expand(msg, conn)
+            elif cmd == 'code':
+                marker = self._decode(msg.get('code', None))
+            if not isinstance(marker, str) or not _is_tstamp(tstamp):
+                print(f'Received invalid marker {marker!r} for {tstamp!r} '
+                      f'from {address}')
+                return self._reject(session, seq)
+            if self.verbose:
+                print(f'Received {marker} for {tstamp} at {pylsl.local_clock()}')
+            if clock is not None and tstamp is not None:
+                tstamp = to_local(clock, tstamp)
+            self._account(conn, streamer.push(marker, tstamp, force, priority))
+        elif cmd == 'batch':
+            markers = msg.get('markers', [])
+            if not _is_batch(markers):
+                print(f'Received invalid batch {markers!r} from {address}')
+                return self._reject(session, seq)
+            if self.verbose:
+                print(f'Received batch of {len(markers)} markers at '
+                      f'{pylsl.local_clock()}')
+            if clock is not None:
+                markers = [(m, t if t is None else to_local(clock, t))
+                           for m, t in markers]
+            self._account(conn, streamer.push_many(markers, force, priority))
+        if cmd in ('push', 'batch', 'code'):
+            if session is not None and seq is not None:
+                self._expect(session, streamer.queue.lane(priority), seq)
+        elif cmd == 'time':  # a client estimates the offset of our clock
+            received = pylsl.local_clock()
+            return {'cmd': 'time', 't0': msg.get('t0', None), 't1': received,
+                    't2': pylsl.local_clock()}
+        elif cmd == 'clock':
+            return self._set_clock(msg, conn)
+        elif cmd == 'register':
+            return self._register_code(msg.get('marker', None),
+                                       msg.get('code', None))
+        elif cmd == 'template':
+            return self._register_template(msg, conn)
+        elif cmd == 'resume':
+            return self._resume_session(msg.get('client', None), conn)
+        elif cmd == 'ping':  # connection was only pinged
+            if self.verbose:
+                print("Received ping from", address)
+            return {'cmd': 'pong'}
+        elif cmd == 'health':
+            return self.health()
+        elif cmd == 'hello':
+            offered = msg.get('formats', ['json'])
+            format = [f for f in offered if f in self.formats] + ['json']
+            return {'cmd': 'hello', 'format': format[0]}
+        elif cmd == 'attach':
+            return self._attach(msg.get('ring', ''), conn)
+        elif cmd == 'stats':
+            return {'cmd': 'stats', 'stats': self.status()}
+        elif cmd == 'kill':
+            print("Swallowing poison pill")
+            self.is_running.clear()
+        else:
+            print(f'Received unknown command {cmd} from {address}')
+        return None
+
+    def _account(self, conn: _Connection, counts: Tuple[int, int]):
+        'count the markers of a connection which were dropped or coalesced'
+        if conn is not None:
+            conn.dropped += counts[0]
+            conn.coalesced += counts[1]
+
+    def _notify(self, conn: _Connection, blocked: bool = None,
+                stream: str = None):
+        'notify a client about backpressure, at most once per interval'
+        now = pylsl.local_clock()
+        if blocked is None:
+            if not (conn.dropped or conn.coalesced) or \
+                    now - conn.notified < self.notice_interval:
+                return
+            notice = {'cmd': 'backpressure', 'policy': self.policy,
+                      'dropped': conn.dropped, 'coalesced': conn.coalesced,
+                      'blocked': False}
+            conn.dropped = conn.coalesced = 0
+        else:
+            notice = {'cmd': 'backpressure', 'policy': self.policy,
+                      'stream': stream, 'blocked': blocked}
+        conn.notified = now
+        if self.verbose:
+            print(f'Notifying {conn.address} of backpressure: {notice}')
+        conn.outbox += encode(notice)
+
+    def _pause(self, conn: _Connection, msgs, stream: str, lane=None):
+        'stop reading from a connection until the queue of stream drained'
+        conn.pending.extend(msgs)
+        if conn not in self.paused:
+            self.paused.add(conn)
+            conn.blocked, conn.lane = stream, lane
+            self._notify(conn, blocked=True, stream=stream)
+
+    def _resume(self):
+        'handle the messages held back once their lane is half empty again'
+        for conn in list(self.paused):
+            if conn not in self.connections:
+                self.paused.discard(conn)
+                continue
+            if conn.lane is not None and conn.lane.blocked:
+                continue
+            try:
+                while conn.pending:
+                    reply = self._handle_frame(conn.pending[0], conn)
+                    conn.pending.popleft()
+                    if reply is not None:
+                        conn.outbox += encode(reply)
+                if conn.ring is not None:
+                    self._drain(conn)
+            except Full as e:
+                conn.lane = e.args[1]
+            else:
+                self.paused.discard(conn)
+                self._notify(conn, blocked=False, stream=conn.blocked)
+            self._notify(conn)
+            if conn.outbox:
+                self._write(conn)
+
+    def _register_template(self, msg: dict, conn: _Connection):
+        'remember a template announced by a client for this connection'
+        parts = msg.get('parts', None)
+        if conn is None or not isinstance(msg.get('id', None), int) or \
+                not isinstance(parts, list) or not parts or \
+                not all(isinstance(p, str) for p in parts):
+            print(f'Ignoring invalid template {msg}')
+            return None  # clients do not wait for a reply
+        conn.templates[msg['id']] = (parts, bool(msg.get('json', False)),
+                                     bool(msg.get('sanitize', False)))
+        return None
+
+    def _decode(self, code: int) -> str:
+        'the marker of an event code, or an empty marker if it is invalid'
+        if isinstance(code, bool) or not isinstance(code, int):
+            print(f'Received invalid code {code!r}')
+            return ''
+        if self.codes is None:
+            return str(code)
+        return self.codes.marker(code)
+
+    def _register_code(self, marker: str, code: int) -> dict:
+        'register the event code of a marker'
+        if self.codes is None:
+            return {'cmd': 'error', 'error': 'event codes are not enabled'}
+        try:
+            self.codes.register(marker, code)
+        except ValueError as e:
+            return {'cmd': 'error', 'error': str(e)}
+        return {'cmd': 'register', 'marker': marker, 'code': code}
+
+    def _expand(self, msg: dict, conn: _Connection) -> str:
+        'the marker of a template announced before, or an empty marker'
+        template = None if conn is None else \
+            conn.templates.get(msg['template'], None)
+        if template is None:
+            print(f"Received unknown template {msg['template']}")
+            return ''
+        parts, as_json, sanitize = template
+        try:
+            return expand(parts, msg.get('values', []), as_json, sanitize)
+        except (TypeError, ValueError) as e:
+            print(f"Received invalid values for template {msg['template']}: "
+                  f"{e}")
+            return ''
+
+    def _resume_session(self, client: str, conn: _Connection) -> dict:
+        'attach the connection to the session of a client'
+        if conn is None or conn not in self.connections or \
+                not isinstance(client, str):
+            return {'cmd': 'error', 'error': 'can not resume a session'}
+        session = self.sessions.get(client, None)
+        if session is None:
+            session = self.sessions[client] = _Session(client)
+        session.conn, session.closed = conn, None
+        conn.session = session
+        return {'cmd': 'resume', 'received': session.received,
+                'acked': session.acked}
+
+    def _reject(self, session: _Session, seq: int):
+        'acknowledge a rejected message, as retransmitting it would not help'
+        if session is not None and seq is not None:
+            self._expect(session, None, seq)
+        return None
+
+    def _expect(self, session: _Session, queue, seq: int):
+        'acknowledge seq once the queue processed the markers enqueued last'
+        session.received = seq
+        ticket = 0  # without a queue, seq only waits for the previous ones
+        if queue is not None:
+            queue.wanted = max(queue.wanted, queue.tickets)  # before checking
+            ticket = queue.tickets
+        session.outstanding.append((queue, ticket, seq))
+        self.unacked.add(session)
+
+    def _acknowledge(self):
+        'send cumulative acknowledgements for all markers pushed meanwhile'
+        for session in list(self.unacked):
+            acked = session.acked
+            while session.outstanding:
+                queue, ticket, seq = session.outstanding[0]
+                if queue is not None and queue.processed < ticket:
+                    break
+                session.outstanding.popleft()
+                acked = seq
+            if not session.outstanding:
+                self.unacked.discard(session)
+            if acked == session.acked:
+                continue
+            session.acked = acked
+            conn = session.conn
+            if conn is not None and conn in self.connections:
+                conn.outbox += encode({'cmd': 'ack', 'seq': acked})
+                self._write(conn)
+
+    def _expire(self):
+        'forget the sessions whose clients did not resume them in time'
+        now = pylsl.local_clock()
+        for client, session in list(self.sessions.items()):
+            if session.closed is not None and \
+                    now - session.closed > self.session_timeout:
+                del self.sessions[client]
+                self.unacked.discard(session)
+
+    def _set_clock(self, msg: dict, conn: _Connection):
+        'map further timestamps of the connection with the estimate of a client'
+        if conn is None or conn not in self.connections:
+            print('Ignoring clock estimate without connection')
+            return None  # clients do not wait for a reply
+        try:
+            conn.clock = {k: float(msg[k]) for k in
+                          ('offset', 'drift', 'tref', 'rtt', 'residual')}
+        except (KeyError, TypeError, ValueError) as e:
+            print(f'Invalid clock estimate from {conn.address}: {e}')
+            return None
+        if self.verbose:
+            print(f"Mapping clock of {conn.address} with offset "
+                  f"{conn.clock['offset']:.6f}s and residual "
+                  f"{conn.clock['residual'] * 1e6:.0f}µs")
+        return None
+
+    def _recover(self, journal: Journal):
+        'push the markers left unacknowledged in the journal to their outlets'
+        pending = dict()
+        for seq, marker, tstamp, stream in journal.pending():
+            pending.setdefault(stream or None, []).append(
+                (seq, marker, tstamp))
+        for stream, markers in pending.items():
+            streamer = self.streamer(stream)
+            if streamer is not None:
+                streamer.recover(markers)
+
+    def _attach(self, name: str, conn: _Connection) -> dict:
+        'attach the shared-memory ring of a client'
+        if self.doorbell is None or conn is None or conn not in \
+                self.connections:
+            return {'cmd': 'error', 'error': 'shm transport is not enabled'}
+        try:
+            conn.ring = Ring.attach(name)
+        except (OSError, ValueError, RuntimeError) as e:
+            return {'cmd': 'error', 'error': str(e)}
+        self.rings[conn] = conn.ring
+        conn.frames = 0
+        conn.ring.waiting = True
+        return {'cmd': 'attached', 'doorbell': self.doorbell.getsockname()[1]}
+
+    def _drain(self, conn: _Connection, force: bool = False):
+        """forward the markers written into the ring of a connection before
+        the frames handled so far to the MarkerStreamer
+
+        raises
+        ------
+        queue.Full
+            if the markers have to wait until the queue drained. They are
+            held back, and forwarded first by the next call.
+        """
+        ring = conn.ring
+        ring.waiting = False
+        markers = ring.read(conn.frames)
+        ring.waiting = True
+        markers += ring.read(conn.frames)  # written before we were waiting
+        markers, conn.held = conn.held + markers, []
+        if not markers:
+            return
+        try:
+            self._account(conn, self.markerstreamer.push_many(markers, force))
+        except Full:
+            conn.held = markers
+            raise
+
+    def _handle_frame(self, msg: dict, conn: _Connection,
+                      force: bool = False) -> dict:
+        'handle a message received from a connection, see handle'
+        ring = conn.ring
+        if ring is not None:  # forward the markers written before the frame
+            self._drain(conn, force)
+        try:
+            reply = self.handle(msg, conn, force)
+        except Full:
+            raise
+        except Exception as e:  # one message must not stop the server
+            print(f'Dropping message from {conn.address}: {e!r}')
+            reply = None
+        if ring is not None:
+            conn.frames += 1
+        return reply
+
+    def _ring_doorbell(self):
+        'consume all pending doorbells and drain the rings'
+        while True:
+            try:
+                self.doorbell.recv(64)
+            except (BlockingIOError, OSError):
+                break
+        for conn in list(self.rings):
+            if conn in self.paused:
+                continue  # the markers wait in the ring
+            try:
+                self._drain(conn)
+            except Full as e:
+                self._pause(conn, [], *e.args)
+            if conn.outbox:
+                self._write(conn)
+
+    def _listen(self, transport: str):
+        'create a non-blocking socket listening on the transport'
+        if transport == 'shm':  # the doorbell of all rings
+            listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            listener.bind(('127.0.0.1', 0))
+            self.doorbell = listener
+        elif transport == 'unix':
+            path = unix_path(self.port)
+            if os.path.exists(path):  # left over by a crashed server
+                os.unlink(path)
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(path)
+        elif transport == 'udp':
+            listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            listener.bind((self.host, self.port))
+        else:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((self.host, self.port))
+        if transport not in ('udp', 'shm'):
+            listener.listen(socket.SOMAXCONN)
+        listener.setblocking(False)
+        return listener
+
+    def _receive_datagrams(self, listener):
+        'handle all pending datagrams, each carrying exactly one frame'
+        while True:
+            try:
+                data, address = listener.recvfrom(65536)
+            except (BlockingIOError, socket.timeout):
+                return
+            except OSError as e:
+                print(f'Receiving datagram failed: {e}')
+                return
+            conn = _Connection(listener, address)
+            try:
+                msgs = Reader().feed(data)
+            except ProtocolError as e:
+                print(f'Datagram from {address} failed: {e}')
+                continue
+            for msg in msgs:
+                try:
+                    reply = self.handle(msg, conn)
+                except Full:  # datagrams can not wait
+                    self.dropped_datagrams += 1
+                    continue
+                except Exception as e:
+                    print(f'Dropping datagram from {address}: {e!r}')
+                    continue
+                if reply is not None:
+                    try:
+                        listener.sendto(encode(reply), address)
+                    except OSError:
+                        pass  # fire-and-forget
+
+    def _accept(self, listener):
+        'accept all pending connections'
+        while True:
+            try:
+                sock, address = listener.accept()
+            except (BlockingIOError, socket.timeout):
+                return
+            sock.setblocking(False)
+            if sock.family != getattr(socket, 'AF_UNIX', None):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _Connection(sock, address)
+            self.connections.add(conn)
+            self._register(conn)
+
+    def _read(self, conn: _Connection):
+        'receive from a readable connection and handle complete messages'
+        try:
+            data = conn.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            print(f'Connection with {conn.address} failed: {e}')
+            data = b''
+        if not data:  # client closed the connection
+            self._close(conn)
+            return
+        try:
+            msgs = conn.reader.feed(data)
+        except ProtocolError as e:
+            print(f'Connection with {conn.address} failed: {e}')
+            self._close(conn)
+            return
+        if conn in self.paused:  # e.g. a message pending from the ring
+            self._pause(conn, msgs, None)
+            msgs = []
+        for i, msg in enumerate(msgs):
+            try:
+                reply = self._handle_frame(msg, conn)
+            except Full as e:
+                self._pause(conn, msgs[i:], *e.args)
+                break
+            if reply is not None:
+                conn.outbox += encode(reply)
+        else:
+            if conn.ring is not None:  # written after the last frame
+                try:
+                    self._drain(conn)
+                except Full as e:
+                    self._pause(conn, [], *e.args)
+        self._notify(conn)
+        if conn.outbox:
+            self._write(conn)
+
+    def _write(self, conn: _Connection):
+        'send as much of the outbox as the socket accepts without blocking'
+        try:
+            sent = conn.sock.send(conn.outbox)
+        except BlockingIOError:
+            sent = 0
+        except OSError as e:
+            print(f'Connection with {conn.address} failed: {e}')
+            self._close(conn)
+            return
+        del conn.outbox[:sent]
+        self._register(conn)
+
+    def _register(self, conn: _Connection):
+        'select a connection for reading unless paused, and for pending replies'
+        events = 0 if conn in self.paused else selectors.EVENT_READ
+        if conn.outbox:
+            events |= selectors.EVENT_WRITE
+        if not events:
+            if conn.registered:
+                self.selector.unregister(conn.sock)
+        elif conn.registered:
+            self.selector.modify(conn.sock, events, conn)
+        else:
+            self.selector.register(conn.sock, events, conn)
+        conn.registered = bool(events)
+
+    def _close(self, conn: _Connection):
+        'unregister and close a connection, pushing all markers held back'
+        if conn in self.connections:
+            self.connections.discard(conn)
+            self.paused.discard(conn)
+            if conn.registered:
+                self.selector.unregister(conn.sock)
+            for msg in conn.pending:
+                self._handle_frame(msg, conn, force=True)
+            conn.pending.clear()
+            if self.rings.pop(conn, None) is not None:
+                conn.frames = None  # also the markers after the last frame
+                self._drain(conn, force=True)
+            if conn.session is not None and conn.session.conn is conn:
+                conn.session.closed = pylsl.local_clock()
+            conn.close()
 
     def run(self):
         """wait for clients to connect and send messages.
@@ -145,10 +1021,12 @@ class Server(threading.Thread):
 
         # we check whether there is already an instance running, and if so
         # let it keep control by returning
-        if available(self.port):
+        probe = [t for t in self.transports if t != 'shm'][0]
+        if available(self.port, transport=probe):
             self.singleton.clear()
             if self.verbose:
                 print("Server already running on that port")
+            self._close_wakeup()
             self.is_running.set()
             return
         else:
@@ -156,39 +1034,77 @@ class Server(threading.Thread):
             if self.verbose:
                 print("This server is the original instance")
 
+        journal = None if self.journal is None else Journal(self.journal)
         # create the MarkerStreamer, i.e. the LSL-Server that distributes the strings received from the Listener
-        markerstreamer = _MarkerStreamer(name=self.name)
-        markerstreamer.start()
+        self.markerstreamer = self._start_streamer(name=self.name,
+                                                   stats=self.stats,
+                                                   journal=journal)
+        self.markerstreamer.is_running.wait()  # i.e. the outlet is up
+        self.streamers[self.name] = self.markerstreamer
+        if journal is not None:
+            self._recover(journal)
         # create the ListenerServer, i.e. the TCP/IP Server that waits for messages for forwarding them to the MarkerStreamer
-        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listener.settimeout(1)
-        listener.bind((self.host, self.port))
-        listener.listen(1)
+        self.selector = selectors.DefaultSelector()
+        listeners = dict()
+        for transport in self.transports:
+            listener = self._listen(transport)
+            listeners[listener] = transport
+            self.selector.register(listener, selectors.EVENT_READ, listener)
+        self._wakeup.setblocking(False)
+        self._waker.setblocking(False)
+        self.selector.register(self._wakeup, selectors.EVENT_READ,
+                               self._wakeup)
         if self.verbose:
-            print('Server mediating an LSL Outlet opened at {0}:{1}'.format(
-                self.host, self.port))
+            print('Server mediating an LSL Outlet opened at {0}:{1} ({2})'
+                  .format(self.host, self.port, ', '.join(self.transports)))
         self.is_running.set()
         while self.is_running.is_set():
-            try:
-                client, address = listener.accept()
-                try:
-                    marker, tstamp = _read_msg(client)
-                    if marker.lower() == "ping":  # connection was only pinged
-                        print("Received ping from", address)
-                    elif marker.lower() == "poison-pill":
-                        print("Swallowing poison pill")
-                        self.is_running.clear()
-                        break
+            if journal is None or journal.idle:
+                timeout = 1
+            else:  # wake up to sync the journal only while it changes
+                timeout = journal.sync_interval
+            ready = self.selector.select(timeout=timeout)
+            if not ready and self.rings:  # safety net for a lost doorbell
+                self._ring_doorbell()
+            if journal is not None:
+                journal.sync()
+            if self.paused:
+                self._resume()
+            for key, events in ready:
+                if key.data in listeners:
+                    if listeners[key.data] == 'shm':
+                        self._ring_doorbell()
+                    elif listeners[key.data] == 'udp':
+                        self._receive_datagrams(key.data)
                     else:
-                        markerstreamer.push(marker, tstamp)
-                except socket.timeout:
-                    print('Client from {address} timed out')
-                finally:
-                    client.shutdown(2)
-                    client.close()
-            except socket.timeout:
-                pass
+                        self._accept(key.data)
+                elif key.data is self._wakeup:
+                    try:
+                        self._wakeup.recv(4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    conn = key.data
+                    if events & selectors.EVENT_WRITE:
+                        self._write(conn)
+                    if events & selectors.EVENT_READ and \
+                            conn in self.connections:
+                        self._read(conn)
+            if self.unacked:  # after reading, not to miss a pushed marker
+                self._acknowledge()
+            if self.sessions:
+                self._expire()
 
         print(f"Shutting down MarkerServer: {self.name}")
-        markerstreamer.stop()
+        for conn in list(self.connections):
+            self._close(conn)
+        self.selector.close()
+        for listener, transport in listeners.items():
+            listener.close()
+            if transport == 'unix':
+                os.unlink(unix_path(self.port))
+        for streamer in self.streamers.values():
+            streamer.stop()
+        self._close_wakeup()
+        if journal is not None:
+            journal.close()
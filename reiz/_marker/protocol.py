@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+Wire protocol
+-------------
+
+Clients and the MarkerServer exchange messages as frames. Each frame starts
+with a four-byte big-endian header carrying the length of the payload,
+followed by the payload as utf-8 encoded json. Framing allows to send many
+messages over one long-lived connection.
+
+Every message is a dictionary with at least the key `cmd`, e.g.
+
+.. code-block:: python
+
+    {"cmd": "push", "marker": "hello", "tstamp": 1234.5}
+    {"cmd": "batch", "markers": [["trial_1", 1234.5], ["left", 1234.5]]}
+    {"cmd": "ping"}
+    {"cmd": "health"}
+    {"cmd": "stats"}
+    {"cmd": "attach", "ring": "psm_1a2b3c"}
+    {"cmd": "time", "t0": 1234.5}
+    {"cmd": "resume", "client": "5f0c8e1d"}
+    {"cmd": "template", "id": 0, "parts": ["trial_", "_onset"], "json": False,
+     "sanitize": True}
+    {"cmd": "register", "marker": "trial_onset", "code": 1}
+    {"cmd": "code", "code": 1, "tstamp": 1234.5}
+    {"cmd": "kill"}
+
+Markers are pushed to the default outlet of the MarkerServer, unless `push`
+or `batch` name another outlet with the key `stream`, e.g.
+
+.. code-block:: python
+
+    {"cmd": "push", "marker": "correct", "tstamp": 1234.5, "stream": "feedback"}
+
+Likewise, `push`, `batch` and `code` may name their priority class with the
+key `priority`, one of `critical`, `normal` and `bulk`, see
+:mod:`~reiz._marker.bounded`.
+
+Clients delivering reliably identify themselves after connecting with
+`resume`, and number their `push` and `batch` messages with the key `seq`.
+The MarkerServer replies with the highest sequence number it received and
+the highest it acknowledged, e.g. `{"cmd": "resume", "received": 41,
+"acked": 38}`, so that the client can retransmit the messages which were
+lost. It ignores messages with a sequence number it already received, and
+sends cumulative acknowledgements once all markers up to a sequence number
+were pushed to their outlet, e.g. `{"cmd": "ack", "seq": 41}`. Messages
+which are rejected, e.g. for an invalid outlet name, are acknowledged all
+the same, as retransmitting them would not help. The MarkerServer forgets a
+session if the client did not resume it within a minute after its
+connection closed, and the client starts a new session then.
+
+Frames of the most frequent messages can be encoded in a compact binary
+format instead, which saves encoding and parsing json and transmits
+timestamps as float64. Binary frames set the highest bit of the header, and
+their payload starts with a type byte
+
+.. code-block:: none
+
+    push:  0x01, uint8 n, n bytes stream, float64 tstamp, utf-8 marker
+    batch: 0x02, uint8 n, n bytes stream, uint32 count,
+           count times (float64 tstamp, uint32 length, utf-8 marker)
+    ping:  0x03
+    kill:  0x04
+    push of a template:
+           0x05, uint8 n, n bytes stream, float64 tstamp, uint32 id,
+           utf-8 json list of values
+    code:  0x06, uint8 n, n bytes stream, float64 tstamp, int32 code
+
+All numbers are big-endian, an empty stream denotes the default outlet,
+and a tstamp of NaN is replaced by the time of arrival. Numbered messages
+set the highest bit of the type byte, and carry the sequence number as
+uint64 right after the stream. Messages with a priority class set the
+second-highest bit, and carry the index of the class as uint8 after the
+stream and the sequence number. Clients offer the
+binary format with `{"cmd": "hello", "formats": ["binary", "json"]}` after
+connecting, and the MarkerServer replies with the format to use, e.g.
+`{"cmd": "hello", "format": "binary"}`. Start it with `reiz-marker --format
+json` to make all clients fall back to json, e.g. for debugging. Replies
+and all other messages are always json.
+
+The same frames travel over every transport: `tcp` on host and port, `unix`
+as a unix domain socket whose path is derived from the port, and `udp` as
+one frame per datagram. Connectionless `udp` suits fire-and-forget markers,
+but frames are limited to the size of a single datagram. With `shm`, clients
+connect over `tcp`, but write markers into a shared-memory ring, see
+:mod:`~reiz._marker.ring`.
+
+Legacy clients send a single unframed json list `[marker, tstamp]` and close
+the connection afterwards. The :class:`~.Reader` detects them by the leading
+`[`, which can not start a valid header, and translates their message.
+
+Functions
+.........
+"""
+import json
+import os
+import struct
+import tempfile
+from typing import List
+from reiz._marker.bounded import PRIORITIES
+
+HEADER = struct.Struct(">I")  #: length of the payload in bytes
+MAX_FRAME = 2 ** 24  #: payloads larger than 16MiB are considered corrupt
+BINARY = 0x80000000  #: set in the header of binary frames
+FORMATS = ("binary", "json")  #: all supported formats, preferred first
+PUSH, BATCH, PING, KILL, TEMPLATE, CODE = 1, 2, 3, 4, 5, 6  #: binary types
+SEQUENCED = 0x80  #: set in the type byte of numbered messages
+PRIORITIZED = 0x40  #: set in the type byte of messages with a priority class
+TYPES = {"push": PUSH, "batch": BATCH, "ping": PING, "kill": KILL,
+         "code": CODE}
+TSTAMP = struct.Struct(">d")
+COUNT = struct.Struct(">I")
+ITEM = struct.Struct(">dI")  #: timestamp and length of a marker in a batch
+FILL = struct.Struct(">dI")  #: timestamp and id of a template
+CODED = struct.Struct(">di")  #: timestamp and event code
+SEQ = struct.Struct(">Q")
+NAN = float("nan")  #: encodes a missing timestamp
+LEGACY = b"["  #: the first byte sent by legacy clients
+TRANSPORTS = ("tcp", "unix", "udp", "shm")  #: all supported transports
+_encode_values = json.JSONEncoder(separators=(",", ":")).encode
+
+
+class ProtocolError(ValueError):
+    "raised when a frame can not be parsed"
+    pass
+
+
+def unix_path(port: int) -> str:
+    "the path of the unix domain socket of the MarkerServer at port"
+    return os.path.join(tempfile.gettempdir(), f"reiz-marker-{port}.sock")
+
+
+def encode(msg: dict, binary: bool = False) -> bytes:
+    """encode a message into a frame
+
+    args
+    ----
+    msg: dict
+        a json-encodable dictionary with at least the key `cmd`
+    binary: bool
+        whether to use the binary format for push, batch, code, ping and
+        kill
+
+    returns
+    -------
+    frame: bytes
+        the header followed by the payload
+    """
+    if binary and msg["cmd"] in TYPES:
+        payload = _pack(msg)
+        return HEADER.pack(len(payload) | BINARY) + payload
+    payload = json.dumps(msg).encode("utf-8")
+    return HEADER.pack(len(payload)) + payload
+
+
+def _pack(msg: dict) -> bytes:
+    "encode a message as binary payload"
+    kind = TYPES[msg["cmd"]]
+    if kind == PUSH and "template" in msg:
+        kind = TEMPLATE
+    if kind in (PING, KILL):
+        return bytes((kind,))
+    stream = (msg.get("stream", None) or "").encode("utf-8")
+    if len(stream) > 255:
+        raise ProtocolError(f"Stream name {msg['stream']} is too long")
+    flags, tail = 0, b""
+    seq = msg.get("seq", None)
+    if seq is not None:
+        flags |= SEQUENCED
+        tail += SEQ.pack(seq)
+    priority = msg.get("priority", None)
+    if priority is not None:
+        if priority not in PRIORITIES:
+            raise ProtocolError(f"Unknown priority {priority}")
+        flags |= PRIORITIZED
+        tail += bytes((PRIORITIES.index(priority),))
+    head = bytes((kind | flags, len(stream))) + stream + tail
+    if kind == TEMPLATE:
+        tstamp = msg.get("tstamp", None)
+        return (head + FILL.pack(NAN if tstamp is None else tstamp,
+                                 msg["template"])
+                + _encode_values(msg["values"]).encode("utf-8"))
+    if kind == CODE:
+        tstamp = msg.get("tstamp", None)
+        return head + CODED.pack(NAN if tstamp is None else tstamp, msg["code"])
+    if kind == PUSH:
+        tstamp = msg.get("tstamp", None)
+        return (head + TSTAMP.pack(NAN if tstamp is None else tstamp)
+                + msg.get("marker", "").encode("utf-8"))
+    parts = [head, COUNT.pack(len(msg["markers"]))]
+    for marker, tstamp in msg["markers"]:
+        marker = marker.encode("utf-8")
+        parts.append(ITEM.pack(NAN if tstamp is None else tstamp, len(marker)))
+        parts.append(marker)
+    return b"".join(parts)
+
+
+def _unpack(payload: bytes) -> dict:
+    "decode a binary payload into a message"
+    try:
+        kind = payload[0]
+        if kind == PING:
+            return {"cmd": "ping"}
+        if kind == KILL:
+            return {"cmd": "kill"}
+        start = 2 + payload[1]
+        stream = payload[2:start].decode("utf-8") if start > 2 else None
+        if kind & SEQUENCED:
+            (seq,) = SEQ.unpack_from(payload, start)
+            msg = _unpack(bytes((kind & ~SEQUENCED,)) + payload[1:start]
+                          + payload[start + SEQ.size:])
+            msg["seq"] = seq
+            return msg
+        if kind & PRIORITIZED:
+            msg = _unpack(bytes((kind & ~PRIORITIZED,)) + payload[1:start]
+                          + payload[start + 1:])
+            msg["priority"] = PRIORITIES[payload[start]]
+            return msg
+        if kind == PUSH:
+            (tstamp,) = TSTAMP.unpack_from(payload, start)
+            return {
+                "cmd": "push",
+                "marker": payload[start + TSTAMP.size:].decode("utf-8"),
+                "tstamp": None if tstamp != tstamp else tstamp,
+                "stream": stream,
+            }
+        if kind == CODE:
+            tstamp, code = CODED.unpack_from(payload, start)
+            return {
+                "cmd": "code",
+                "code": code,
+                "tstamp": None if tstamp != tstamp else tstamp,
+                "stream": stream,
+            }
+        if kind == TEMPLATE:
+            tstamp, id = FILL.unpack_from(payload, start)
+            return {
+                "cmd": "push",
+                "template": id,
+                "values": json.loads(payload[start + FILL.size:]),
+                "tstamp": None if tstamp != tstamp else tstamp,
+                "stream": stream,
+            }
+        if kind == BATCH:
+            (count,) = COUNT.unpack_from(payload, start)
+            pos = start + COUNT.size
+            markers = []
+            for i in range(count):
+                tstamp, length = ITEM.unpack_from(payload, pos)
+                pos += ITEM.size
+                marker = payload[pos:pos + length].decode("utf-8")
+                pos += length
+                markers.append((marker, None if tstamp != tstamp else tstamp))
+            return {"cmd": "batch", "markers": markers, "stream": stream}
+    except (IndexError, struct.error, UnicodeDecodeError,
+            json.decoder.JSONDecodeError) as e:
+        raise ProtocolError(f"Malformed binary payload: {e}")
+    raise ProtocolError(f"Unknown binary message type {kind}")
+
+
+def decode(payload: bytes, binary: bool = False) -> dict:
+    "decode the payload of a frame into a message"
+    if binary:
+        return _unpack(payload)
+    try:
+        msg = json.loads(payload.decode("utf-8"))
+    except (UnicodeDecodeError, json.decoder.JSONDecodeError) as e:
+        raise ProtocolError(f"Malformed payload: {e}")
+    if not isinstance(msg, dict) or "cmd" not in msg:
+        raise ProtocolError(f"Message without cmd: {msg}")
+    return msg
+
+
+def _from_legacy(marker: str, tstamp: float) -> dict:
+    "translate the (marker, tstamp) tuple of a legacy client into a message"
+    if not isinstance(marker, str):
+        raise ProtocolError(f"Malformed legacy message: {marker!r}")
+    if marker.lower() == "ping":
+        return {"cmd": "ping"}
+    if marker.lower() == "poison-pill":
+        return {"cmd": "kill"}
+    return {"cmd": "push", "marker": marker, "tstamp": tstamp}
+
+
+class Reader:
+    """incrementally parse frames from a stream of bytes
+
+    Feed it whatever `recv` returned. Partial frames are buffered until they
+    are complete, and each payload is parsed exactly once, no matter how
+    many reads it took to arrive or how many frames arrived with one read.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.legacy = False
+
+    def feed(self, data: bytes) -> List[dict]:
+        """add received bytes and return all messages completed by them
+
+        args
+        ----
+        data: bytes
+            the bytes as received from the socket
+
+        returns
+        -------
+        msgs: List[dict]
+            the messages completed by data, in the order they were sent
+        """
+        buf = self.buffer
+        if not buf and not self.legacy and data[:1] == LEGACY:
+            self.legacy = True
+        buf += data
+        if self.legacy:
+            return self._feed_legacy()
+        msgs = []
+        pos = 0
+        while len(buf) - pos >= HEADER.size:
+            (length,) = HEADER.unpack_from(buf, pos)
+            binary = length & BINARY
+            length &= ~BINARY
+            if length > MAX_FRAME:
+                raise ProtocolError(
+                    f"Frame of {length} bytes exceeds {MAX_FRAME}")
+            end = pos + HEADER.size + length
+            if len(buf) < end:
+                break
+            msgs.append(decode(buf[pos + HEADER.size:end], binary))
+            pos = end
+        del buf[:pos]
+        return msgs
+
+    def _feed_legacy(self) -> List[dict]:
+        "parse the unframed json of a legacy client once it looks complete"
+        if not self.buffer.rstrip().endswith(b"]"):
+            return []
+        try:
+            marker, tstamp = json.loads(self.buffer.decode("ascii"))
+        except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+            return []  # a closing bracket inside the marker, wait for more
+        except (TypeError, ValueError) as e:
+            raise ProtocolError(f"Malformed legacy message: {e}")
+        self.buffer.clear()
+        self.legacy = False
+        return [_from_legacy(marker, tstamp)]
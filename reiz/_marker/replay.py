@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Replay of recorded marker sessions
+----------------------------------
+
+Replays a recorded marker session through an LSL outlet, keeping the
+original relative timing, or accelerating it by a constant rate. Use it to
+load-test a recording pipeline, or to check analysis scripts against a
+known session.
+
+Run from terminal with
+
+.. code-block:: bash
+
+    reiz-marker --replay session.journal --rate 2 --name reiz-replay
+
+The session is read from a journal written with `reiz-marker --journal`, or
+from a file exported as
+
+- `.csv` with the columns `marker` and `tstamp`
+- `.json` with a list of `[marker, tstamp]` or of dictionaries with the
+  keys `marker` and `tstamp`
+- `.jsonl` with one `[marker, tstamp]` per line, e.g. the spool of
+  :func:`~reiz._marker.sender.configure_sender`
+
+A journal only keeps the markers since it was last compacted, see
+:mod:`~reiz._marker.journal`, so replay long sessions from an export.
+
+Each marker is scheduled relative to the start of the replay. The replay
+sleeps until shortly before the marker is due, and spins on
+:func:`pylsl.local_clock` for the remainder, so that the scheduler of the
+operating system adds no jitter. The timing error of each marker, i.e. how
+late it was pushed, is reported.
+
+Functions
+.........
+"""
+import csv
+import json
+import os
+import time
+from typing import List, Tuple
+from pylsl import local_clock
+from reiz._marker.journal import MAGIC, read_journal
+
+
+def load(path: str) -> List[Tuple[str, float]]:
+    """load a recorded marker session
+
+    args
+    ----
+    path: str
+        path to a journal, or to a `.csv`, `.json` or `.jsonl` file
+
+    returns
+    -------
+    markers: List[Tuple[str, float]]
+        the markers and their timestamps, sorted by timestamp
+    """
+    with open(path, "rb") as f:
+        is_journal = f.read(len(MAGIC)) == MAGIC
+    ext = os.path.splitext(path)[1].lower()
+    if is_journal:
+        markers = [(m, t) for seq, m, t, acked, s in read_journal(path)]
+    elif ext == ".csv":
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            markers = [(r["marker"], r["tstamp"]) for r in csv.DictReader(f)]
+    elif ext == ".json":
+        with open(path, "r", encoding="utf-8") as f:
+            markers = [
+                (e["marker"], e["tstamp"]) if isinstance(e, dict) else tuple(e)
+                for e in json.load(f)
+            ]
+    elif ext == ".jsonl":
+        with open(path, "r", encoding="utf-8") as f:
+            markers = [tuple(json.loads(line)) for line in f if line.strip()]
+    else:
+        raise ValueError(f"Can not replay {path}, use a journal, csv or json")
+    markers = [(str(m), float(t)) for m, t in markers]
+    return sorted(markers, key=lambda marker: marker[1])
+
+
+def wait_until(deadline: float, spin: float = 0.002) -> float:
+    """wait until the deadline according to :func:`pylsl.local_clock`
+
+    args
+    ----
+    deadline: float
+        the time to wait for
+    spin: float
+        sleep until spin seconds before the deadline, and busy-wait for the
+        remainder
+
+    returns
+    -------
+    now: float
+        the time when the wait ended
+    """
+    while True:
+        now = local_clock()
+        remaining = deadline - now
+        if remaining <= 0:
+            return now
+        if remaining > spin:
+            time.sleep(remaining - spin)
+
+
+def replay(
+    markers: List[Tuple[str, float]],
+    rate: float = 1.0,
+    name: str = "reiz-replay",
+    lead: float = 0.5,
+    verbose: bool = True,
+) -> List[float]:
+    """push markers through an outlet at their original relative timing
+
+    args
+    ----
+    markers: List[Tuple[str, float]]
+        the markers and their timestamps, sorted by timestamp, see
+        :func:`~.load`
+    rate: float
+        how much faster than the original to replay, e.g. 2 for twice as
+        fast
+    name: str
+        the name of the outlet
+    lead: float
+        seconds between opening the outlet and pushing the first marker
+    verbose: bool
+        whether to print every marker and its timing error
+
+    returns
+    -------
+    errors: List[float]
+        for each marker, how many seconds it was pushed after it was due
+    """
+    from reiz._marker.mitm import _Outlet
+
+    if rate <= 0:
+        raise ValueError("The rate has to be positive")
+    outlet = _Outlet.get(name=name)
+    errors = []
+    if not markers:
+        return errors
+    first = markers[0][1]
+    start = local_clock() + lead
+    for marker, tstamp in markers:
+        deadline = start + (tstamp - first) / rate
+        now = wait_until(deadline)
+        outlet.push_sample([marker], now)
+        errors.append(now - deadline)
+        if verbose:
+            print(f"Replayed {marker} at {now} ({errors[-1] * 1e6:.1f}µs late)")
+    return errors
+
+
+def summarize(errors: List[float]) -> dict:
+    "the mean, median, 99th percentile and maximum of the timing errors"
+    if not errors:
+        return {"count": 0, "mean": None, "p50": None, "p99": None, "max": None}
+    ordered = sorted(errors)
+    n = len(ordered) - 1
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": ordered[n // 2],
+        "p99": ordered[n * 99 // 100],
+        "max": ordered[n],
+    }
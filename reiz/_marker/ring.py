@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Shared-memory ring buffer
+-------------------------
+
+For markers pushed on the same machine, the `shm` transport avoids sockets
+for the payload. Each client process creates its own ring in shared memory
+and attaches it to the MarkerServer over its regular connection. The client
+is the only writer, and the MarkerServer the only reader, so the ring needs
+no lock between the processes.
+
+The ring starts with a header, followed by fixed-size slots
+
+.. code-block:: none
+
+    header: magic, slots, slot size, head, tail, overflows, waiting
+    slot:   float64 timestamp, uint64 frames, uint32 length, utf-8 payload
+
+The writer advances `head`, the reader advances `tail`. Before the reader
+goes to sleep, it sets `waiting`. The writer clears it and rings a doorbell,
+i.e. sends a tiny datagram to the MarkerServer. Until the reader drained the
+ring and set `waiting` again, writing a marker costs no system call, except
+that the client checks whether its connection is still open at most every
+250ms. Markers written after the MarkerServer quit and before that check
+noticed it are lost, like those sent over tcp before the connection reset.
+If the ring is full or a marker does not fit into a slot, the writer counts
+an overflow and the client falls back to sending the marker over its
+connection.
+
+Markers written into the ring and messages sent over the connection are
+kept in order. Each slot records how many frames the client had sent over
+its connection since attaching the ring, and the reader forwards a slot only
+once it handled as many frames.
+
+Requires Python 3.8 or later for :mod:`multiprocessing.shared_memory`.
+
+Classes
+.......
+"""
+import struct
+from typing import List, Tuple
+
+MAGIC = b"REIZ"
+HEADER = struct.Struct("<4sII")  #: magic, slots, slot size
+HEADER_SIZE = 64
+COUNTER = struct.Struct("<Q")
+HEAD, TAIL, OVERFLOWS, WAITING = 16, 24, 32, 40  #: offsets in the header
+SLOT = struct.Struct("<dQI")  #: timestamp, frames sent before, length
+
+
+def _shared_memory():
+    "import shared_memory only when a ring is used, it slows down the startup"
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:  # pragma no cover
+        raise RuntimeError("The shm transport requires Python 3.8")
+    return shared_memory
+
+
+def _untrack(shm):
+    "stop the resource tracker from unlinking memory owned by another process"
+    try:
+        from multiprocessing import resource_tracker
+
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except (ImportError, AttributeError, KeyError):  # pragma no cover
+        pass
+
+
+class Ring:
+    """a single-producer single-consumer ring of markers in shared memory
+
+    Create it in the client with :meth:`~.create`, and attach to it in the
+    MarkerServer with :meth:`~.attach`.
+    """
+
+    _created = set()  #: names of the rings created by this process
+
+    def __init__(self, shm, owner: bool = False):
+        self.shm = shm
+        self.owner = owner
+        magic, self.slots, self.slot_size = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{shm.name} is not a marker ring")
+        self.capacity = self.slot_size - SLOT.size
+
+    @classmethod
+    def create(cls, slots: int = 4096, slot_size: int = 256):
+        "create a new ring, owned and eventually unlinked by this process"
+        shm = _shared_memory().SharedMemory(
+            create=True, size=HEADER_SIZE + slots * slot_size
+        )
+        shm.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        HEADER.pack_into(shm.buf, 0, MAGIC, slots, slot_size)
+        cls._created.add(shm.name)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name: str):
+        "attach to a ring created by another process"
+        shm = _shared_memory().SharedMemory(name=name)
+        if name not in cls._created:
+            _untrack(shm)
+        return cls(shm, owner=False)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def _get(self, offset: int) -> int:
+        return COUNTER.unpack_from(self.shm.buf, offset)[0]
+
+    def _set(self, offset: int, value: int):
+        COUNTER.pack_into(self.shm.buf, offset, value)
+
+    @property
+    def overflows(self) -> int:
+        "how many markers did not fit into the ring"
+        return self._get(OVERFLOWS)
+
+    @property
+    def waiting(self) -> bool:
+        "whether the reader sleeps and has to be woken up"
+        return self.shm.buf[WAITING] == 1
+
+    @waiting.setter
+    def waiting(self, value: bool):
+        self.shm.buf[WAITING] = 1 if value else 0
+
+    def write(self, payload: bytes, tstamp: float, frames: int = 0) -> bool:
+        """write a marker into the next free slot
+
+        args
+        ----
+        payload: bytes
+            the encoded marker
+        tstamp: float
+            the timestamp of the marker
+        frames: int
+            how many frames the writer sent over its connection before
+
+        returns
+        -------
+        success: bool
+            False if the ring was full or the payload too large for a slot
+        """
+        head = self._get(HEAD)
+        if len(payload) > self.capacity or head - self._get(TAIL) >= self.slots:
+            self._set(OVERFLOWS, self._get(OVERFLOWS) + 1)
+            return False
+        offset = HEADER_SIZE + (head % self.slots) * self.slot_size
+        SLOT.pack_into(self.shm.buf, offset, tstamp, frames, len(payload))
+        start = offset + SLOT.size
+        self.shm.buf[start:start + len(payload)] = payload
+        self._set(HEAD, head + 1)  # publish the slot only after writing it
+        return True
+
+    def read(self, frames: int = None) -> List[Tuple[str, float]]:
+        """read the markers written since the last read
+
+        args
+        ----
+        frames: int
+            stop at the first marker written after more than this many
+            frames, or None to read all markers
+        """
+        head, index = self._get(HEAD), self._get(TAIL)
+        markers = []
+        while index < head:
+            offset = HEADER_SIZE + (index % self.slots) * self.slot_size
+            tstamp, sent, length = SLOT.unpack_from(self.shm.buf, offset)
+            if frames is not None and sent > frames:
+                break
+            start = offset + SLOT.size
+            payload = bytes(self.shm.buf[start:start + length])
+            markers.append((payload.decode("utf-8"), tstamp))
+            index += 1
+        self._set(TAIL, index)
+        return markers
+
+    def close(self):
+        "detach from the ring, and unlink it if this process created it"
+        self.shm.close()
+        if self.owner:
+            self._created.discard(self.shm.name)
+            self.shm.unlink()
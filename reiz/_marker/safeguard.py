@@ -4,23 +4,26 @@ Safeguard your scripts against absence of a MarkerServer
 
 
 """
-from reiz._marker.mitm import Server
-from sys import platform
-from reiz._marker.client import _Client
-from subprocess import Popen, run
+from sys import executable
+from reiz._marker.client import available as _available
+from reiz._marker.client import kill
+from subprocess import Popen, TimeoutExpired
 from time import sleep
-from sys import platform
-from pylsl import local_clock
 from logging import getLogger
+from typing import Tuple
+import select
+import os
 
 logger = getLogger("throw-away-marker-server")
 
 server = None
 
 
-def available(port: int = 7654, verbose=True) -> bool:
+def available(port: int = 7654, verbose=True, max_age: float = 0) -> bool:
     """test whether a markerserver is already available at port
 
+    Sends a health check, which never reaches the recorded stream.
+
     Example
     -------
 
@@ -37,6 +40,9 @@ def available(port: int = 7654, verbose=True) -> bool:
     port: int
         the port number of the markerserver (defaults to 7654)
 
+    max_age: float
+        reuse a positive result if it is at most max_age seconds old
+
     returns
     -------
 
@@ -44,16 +50,41 @@ def available(port: int = 7654, verbose=True) -> bool:
         True if available, False if not
 
     """
-    host: str = "127.0.0.1"
-    c = _Client(host=host, port=port)
+    return _available(port=port, verbose=verbose, max_age=max_age)
+
+
+def _launch(
+    port: int = 7654, name: str = "reiz-marker", timeout: float = 10
+) -> Tuple[Popen, bool]:
+    """start a MarkerServer process and wait until it is ready
+
+    On POSIX, the MarkerServer inherits the writing end of a pipe and
+    signals through it as soon as its outlet and listeners are up.
+
+    returns
+    -------
+    process: Popen
+        the process of the MarkerServer
+    ready: bool
+        whether it signalled that it is ready. False if it could not signal,
+        e.g. on Windows, or if it quit because a MarkerServer was running
+        already
+    """
+    command = [executable, "-m", "reiz._marker", "--name", name,
+               "--port", str(port)]
+    if os.name != "posix":
+        return Popen(command), False
+    read, write = os.pipe()
     try:
-        c.push("None", local_clock())
-        return True
-    except ConnectionRefusedError as e:
-        if verbose:
-            print(e)
-            print(f"Markerserver at {host}:{port} is not available")
-        return False
+        process = Popen(command + ["--notify-fd", str(write)], pass_fds=(write,))
+    finally:
+        os.close(write)
+    try:
+        readable, _, _ = select.select([read], [], [], timeout)
+        status = os.read(read, 64) if readable else b""
+    finally:
+        os.close(read)
+    return process, status.startswith(b"ready")
 
 
 def start():
@@ -72,9 +103,9 @@ def start():
     global server
     if server is None:
         print("Starting a marker-server")
-        server = Popen(["reiz-marker", "--name", "reiz-marker"])
-        while not available(verbose=False):
-            sleep(0.5)
+        server, ready = _launch()
+        while not ready and not available(verbose=False):
+            sleep(0.05)
         return True
     else:
         print("A marker-server is already running")
@@ -91,9 +122,12 @@ def stop():
         print("No marker-server is currently running")
         return True
     else:
-        killer = Popen(["reiz-marker", "--kill", "--name", "reiz-marker"])
-        killer.communicate()
+        try:
+            kill()
+            server.wait(timeout=10)
+        except (OSError, TimeoutExpired):  # not running anymore, or stuck
+            pass
         while available(verbose=False):
-            sleep(0.5)
+            sleep(0.05)
         server = None
         return True
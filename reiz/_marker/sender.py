@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Fire-and-forget marker sender
+-----------------------------
+
+:func:`~.push_nowait` takes the timestamp at the time of the call and hands
+the marker to a background thread, which delivers all markers in order. The
+calling thread, e.g. the one presenting a :class:`~reiz.cue.Cue`, therefore
+never waits for a connection to the MarkerServer.
+
+If the MarkerServer is not available, the thread spools markers and
+retries in regular intervals. The spool is bounded, and drops the oldest
+markers once it is full. Optionally, the spool is mirrored into a file with
+:func:`~.configure_sender`, so that markers survive a crash of the
+experiment and are delivered with the next start. The file is rewritten
+after every delivered batch, and whenever a tenth of its markers were
+dropped, so it neither grows beyond the spool nor holds delivered markers.
+
+Functions
+.........
+"""
+import atexit
+import json
+import os
+import queue
+import threading
+from collections import deque
+from logging import getLogger
+from typing import Tuple
+from sys import platform
+import pylsl
+from reiz._marker.client import _Client, sanitize_string
+
+log = getLogger()
+
+_Queue = getattr(queue, "SimpleQueue", queue.Queue)  # SimpleQueue since 3.7
+
+
+class _Sender(threading.Thread):
+    """delivers queued markers in the background, spooling them if necessary
+
+    args
+    ----
+    port: int
+        the port of the MarkerServer
+    transport: str
+        how to reach the MarkerServer, see :func:`~reiz._marker.client.push`
+    spool: str
+        path to a file mirroring the spool. Defaults to None, i.e. spool
+        only in memory
+    maxlen: int
+        the maximal number of spooled markers
+    retry: float
+        seconds between two attempts to deliver the spool
+    """
+
+    instance = dict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, port: int = 7654, transport: str = "tcp", **kwargs):
+        "get the running sender for port and transport, starting it if necessary"
+        key = (port, transport)
+        sender = cls.instance.get(key, None)
+        if sender is None:
+            with cls._lock:
+                sender = cls.instance.get(key, None)
+                if sender is None:
+                    sender = cls(port=port, transport=transport, **kwargs)
+                    sender.start()
+                    cls.instance[key] = sender
+        return sender
+
+    def __init__(
+        self,
+        port: int = 7654,
+        transport: str = "tcp",
+        spool: str = None,
+        maxlen: int = 10000,
+        retry: float = 0.5,
+    ):
+        threading.Thread.__init__(self, daemon=True)
+        self.client = _Client.get(port=port, transport=transport)
+        self.queue = _Queue()
+        self.spooled = deque(maxlen=maxlen)
+        self.dropped = 0
+        self.stale = 0  #: markers in the file which were dropped meanwhile
+        self.retry = retry
+        self.last_attempt = 0.0
+        self.path = spool
+        self.file = None
+        if spool is not None:
+            self._load(spool)
+
+    def put(self, marker: str, tstamp: float):
+        "hand a marker to the thread"
+        self.queue.put((marker, tstamp))
+
+    def flush(self, timeout: float = None) -> bool:
+        """wait until all markers handed so far were delivered or spooled
+
+        returns
+        -------
+        delivered: bool
+            True if the spool is empty, i.e. all markers were delivered
+        """
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+        return done.is_set() and not self.spooled
+
+    def _load(self, path: str):
+        "load markers left over in the spool file, e.g. after a crash"
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self.spooled.append(tuple(json.loads(line)))
+                    except ValueError:  # the last line was cut off
+                        pass
+            if self.spooled:
+                log.warning(f"Loaded {len(self.spooled)} markers from {path}")
+        self.file = open(path, "a", encoding="utf-8")
+
+    def _spool(self, item: Tuple[str, float]):
+        "keep an undelivered marker for later"
+        if len(self.spooled) == self.spooled.maxlen:
+            self.dropped += 1
+            self.stale += 1
+            log.warning(f"Marker spool is full, dropped {self.dropped} markers")
+        self.spooled.append(item)
+        if self.file is not None:
+            if self.stale >= max(1, self.spooled.maxlen // 10):
+                self._rewrite()
+            else:
+                self.file.write(json.dumps(item) + "\n")
+                self.file.flush()
+
+    def _rewrite(self):
+        "replace the spool file with the markers currently spooled"
+        if self.file is None:
+            return
+        self.file.close()
+        temporary = self.path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            for item in self.spooled:
+                f.write(json.dumps(item) + "\n")
+        os.replace(temporary, self.path)  # atomic, the old file stays valid
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.stale = 0
+
+    def _deliver(self, item: Tuple[str, float]) -> bool:
+        try:
+            self.client.push(*item)
+            return True
+        except OSError:
+            return False
+
+    def _deliver_spool(self, force: bool = False) -> bool:
+        "try to deliver all spooled markers, at most once every retry seconds"
+        now = pylsl.local_clock()
+        if not force and now - self.last_attempt < self.retry:
+            return False
+        self.last_attempt = now
+        while self.spooled:
+            batch = [self.spooled[i] for i in range(min(500, len(self.spooled)))]
+            try:
+                self.client.push_many(batch)
+            except OSError:
+                return False
+            for i in range(len(batch)):
+                self.spooled.popleft()
+            self._rewrite()  # not to deliver the batch again after a crash
+        return True
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self.retry if self.spooled else None)
+            except queue.Empty:
+                self._deliver_spool()
+                continue
+            if isinstance(item, threading.Event):  # requested by flush
+                if self.spooled:
+                    self._deliver_spool(force=True)
+                item.set()
+            elif self.spooled:  # keep the order behind spooled markers
+                self._spool(item)
+                self._deliver_spool()
+            elif not self._deliver(item):
+                self._spool(item)
+
+
+def push_nowait(
+    marker: str = "",
+    tstamp: float = None,
+    sanitize=True,
+    port: int = 7654,
+    transport: str = "tcp",
+):
+    """push a marker without waiting for the MarkerServer
+
+    The timestamp is taken immediately, and the marker is delivered by a
+    background thread. See :func:`~reiz._marker.client.push` for the
+    arguments, and :func:`~.flush` to wait for the delivery.
+    """
+    if tstamp is None:
+        tstamp = pylsl.local_clock()
+    if sanitize:
+        marker = sanitize_string(marker)
+    _Sender.get(port=port, transport=transport).put(marker, tstamp)
+
+
+def flush(timeout: float = None) -> bool:
+    """wait until all markers pushed with :func:`~.push_nowait` were delivered
+
+    args
+    ----
+    timeout: float
+        how many seconds to wait at most for each sender
+
+    returns
+    -------
+    delivered: bool
+        False if markers remain spooled, e.g. because no MarkerServer is
+        available
+    """
+    return all([s.flush(timeout) for s in list(_Sender.instance.values())])
+
+
+def configure_sender(
+    spool: str = None, maxlen: int = 10000, port: int = 7654, transport: str = "tcp"
+):
+    """configure the spool of the background sender
+
+    Call this before the first :func:`~.push_nowait` to the MarkerServer.
+
+    args
+    ----
+    spool: str
+        path to a file mirroring the spool, so that undelivered markers
+        survive a crash and are delivered after the next start
+    maxlen: int
+        the maximal number of spooled markers. Once the spool is full, the
+        oldest markers are dropped
+    port: int
+        the port of the MarkerServer
+    transport: str
+        how to reach the MarkerServer
+    """
+    if (port, transport) in _Sender.instance:
+        raise RuntimeError("The sender is already running")
+    _Sender.get(port=port, transport=transport, spool=spool, maxlen=maxlen)
+
+
+atexit.register(flush, 1)
+
+if "darwin" in platform:  # pragma no cover
+    from reiz._marker.client import push as fake_push_nowait
+
+    push_nowait = fake_push_nowait
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Statistics of a running MarkerServer
+------------------------------------
+
+The :class:`~reiz._marker.mitm.Server` and its MarkerStreamer count every
+marker they receive and push, and keep latency histograms for three
+intervals:
+
+- `transit`: from the timestamp set by the client until the server received
+  the marker
+- `queue`: from receiving the marker until it was pushed to the outlet
+- `total`: from the timestamp set by the client until it was pushed to the
+  outlet
+
+The `queue` and `total` latencies are additionally kept for each priority
+class, see :mod:`~reiz._marker.bounded`, to check that critical markers
+overtake the bulk. Query them from a running daemon with
+`reiz-marker --stats`.
+
+Classes
+.......
+"""
+import bisect
+from collections import deque
+from pylsl import local_clock
+
+
+class Histogram:
+    """a latency histogram with logarithmically spaced buckets
+
+    Buckets span from 1µs to 100s with ten buckets per decade, so recording
+    is constant in time and memory, and percentiles are accurate to about
+    25%.
+    """
+
+    EDGES = [10 ** (k / 10 - 6) for k in range(81)]  #: upper bucket edges
+
+    def __init__(self):
+        self.counts = [0] * (len(self.EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.skipped = 0
+
+    def add(self, value: float):
+        """record a latency in seconds
+
+        negative values occur if the timestamp was set deliberately, e.g. to
+        the expected onset of a stimulus, or on a different clock. They are
+        counted as skipped.
+        """
+        if value < 0:
+            self.skipped += 1
+            return
+        self.counts[bisect.bisect_left(self.EDGES, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> float:
+        "the upper edge of the bucket containing the q-th percentile"
+        if self.count == 0:
+            return None
+        rank = q / 100 * self.count
+        cumulative = 0
+        for edge, count in zip(self.EDGES, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(edge, self.max)
+        return self.max
+
+    def as_dict(self) -> dict:
+        "summarize the histogram"
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+            "max": self.max if self.count else None,
+            "skipped": self.skipped,
+        }
+
+
+class Rate:
+    "counts events per second within a sliding window of seconds"
+
+    def __init__(self, window: int = 300):
+        self.seconds = deque(maxlen=window)
+
+    def add(self, count: int = 1, now: float = None):
+        second = int(local_clock() if now is None else now)
+        if self.seconds and self.seconds[-1][0] == second:
+            self.seconds[-1][1] += count
+        else:
+            self.seconds.append([second, count])
+
+    def as_dict(self) -> dict:
+        "percentiles of events per second, over seconds with any events"
+        rates = sorted(count for second, count in self.seconds)
+        if not rates:
+            return {"p50": None, "p90": None, "max": None}
+        n = len(rates) - 1
+        return {
+            "p50": rates[n // 2],
+            "p90": rates[n * 9 // 10],
+            "max": rates[n],
+        }
+
+
+class Stats:
+    """counters and latency histograms of a MarkerServer
+
+    The server thread records received markers, the MarkerStreamer records
+    pushed markers. Each counter is written by only one thread, so recording
+    needs no lock, and a snapshot with :meth:`~.as_dict` might only be off
+    by the markers handled while it is taken.
+    """
+
+    def __init__(self):
+        self.started = local_clock()
+        self.received = 0
+        self.pushed = 0
+        self.peak_queue = 0
+        self.latency = {
+            "transit": Histogram(),
+            "queue": Histogram(),
+            "total": Histogram(),
+        }
+        self.throughput = Rate()
+        self.priorities = dict()  #: queue and total latencies of each class
+
+    def on_receive(self, tstamps, received: float):
+        "record markers received by the server"
+        self.received += len(tstamps)
+        for tstamp in tstamps:
+            self.latency["transit"].add(received - tstamp)
+
+    def on_push(self, tstamps, received: float, pushed: float, depth: int,
+                priority: str = None):
+        "record markers of a priority class pushed by the MarkerStreamer"
+        self.pushed += len(tstamps)
+        self.peak_queue = max(self.peak_queue, depth)
+        self.throughput.add(len(tstamps), now=pushed)
+        latencies = [self.latency]
+        if priority is not None:
+            if priority not in self.priorities:
+                self.priorities[priority] = {"queue": Histogram(),
+                                             "total": Histogram()}
+            latencies.append(self.priorities[priority])
+        for latency in latencies:
+            latency["queue"].add(pushed - received)
+            for tstamp in tstamps:
+                latency["total"].add(pushed - tstamp)
+
+    def by_priority(self) -> dict:
+        "summarize the latencies of each priority class"
+        return {
+            priority: {k: v.as_dict() for k, v in latency.items()}
+            for priority, latency in list(self.priorities.items())
+        }
+
+    def as_dict(self, **status) -> dict:
+        """summarize the statistics
+
+        args
+        ----
+        status:
+            additional entries describing the current state, e.g. the queue
+            depth or the number of open connections
+        """
+        summary = {
+            "uptime": local_clock() - self.started,
+            "received": self.received,
+            "pushed": self.pushed,
+            "peak_queue": self.peak_queue,
+            "throughput": self.throughput.as_dict(),
+            "latency": {k: v.as_dict() for k, v in self.latency.items()},
+            "priorities": self.by_priority(),
+        }
+        summary.update(status)
+        return summary
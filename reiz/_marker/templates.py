@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Marker templates
+----------------
+
+Feedback loops send the same few structured markers thousands of times per
+session, and only few of their values change. Register such a marker once
+as a template, and push only its values
+
+.. code-block:: python
+
+    feedback = template({"event": "feedback"}, "value", "trial")
+    feedback.push(0.53, 12)  # {"event": "feedback", "value": 0.53, "trial": 12}
+    onset = template("trial_{}_onset")
+    onset.push(12)  # pushes trial_12_onset
+
+A template is either a dictionary, to which the names of its slots are
+appended as keys and which is encoded as json like with
+:func:`~reiz._marker.client.push_json`, or a string with `{}` as slots.
+The expanded marker of a string template is sanitized like with
+:func:`~reiz._marker.client.push`, i.e. a template pushes exactly the same
+marker as pushing it in full.
+
+Each template is interned with a small integer id. A client announces the
+template once per connection, e.g.
+
+.. code-block:: python
+
+    {"cmd": "template", "id": 0, "parts": ["{\\"event\\": \\"feedback\\", \\"value\\": ",
+     ", \\"trial\\": ", "}"], "json": True, "sanitize": False}
+
+and then only sends the id and the values, e.g. `{"cmd": "push", "template":
+0, "values": [0.53, 12], "tstamp": 1234.5}`. The MarkerServer expands them
+into the final marker, so neither encoding the whole marker nor sanitizing
+it costs the client any time.
+
+Functions and Classes
+.....................
+"""
+import json
+import threading
+from typing import List
+from pylsl import local_clock
+from reiz._marker.client import sanitize_string, _Client
+
+_registry = []  #: all templates, indexed by their id
+_interned = dict()  #: the id of each template, keyed by its definition
+_lock = threading.Lock()
+
+
+def expand(parts: List[str], values: list, as_json: bool = False,
+           sanitize: bool = False) -> str:
+    """fill the slots of a template with values
+
+    args
+    ----
+    parts: List[str]
+        the literal text before, between and after the slots
+    values: list
+        one value for each slot
+    as_json: bool
+        whether to encode values as json, or to insert them as text
+    sanitize: bool
+        whether to sanitize the expanded marker like a marker pushed in
+        full, see :func:`~reiz._marker.client.sanitize_string`
+
+    returns
+    -------
+    marker: str
+        the expanded marker
+    """
+    if len(values) != len(parts) - 1:
+        raise ValueError(
+            f"Template has {len(parts) - 1} slots, received {len(values)} values")
+    pieces = [parts[0]]
+    for value, part in zip(values, parts[1:]):
+        pieces.append(json.dumps(value) if as_json else str(value))
+        pieces.append(part)
+    marker = "".join(pieces)
+    return sanitize_string(marker) if sanitize else marker
+
+
+class Template:
+    """a registered marker template, see :func:`~.template`
+
+    args
+    ----
+    id: int
+        the interned id of the template
+    parts: List[str]
+        the literal text before, between and after the slots
+    as_json: bool
+        whether values are encoded as json
+    sanitize: bool
+        whether values are sanitized
+    """
+
+    def __init__(self, id: int, parts: List[str], as_json: bool,
+                 sanitize: bool):
+        self.id = id
+        self.parts = parts
+        self.as_json = as_json
+        self.sanitize = sanitize
+        self.announcement = {"cmd": "template", "id": id, "parts": parts,
+                             "json": as_json, "sanitize": sanitize}
+
+    def __repr__(self):
+        return f"Template({self.expand(['{}'] * (len(self.parts) - 1))!r})"
+
+    def expand(self, values: list) -> str:
+        "the marker with the slots filled by values"
+        return expand(self.parts, values, self.as_json, self.sanitize)
+
+    def push(
+        self,
+        *values,
+        tstamp: float = None,
+        port: int = 7654,
+        transport: str = "tcp",
+        stream: str = None,
+        host: str = "127.0.0.1",
+        reliable: bool = False,
+        priority: str = None,
+    ):
+        """push the template with its slots filled by values
+
+        args
+        ----
+        values:
+            one value for each slot
+        tstamp: float
+            the timestamp of the event, see :func:`~reiz._marker.client.push`
+
+        All other arguments are the same as for
+        :func:`~reiz._marker.client.push`.
+        """
+        if len(values) != len(self.parts) - 1:
+            raise ValueError(f"{self!r} takes {len(self.parts) - 1} values")
+        if tstamp is None:
+            tstamp = local_clock()
+        c = _Client.get(host=host, port=port, transport=transport,
+                        reliable=reliable)
+        c.push_template(self, values, tstamp, stream, priority)
+
+
+def template(marker, *slots: str, sanitize: bool = None) -> Template:
+    """register a marker template
+
+    args
+    ----
+    marker: Union[str, dict]
+        a string with `{}` for each slot, or a dictionary with the fixed keys
+    slots: str
+        for a dictionary, the keys of the slots
+    sanitize: bool
+        whether to sanitize the marker. Defaults to sanitizing strings, but
+        not dictionaries, like :func:`~reiz._marker.client.push` and
+        :func:`~reiz._marker.client.push_json`
+
+    returns
+    -------
+    template: Template
+        the registered template. Registering the same template again returns
+        the same id
+    """
+    if isinstance(marker, dict):
+        if sanitize is None:
+            sanitize = False
+        if any(slot in marker for slot in slots):
+            raise ValueError("Slots can not be fixed keys, too")
+        slot = object()
+
+        def placeholder(obj):
+            if obj is slot:
+                return "\0slot\0"
+            raise TypeError(f"{obj!r} is not JSON serializable")
+
+        text = json.dumps(dict(marker, **{key: slot for key in slots}),
+                          default=placeholder)
+        parts = text.split('"\\u0000slot\\u0000"')
+        as_json = True
+    else:
+        if slots:
+            raise ValueError("Slots of string templates are marked with {}")
+        if sanitize is None:
+            sanitize = True
+        text = str(marker)
+        parts = text.split("{}")
+        as_json = False
+    key = (tuple(parts), as_json, sanitize)
+    with _lock:
+        if key not in _interned:
+            _interned[key] = len(_registry)
+            _registry.append(Template(len(_registry), parts, as_json,
+                                      sanitize))
+        return _registry[_interned[key]]
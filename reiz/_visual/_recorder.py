@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Recording stimulus parameters
+-----------------------------
+
+Markers describe discrete events, but parameters of dynamic stimuli, e.g.
+the zoom of a growing ball, change with every frame. Sending a marker for
+each frame floods the marker outlet with strings. Instead, record them as a
+regular numeric stream, sampled once per flip of the canvas
+
+.. code-block:: python
+
+    ball = reiz.visual.Circle(zoom=1, color="red")
+    canvas.record("ball-parameters", zoom=(ball, "zoom"))
+
+The stream has one `float32` channel per parameter, labelled with its name,
+and its nominal sampling rate is the refresh rate of the display as
+measured with :meth:`~reiz._visual._screen.Canvas.estimate_fps`. Each sample
+is timestamped with the time the frame was flipped, and samples are pushed
+in chunks to keep the overhead per frame small.
+
+Classes
+.......
+"""
+import socket
+import pylsl
+from pylsl import local_clock
+from typing import Dict, Tuple, Any
+
+
+class ParameterStream:
+    """records attributes of visual stimuli at every flip of a canvas
+
+    args
+    ----
+    name: str
+        the name of the LSL outlet
+    parameters: Dict[str, Tuple[Any, str]]
+        for each channel its label, and the visual stimulus and the name of
+        its attribute to record
+    srate: float
+        the refresh rate of the display in Hz
+    chunk_size: int
+        how many samples to collect before pushing them. Defaults to about
+        ten chunks per second
+    """
+
+    def __init__(
+        self,
+        name: str,
+        parameters: Dict[str, Tuple[Any, str]],
+        srate: float,
+        chunk_size: int = None,
+    ):
+        if not parameters:
+            raise ValueError("Record at least one parameter")
+        for label, (visual, attribute) in parameters.items():
+            if not hasattr(visual, attribute):
+                raise ValueError(f"{visual} has no attribute {attribute}")
+        self.name = name
+        self.labels = list(parameters.keys())
+        self.parameters = list(parameters.values())
+        self.srate = srate
+        self.chunk_size = chunk_size or max(1, int(round(srate / 10)))
+        self.samples = []
+        self.tstamps = []
+        self.per_sample = False
+        info = pylsl.StreamInfo(
+            name,
+            type="Stimulus",
+            channel_count=len(self.labels),
+            nominal_srate=srate,
+            channel_format="float32",
+            source_id="_at_".join((name, socket.gethostname())),
+        )
+        channels = info.desc().append_child("channels")
+        for label in self.labels:
+            channels.append_child("channel").append_child_value("label", label)
+        self.outlet = pylsl.StreamOutlet(info, chunk_size=self.chunk_size)
+
+    def __repr__(self):
+        return (f"ParameterStream({self.name!r}, {self.labels}, "
+                f"srate={self.srate:.2f})")
+
+    def sample(self, tstamp: float = None):
+        "record the current values of all parameters for a flip at tstamp"
+        self.samples.append([float(getattr(visual, attribute))
+                             for visual, attribute in self.parameters])
+        self.tstamps.append(local_clock() if tstamp is None else tstamp)
+        if len(self.samples) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        "push all recorded samples"
+        if not self.samples:
+            return
+        if not self.per_sample:
+            try:
+                self.outlet.push_chunk(self.samples, self.tstamps)
+            except TypeError:  # pylsl < 1.14 takes only a single timestamp
+                self.per_sample = True
+        if self.per_sample:
+            for sample, tstamp in zip(self.samples, self.tstamps):
+                self.outlet.push_sample(sample, tstamp)
+        self.samples = []
+        self.tstamps = []
@@ -7,6 +7,7 @@ Pyglet based screen and frame drawing
 import pyglet
 from pylsl import local_clock
 from typing import Tuple
+from reiz._visual._recorder import ParameterStream
 
 # %%
 
@@ -56,6 +57,8 @@ class Canvas:
         self.start_width = size[0]
         self.start_height = size[1]
         self.antialias = antialias
+        self.recorders = []
+        self.fps = None  #: the refresh rate measured by estimate_fps
         self._create_window()
 
     @property
@@ -75,7 +78,53 @@ class Canvas:
         for i in range(0, 100, 1):
             self.window.flip()
             pyglet.clock.tick()
-        return pyglet.clock.get_fps()
+        self.fps = pyglet.clock.get_fps()
+        return self.fps
+
+    def record(
+        self,
+        name: str = "reiz-parameters",
+        chunk_size: int = None,
+        srate: float = None,
+        **parameters
+    ) -> ParameterStream:
+        """record attributes of visual stimuli at every flip as an LSL stream
+
+        args
+        ----
+        name: str
+            the name of the LSL outlet
+        chunk_size: int
+            how many samples to collect before pushing them
+        srate: float
+            the nominal sampling rate, i.e. the refresh rate of the display
+        parameters: Tuple[Visual, str]
+            for each channel, the visual stimulus and the name of its
+            attribute, e.g. `zoom=(ball, "zoom")`
+
+        returns
+        -------
+        stream: :class:`~reiz._visual._recorder.ParameterStream`
+            the stream, sampled until it is passed to :meth:`~.stop_recording`
+
+        Unless srate is given, the refresh rate last measured with
+        :meth:`~.estimate_fps` is used. If it was not measured yet, it is
+        measured now, which flips the canvas 100 times, so start the first
+        recording before presenting any stimuli.
+        """
+        if srate is None:
+            srate = self.fps if self.fps is not None else self.estimate_fps()
+        stream = ParameterStream(name, parameters, srate=srate,
+                                 chunk_size=chunk_size)
+        self.recorders.append(stream)
+        return stream
+
+    def stop_recording(self, stream: ParameterStream = None):
+        "push the remaining samples and stop recording a stream, or all streams"
+        for recorder in list(self.recorders):
+            if stream is None or recorder is stream:
+                recorder.flush()
+                self.recorders.remove(recorder)
 
     def _create_window(self):
         def default_window(kwargs={}):
@@ -144,9 +193,17 @@ class Canvas:
             self.window.dispatch_events()
             self.window.dispatch_event("on_draw")
             self.window.flip()  # flip front to backbuffer
+            tstamp = local_clock()
             self.window.clear()  # clear the current backbuffer: was the old backbuffer
         except Exception as e:
             print(e)
+            return
+        for recorder in list(self.recorders):
+            try:
+                recorder.sample(tstamp)
+            except Exception as e:  # e.g. an attribute is not a number anymore
+                print(f"Stopped recording {recorder!r}: {e}")
+                self.recorders.remove(recorder)
 
     def open(self):
         if not hasattr(self, "window") or self.window.has_exit:
@@ -158,6 +215,8 @@ class Canvas:
         self.clear()
 
     def close(self):
+        for recorder in self.recorders:
+            recorder.flush()
         if hasattr(self, "window") and not self.window.has_exit:
             self.window.on_close()
 
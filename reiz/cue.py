@@ -24,7 +24,7 @@ class Cue:
     visualstim: :class:`reiz._visual.complex.Visual`
         a list or a single visual stimulus. Will be presented on the canvas during the whole duration when :meth:`~.show`. was called. If you use more than one visual stimulus, they will be overlayed and are plotted from left to right. That means the first is at the bottom layer, the last at the top.
     markerstr: str
-        a string encapsulating the meaning of the cue. This string will be forwarded to the marker-server, and published with LSL. By default,
+        a string encapsulating the meaning of the cue. This string will be forwarded to the marker-server, and published with LSL. The marker is timestamped when :meth:`~.show` is called, and delivered in the background, so presentation never waits for the marker-server. By default,
         strings are sanitized for easier parsing, so do not use case-sensitive
         information, and try to limit yourself to ascii.
 
@@ -56,7 +56,7 @@ class Cue:
         if canvas is not None:
             self.canvas = canvas
         if self.marker is not None:
-            marker.push(self.marker)
+            marker.push_nowait(self.marker)
 
         # block for duration as long as we either have a visual or an audio
         if duration is not None and (self.visual is not None or self.audio is not None):
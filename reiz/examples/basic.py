@@ -65,6 +65,9 @@ ball = reiz.Cue(canvas, visualstim=dynamic_ball)
 
 # we open a window, show the cues and close the window again
 canvas.open()
+# the zoom changes with every frame, so instead of sending it as markers, we
+# record it as a numeric LSL stream, sampled whenever the canvas flips
+canvas.record("reiz-ball", zoom=(dynamic_ball, "zoom"))
 
 # we can either add a sleep function afterwards
 fix.show()
@@ -14,7 +14,9 @@ You can start the MarkerServer as an independent process with `reiz-marker` from
 
 .. code-block:: bash
 
-    usage: reiz-marker [-h] [--port PORT] [--host HOST] [--name NAME] [--ping] [--kill]
+    usage: reiz-marker [-h] [--port PORT] [--host HOST] [--name NAME]
+                       [--transport {tcp,unix,udp,shm} [{tcp,unix,udp,shm} ...]]
+                       [--ping] [--stats] [--kill]
 
     Reiz Marker Server
 
@@ -23,9 +25,17 @@ You can start the MarkerServer as an independent process with `reiz-marker` from
     --port PORT  Marker Server port.
     --host HOST  Marker Server host ip.
     --name NAME  Marker Server name.
+    --transport {tcp,unix,udp,shm} [{tcp,unix,udp,shm} ...]
+                 transports to listen on, or to ping and kill with
     --ping       test connection to Markerserver
+    --stats      print statistics of a running Markerserver
     --kill       send a poison pill to the Markerserver
 
+For experiments on the same machine, `reiz-marker --transport tcp unix udp shm`
+additionally accepts markers over a unix domain socket, as fire-and-forget
+datagrams or through a shared-memory ring. Select the transport when
+pushing, e.g. `push("hello", transport="unix")`.
+
 
 From within Python
 ------------------
@@ -40,12 +50,54 @@ Sending markers
 
 There is not much need to push markers for stimuli events manually, as you can create a :class:`~.Cue` and add the desired marker-string during instantiation. Often, you want to send additional information, e.g. the age and id of the subject, or the parameters with which the experiment was run. In these cases, pushing dictionaries or arbitrary strings during initialization of your experiment can be useful.  
 
+If several markers describe the same instant, e.g. the trial id, the condition and the stimulus parameters, send them together with :func:`~.push_many`. They travel as one message, and are published as one chunk with a timestamp for each marker.
+
+A :class:`~.Cue` sends its marker with :func:`~.push_nowait`. The marker is timestamped immediately, and a background thread delivers it, so presentation never waits for the MarkerServer. If the MarkerServer is briefly unavailable, markers are spooled and delivered later in order. Use :func:`~.flush` to wait until all markers were delivered, and :func:`~.configure_sender` to mirror the spool into a file.
+
+Check whether the MarkerServer is running with :func:`~.available`, which sends a health check that never reaches the recorded stream. Pass `max_age` to reuse a recent positive result without asking again, and use :func:`~.health` to receive the uptime, queue depth and outlet name of the MarkerServer.
+
+If you send the same structured marker over and over again, e.g. for feedback at every frame, register it once with :func:`~.template` and push only the values that change. The MarkerServer fills them in, so the marker is neither encoded nor sanitized anew each time.
+
+If your analysis only needs integer event codes, start the MarkerServer with `reiz-marker --codes codes.json`. It then mirrors every marker registered in that file, or with :func:`~.register_code`, as its code in a second outlet with the channel format `int32`. Push codes directly with :func:`~.push_code`, which only sends a timestamp and the code.
+
+If you need to know that a marker was recorded, push it with `reliable=True`. The MarkerServer acknowledges each marker once it was pushed to the outlet, and the client retransmits markers lost while the MarkerServer was restarted. Acknowledgements arrive in the background, so pushing does not wait for them. Use :func:`~.confirm` to wait until all markers were acknowledged.
+
+If one process floods the MarkerServer with chatty markers, e.g. feedback at every frame, push them with `priority="bulk"`, and push markers which must not wait, e.g. the onset of a trial, with `priority="critical"`. Each priority class has its own queue in the MarkerServer, and critical markers are pushed ahead of the others. `reiz-marker --stats` reports the latencies of each class.
+
+If your experiment runs on asyncio, use :func:`~.push_async` and :func:`~.available_async` instead. They never block the event loop, and all coroutines share one persistent connection.
+
 .. currentmodule:: reiz._marker.client
 .. autosummary::
    :template: module.rst
 
     push
+    push_many
     push_json
+    push_code
+    register_code
+    confirm
+    health
+
+.. currentmodule:: reiz._marker.templates
+.. autosummary::
+   :template: module.rst
+
+    template
+
+.. currentmodule:: reiz._marker.aio
+.. autosummary::
+   :template: module.rst
+
+    push_async
+    available_async
+
+.. currentmodule:: reiz._marker.sender
+.. autosummary::
+   :template: module.rst
+
+    push_nowait
+    flush
+    configure_sender
 
 
 
@@ -61,5 +113,9 @@ Safeguarding
 
 """
 
-from reiz._marker.client import push, push_json, available
+from reiz._marker.client import push, push_many, push_json, available
+from reiz._marker.client import health, confirm, push_code, register_code
+from reiz._marker.templates import template
+from reiz._marker.aio import push_async, available_async
+from reiz._marker.sender import push_nowait, flush, configure_sender
 from reiz._marker.safeguard import start, stop
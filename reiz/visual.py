@@ -128,6 +128,9 @@ the following set of visual stimuli: {', '.join([str(k) for k in library.__dict_
 .. automodule:: reiz._visual.colors
    :members: COLORS, get_color
 
+.. automodule:: reiz._visual._recorder
+   :members: ParameterStream
+
 Create libraries of visual stimuli
 ..................................
 
@@ -1,10 +1,26 @@
-from pytest import fixture
+from pytest import fixture, raises
 import reiz.api as reiz
 import logging
+import os
 
 logging.basicConfig(level=1)
 
 
+def wait_until(condition, timeout: float = 5.0) -> bool:
+    "poll condition until it holds or the timeout passed"
+    deadline = reiz.clock.time() + timeout
+    while not condition():
+        if reiz.clock.time() > deadline:
+            return False
+        reiz.clock.sleep(0.01)
+    return True
+
+
+def chunk(*samples):
+    "an item of a marker queue, holding samples without a journal"
+    return list(samples), [0.0] * len(samples), 0.0, []
+
+
 @fixture
 def rmarker(capsys):
     # set up
@@ -59,5 +75,645 @@ def test_sanitization(rmarker, capsys):
 
     out, err = capsys.readouterr()
     cue.show()
+    assert reiz.marker.flush(timeout=1)
     out, err = capsys.readouterr()
     assert "Sending test at" in out
+
+
+def test_persistent_connection(rmarker):
+    from reiz._marker.client import _Client
+
+    reiz.marker.push("first")
+    interface = _Client.get().interface
+    assert interface is not None
+    reiz.marker.push("second")
+    assert _Client.get().interface is interface
+
+
+def test_reader_partial_and_multiple_frames():
+    import json
+    from reiz._marker.protocol import Reader, encode
+
+    frames = b"".join(
+        encode({"cmd": "push", "marker": str(i), "tstamp": i}) for i in range(3)
+    )
+    reader = Reader()
+    assert reader.feed(frames[:3]) == []
+    msgs = reader.feed(frames[3:])
+    assert [m["marker"] for m in msgs] == ["0", "1", "2"]
+
+    legacy = Reader()
+    msg = json.dumps(("ping", 1.0)).encode("ascii")
+    assert legacy.feed(msg[:4]) == []
+    assert legacy.feed(msg[4:]) == [{"cmd": "ping"}]
+
+
+def test_stalled_client_does_not_block(rmarker):
+    import socket
+
+    stalled = socket.create_connection(("127.0.0.1", 7654))
+    stalled.sendall(b"\x00\x00\x00\x10{")  # an incomplete frame
+    assert reiz.marker.available()
+    stalled.close()
+
+
+def test_transports():
+    from reiz._marker.mitm import Server
+    from reiz._marker.client import kill
+
+    server = Server(port=7655, transports=("tcp", "unix", "udp"), verbose=False)
+    server.start()
+    server.is_running.wait()
+    for transport in ("unix", "udp"):
+        assert reiz.marker.available(port=7655, transport=transport)
+        reiz.marker.push("hello", port=7655, transport=transport)
+    kill(port=7655)
+    server.join()
+
+
+def test_push_many(rmarker, capsys):
+    out, err = capsys.readouterr()
+    reiz.marker.push_many([("trial 1", None), ("left", None)])
+    out, err = capsys.readouterr()
+    assert "Sending batch of 2 markers" in out
+    assert reiz.marker.available()
+
+
+def test_stats(rmarker):
+    from reiz._marker.client import stats
+
+    reiz.marker.push("counted")
+    status = stats()
+    assert status["received"] >= 1
+    assert status["name"] == "reiz-marker"
+    assert "p99" in status["latency"]["total"]
+
+
+def test_shm_transport():
+    from reiz._marker.mitm import Server
+    from reiz._marker.client import kill, stats, _Client
+
+    server = Server(port=7656, transports=("tcp", "shm"), verbose=False)
+    server.start()
+    server.is_running.wait()
+    assert reiz.marker.available(port=7656, transport="shm")
+    assert ("127.0.0.1", 7656, "shm", False) not in _Client.instance
+    reiz.marker.push("hello", port=7656, transport="shm")
+    c = _Client.get(port=7656, transport="shm")
+    assert c.ring is not None
+    checked = c.checked
+    reiz.marker.push("again", port=7656, transport="shm")
+    assert c.checked == checked  # the connection is not checked every time
+    assert wait_until(lambda: stats(port=7656)["pushed"] == 2)
+    kill(port=7656)
+    server.join()
+    _Client.get(port=7656, transport="shm").close()
+
+
+def test_shm_keeps_order_with_tcp():
+    from reiz._marker.mitm import Server
+    from reiz._marker.client import kill, _Client
+
+    server = Server(port=7657, transports=("tcp", "shm"), verbose=False)
+    server.start()
+    server.is_running.wait()
+    pushed = []
+    push_chunk = server.markerstreamer._push_chunk
+
+    def record(samples, tstamps):
+        pushed.extend(samples)
+        push_chunk(samples, tstamps)
+
+    server.markerstreamer._push_chunk = record
+    c = _Client(port=7657, transport="shm", verbose=False)
+    expected = []
+    for i in range(200):
+        c.push(f"ring_{i}", 1.0)
+        c.push_many([(f"tcp_{i}", 1.0)])
+        expected += [f"ring_{i}", f"tcp_{i}"]
+    assert c.ring is not None
+    assert wait_until(lambda: len(pushed) == len(expected))
+    assert pushed == expected
+    kill(port=7657)
+    server.join()
+    c.close()
+
+
+def test_push_async(rmarker, capsys):
+    import asyncio
+
+    async def experiment():
+        assert await reiz.marker.available_async()
+        await asyncio.gather(*(reiz.marker.push_async(f"c{i}") for i in range(3)))
+
+    out, err = capsys.readouterr()
+    asyncio.run(experiment())
+    out, err = capsys.readouterr()
+    assert "Sending c2 at" in out
+
+    from reiz._marker.aio import _AsyncClient
+
+    async def again():
+        await reiz.marker.push_async("again", host="127.0.0.1")
+        return [key[0] for key in _AsyncClient.instance]
+
+    loops = asyncio.run(again())
+    assert len(loops) == 1 and asyncio.run(again()) != loops
+
+
+def test_spooled_markers_keep_order(tmp_path):
+    from reiz._marker.mitm import Server
+    from reiz._marker.client import kill
+    from reiz._marker.sender import _Sender, configure_sender
+
+    spool = str(tmp_path / "spool.jsonl")
+    configure_sender(spool=spool, port=7658)
+    for i in range(20):  # no MarkerServer is running yet
+        reiz.marker.push_nowait(f"spooled_{i}", port=7658)
+    sender = _Sender.instance[(7658, "tcp")]
+    assert not sender.flush(timeout=5) and len(sender.spooled) == 20
+    server = Server(port=7658, verbose=False)
+    server.start()
+    server.is_running.wait()
+    pushed = []
+    push_chunk = server.markerstreamer._push_chunk
+
+    def record(samples, tstamps):
+        pushed.extend(samples)
+        push_chunk(samples, tstamps)
+
+    server.markerstreamer._push_chunk = record
+    reiz.marker.push_nowait("delivered", port=7658)
+    assert sender.flush(timeout=5)
+    assert wait_until(lambda: len(pushed) == 21)
+    assert pushed == [f"spooled_{i}" for i in range(20)] + ["delivered"]
+    with open(spool) as f:
+        assert f.read() == ""
+    kill(port=7658)
+    server.join()
+
+
+def test_journal_recovery(tmp_path):
+    from reiz._marker.journal import Journal, read_journal
+
+    path = str(tmp_path / "markers.journal")
+    journal = Journal(path)
+    acked = journal.append("pushed", 1.0)
+    journal.append("lost", 2.0)
+    journal.ack(acked)
+    journal.close()
+    assert [r[1:] for r in read_journal(path)] == [
+        ("pushed", 1.0, True, ""),
+        ("lost", 2.0, False, ""),
+    ]
+    journal = Journal(path)
+    assert [p[1:] for p in journal.pending()] == [("lost", 2.0, "")]
+    journal.ack(journal.pending()[0][0])
+    journal.close()
+    assert Journal(path).pending() == []
+    assert read_journal(path) == []
+
+
+def test_journal_idle(tmp_path):
+    from reiz._marker.journal import Journal
+
+    journal = Journal(str(tmp_path / "markers.journal"))
+    assert journal.idle
+    seq = journal.append("marker", 1.0)
+    journal.sync(force=True)
+    assert not journal.idle  # not yet pushed
+    journal.ack(seq)
+    assert not journal.idle  # not yet synced
+    journal.sync(force=True)
+    assert journal.idle
+    journal.close()
+
+
+def test_journal_compaction(tmp_path):
+    from reiz._marker.journal import Journal, read_journal, CHUNK
+
+    path = str(tmp_path / "markers.journal")
+    journal = Journal(path)
+    journal.append("lost", 0.0)
+    for i in range(20000):  # about 2MiB of records in total
+        journal.ack(journal.append(f"pushed-{i:05d}".ljust(80, "."), i))
+    late = journal.append("late", 1.0)
+    journal.close()
+    assert os.path.getsize(path) == CHUNK
+    records = read_journal(path)
+    assert records[0][1:] == ("lost", 0.0, False, "")
+    assert records[-1][:2] == (late, "late")
+    assert all(r[3] for r in records[1:-1])
+    journal = Journal(path)
+    assert [p[1] for p in journal.pending()] == ["lost", "late"]
+    journal.close()
+
+
+def test_replay(tmp_path):
+    from reiz._marker.replay import load, replay
+
+    path = tmp_path / "session.csv"
+    path.write_text("marker,tstamp\nsecond,1.05\nfirst,1.0\n")
+    markers = load(str(path))
+    assert markers == [("first", 1.0), ("second", 1.05)]
+    errors = replay(markers, rate=2, lead=0.01, verbose=False)
+    assert len(errors) == 2
+    assert all(0 <= e < 0.01 for e in errors)
+
+
+def test_named_streams(rmarker):
+    from reiz._marker.client import stats
+
+    reiz.marker.push("default")
+    reiz.marker.push("correct", stream="feedback")
+    reiz.marker.push_many([("trial_1", None), ("left", None)], stream="task")
+    reiz.clock.sleep(0.5)
+    streams = stats()["streams"]
+    assert streams["feedback"]["pushed"] == 1
+    assert streams["task"]["pushed"] == 2
+
+
+def test_binary_frames():
+    from reiz._marker.protocol import encode, Reader
+
+    push = {"cmd": "push", "marker": "ärger", "tstamp": 1234.567890123456}
+    batch = {"cmd": "batch", "markers": [("a", 1.0), ("b", None)], "stream": "task"}
+    frames = encode(push, binary=True) + encode(batch, binary=True)
+    frames += encode({"cmd": "ping"}, binary=True) + encode({"cmd": "stats"}, True)
+    msgs = Reader().feed(frames)
+    assert msgs[0]["marker"] == "ärger" and msgs[0]["tstamp"] == push["tstamp"]
+    assert msgs[0]["stream"] is None
+    assert msgs[1]["markers"] == batch["markers"] and msgs[1]["stream"] == "task"
+    assert [m["cmd"] for m in msgs[2:]] == ["ping", "stats"]
+    numbered = Reader().feed(encode(dict(push, seq=2 ** 40), binary=True))
+    assert numbered[0]["seq"] == 2 ** 40 and numbered[0]["marker"] == "ärger"
+
+
+def test_reliable_delivery(rmarker):
+    from reiz._marker.client import _Client
+
+    c = _Client(verbose=False, reliable=True)
+    for i in range(100):
+        c.push(f"reliable_{i}", 1.0)
+    assert c.confirm(timeout=5) and not c.unacked
+    c.close()  # the session outlives the connection
+    c.push_many([("again", 1.0)])
+    c.send({"cmd": "push", "marker": "duplicate", "tstamp": 1.0, "seq": 1})
+    status = c.request({"cmd": "stats"})["stats"]
+    assert status["duplicates"] == 1 and status["received"] == 101
+    assert c.confirm(timeout=5) and reiz.marker.confirm()
+
+
+def test_reliable_rejects_and_expires():
+    from reiz._marker.mitm import Server
+    from reiz._marker.client import kill, _Client
+
+    server = Server(port=7662, verbose=False)
+    server.session_timeout = 0.1
+    server.start()
+    server.is_running.wait()
+    c = _Client(port=7662, verbose=False, reliable=True, format="json")
+    try:
+        c.push("invalid", 1.0, stream="")  # rejected, but acknowledged
+        assert c.confirm(timeout=5)
+        c.push("valid", 1.0)
+        assert c.confirm(timeout=5) and len(server.sessions) == 1
+        c.close()
+        assert wait_until(lambda: not server.sessions)
+    finally:
+        kill(port=7662)
+        server.join()
+
+
+def test_malformed_messages():
+    import socket
+    from reiz._marker.mitm import Server
+    from reiz._marker.client import kill, stats
+    from reiz._marker.protocol import encode
+
+    server = Server(port=7663, verbose=False)
+    server.start()
+    server.is_running.wait()
+    push_chunk = server.markerstreamer._push_chunk
+
+    def unencodable(samples, tstamps):
+        if "unencodable" in samples:
+            raise TypeError("pylsl can not encode the marker")
+        push_chunk(samples, tstamps)
+
+    server.markerstreamer._push_chunk = unencodable
+    try:
+        with socket.create_connection(("127.0.0.1", 7663)) as sock:
+            for msg in ({"cmd": "batch", "markers": 5},
+                        {"cmd": "push", "marker": "x", "tstamp": "abc"},
+                        {"cmd": "push", "marker": {"a": 1}, "tstamp": 1.0}):
+                sock.sendall(encode(msg))
+        with socket.create_connection(("127.0.0.1", 7663)) as sock:
+            sock.sendall(b"[1, 2]")
+        server.markerstreamer.push("unencodable", 1.0)
+        reiz.marker.push("valid", port=7663)
+        assert wait_until(lambda: stats(port=7663)["pushed"] == 1)
+        assert stats(port=7663)["received"] == 2
+    finally:
+        kill(port=7663)
+        server.join()
+    assert not server.markerstreamer.is_alive()
+
+
+def test_server_closes_wakeup():
+    from reiz._marker.mitm import Server
+    from reiz._marker.client import kill
+
+    server = Server(port=7664, verbose=False)
+    server.start()
+    server.is_running.wait()
+    duplicate = Server(port=7664, verbose=False)
+    duplicate.start()
+    duplicate.join()  # returns right away, the first server keeps control
+    kill(port=7664)
+    server.join()
+    for s in (server, duplicate):
+        assert s._wakeup.fileno() == -1 and s._waker.fileno() == -1
+
+
+def test_request_discards_late_reply():
+    import socket
+    import threading
+    import time
+    from reiz._marker.client import _Client
+    from reiz._marker.protocol import encode, Reader
+
+    listener = socket.create_server(("127.0.0.1", 0))
+    listener.settimeout(5)
+    port = listener.getsockname()[1]
+
+    def serve():  # replies too late on the first connection only
+        for delay in (1.5, 0.0):
+            sock, address = listener.accept()
+            reader, msgs = Reader(), []
+            while not msgs:
+                msgs = reader.feed(sock.recv(4096))
+            time.sleep(delay)
+            try:
+                sock.sendall(encode({"cmd": "stats", "delay": delay}))
+            except OSError:
+                pass
+            sock.close()
+
+    server = threading.Thread(target=serve)
+    server.start()
+    c = _Client(port=port, format="json", verbose=False)
+    try:
+        with raises(socket.timeout):
+            c.request({"cmd": "stats"})
+        assert c.request({"cmd": "stats"})["delay"] == 0.0
+    finally:
+        server.join()
+        c.close()
+        listener.close()
+
+
+def test_health(rmarker):
+    from reiz._marker.client import health, stats
+    from reiz._marker.safeguard import available
+
+    status = health()
+    assert status["name"] == "reiz-marker"
+    assert status["queue"] == 0 and status["uptime"] > 0
+    assert reiz.marker.available(max_age=10)
+    assert available()
+    assert stats()["received"] == 0
+
+
+def test_clock_estimator():
+    from reiz._marker.clock import Estimator, to_local
+
+    def remote(t):  # the clock of the server runs ahead and faster
+        return t + 5.0 + 20e-6 * (t - 100)
+
+    estimator = Estimator()
+    for i in range(20):
+        t0 = 100.0 + 10 * i
+        delay = 0.01 if i % 4 == 0 else 0.0002  # some exchanges got queued
+        t1 = remote(t0 + delay)
+        estimator.add(t0, t1, t1, t0 + delay + 0.0002)
+    model = estimator.fit()
+    assert abs(model["drift"] - 20e-6) < 1e-7
+    assert abs(to_local(model, 400.0) - remote(400.0)) < 1e-4
+    assert model["rtt"] < 0.001
+
+
+def test_clock_resync_in_background():
+    from reiz._marker.mitm import Server
+    from reiz._marker.client import kill, _Client
+    from reiz._marker.clock import Estimator
+
+    server = Server(port=7665, verbose=False)
+    server.start()
+    server.is_running.wait()
+    c = _Client(port=7665, verbose=False)
+    c.clock = Estimator(interval=0.05)  # as if the server ran remotely
+    try:
+        c.push("first", 1.0)  # connecting synchronizes right away
+        assert len(c.clock.exchanges) == 8 and c.resync.is_alive()
+        assert wait_until(lambda: len(c.clock.exchanges) > 10)
+        assert len(server.connections) == 2  # markers, and the exchanges
+        assert any(conn.clock is not None for conn in server.connections)
+    finally:
+        c.close()
+        kill(port=7665)
+        server.join()
+
+
+def test_bounded_queue():
+    from queue import Full
+    from reiz._marker.bounded import MarkerQueue
+
+    q = MarkerQueue(maxsize=3, policy="block")
+    q.put(chunk("a", "b"))
+    with raises(Full):
+        q.check(2)
+    q.get()
+    q.check(2)
+
+    q = MarkerQueue(maxsize=3, policy="drop-oldest")
+    q.put(chunk("a", "b"))
+    assert q.put(chunk("c", "d")) == (1, 0)
+    assert [q.get()[0], q.get()[0]] == [["b"], ["c", "d"]]
+
+    q = MarkerQueue(maxsize=3, policy="drop-newest")
+    assert q.put(chunk("a", "b", "c", "d")) == (1, 0)
+    assert q.get()[0] == ["a", "b", "c"] and q.dropped == 1
+
+    q = MarkerQueue(maxsize=2, policy="coalesce")
+    q.put(chunk("feedback:1", "trial:1"))
+    assert q.put(chunk("feedback:2", "block:1")) == (1, 1)
+    assert q.get()[0] == ["feedback:2", "trial:1"] and q.qsize() == 0
+
+
+def test_block_resumes_when_half_empty():
+    import threading
+    from reiz._marker.mitm import Server
+    from reiz._marker.client import kill, _Client
+
+    server = Server(port=7661, maxsize=4, policy="block", verbose=False)
+    server.start()
+    server.is_running.wait()
+    gate, stalled_at = threading.Semaphore(0), threading.Event()
+    pushed, notices, resumes = [], [], [0]
+    push_chunk, notify, resume = (server.markerstreamer._push_chunk,
+                                  server._notify, server._resume)
+
+    def stalled(samples, tstamps):
+        stalled_at.set()
+        gate.acquire()
+        pushed.extend(samples)
+        push_chunk(samples, tstamps)
+
+    def record(conn, blocked=None, stream=None):
+        if blocked is not None:
+            notices.append(blocked)
+        notify(conn, blocked, stream)
+
+    def count():
+        resumes[0] += 1
+        resume()
+
+    server.markerstreamer._push_chunk = stalled
+    server._notify, server._resume = record, count
+    lane = server.markerstreamer.queue.lane("normal")
+    c = _Client(port=7661, verbose=False)
+    try:
+        c.push("m0", 1.0)
+        assert stalled_at.wait(timeout=5)  # the streamer holds m0
+        for i in range(1, 10):
+            c.push(f"m{i}", 1.0)
+        assert wait_until(lambda: server.paused and lane.qsize() == 4)
+        gate.release()  # one marker is pushed, which leaves the lane too full
+        assert wait_until(lambda: pushed == ["m0"])
+        retried = resumes[0]
+        assert wait_until(lambda: resumes[0] > retried)
+        assert server.paused and lane.qsize() == 3 and notices == [True]
+        gate.release(100)
+        assert wait_until(lambda: len(pushed) == 10)
+        assert pushed == [f"m{i}" for i in range(10)]
+        assert notices.count(False) == notices.count(True)
+    finally:
+        gate.release(100)
+        kill(port=7661)
+        server.join()
+        c.close()
+
+
+def test_templates():
+    import json
+    from reiz._marker.client import sanitize_string
+    from reiz._marker.protocol import encode, Reader
+    from reiz._marker.templates import template
+
+    feedback = template({"event": "feedback"}, "value", "trial")
+    assert template({"event": "feedback"}, "value", "trial") is feedback
+    expected = json.dumps({"event": "feedback", "value": 0.5, "trial": 3})
+    assert feedback.expand([0.5, 3]) == expected
+    onset = template("Trial {} Önset")
+    assert onset.expand(["Ä b"]) == sanitize_string("Trial Ä b Önset")
+    assert template("{}").expand([" Ping "]) == sanitize_string(" Ping ")
+    assert template("{} ").expand(["B "]) == sanitize_string("B  ")
+    msg = {"cmd": "push", "template": onset.id, "values": ["x"], "tstamp": 1.0}
+    assert Reader().feed(encode(msg, binary=True))[0]["values"] == ["x"]
+    with raises(ValueError):
+        feedback.expand([0.5])
+
+
+def test_event_codes():
+    from reiz._marker.codes import Codes
+    from reiz._marker.protocol import encode, Reader
+
+    codes = Codes({"trial_onset": 1})
+    assert codes.get("trial_onset") == 1 and codes.get("other") is None
+    assert codes.marker(1) == "trial_onset" and codes.marker(99) == "99"
+    assert codes.get("99") == 99
+    with raises(ValueError):
+        codes.register("left", 1)
+    with raises(ValueError):
+        codes.register("huge", 2 ** 31)
+    msg = {"cmd": "code", "code": -5, "tstamp": 1.0, "stream": "task"}
+    assert Reader().feed(encode(msg, binary=True)) == [msg]
+
+
+def test_priority_lanes():
+    from reiz._marker.bounded import Lanes
+    from reiz._marker.protocol import encode, Reader
+    from reiz._marker.stats import Stats
+
+    q = Lanes(maxsize=2, policy="drop-newest")
+    q.put(chunk("feedback:1", "feedback:2"), priority="bulk")
+    q.put(chunk("feedback:3"), priority="bulk")
+    q.put(chunk("trial_onset"), priority="critical")
+    assert q.qsize() == 3 and q.dropped == 1
+    assert q.get() == ("critical", chunk("trial_onset"))
+    q.task_done("critical")
+    assert q.lane("critical").processed == 1 and q.lane("bulk").processed == 0
+    assert q.get()[0] == "bulk"
+
+    msg = {"cmd": "push", "marker": "trial_onset", "tstamp": 1.5, "seq": 7,
+           "priority": "critical"}
+    (decoded,) = Reader().feed(encode(msg, binary=True))
+    assert decoded["priority"] == "critical" and decoded["seq"] == 7
+
+    stats = Stats()
+    stats.on_push([1.0], 1.0, 1.001, 0, "critical")
+    assert stats.as_dict()["priorities"]["critical"]["queue"]["count"] == 1
+
+
+def test_streamer_pushes_queue_on_stop():
+    from reiz._marker.mitm import _MarkerStreamer
+
+    streamer = _MarkerStreamer(name="reiz-test-streamer", verbose=False)
+    streamer.start()
+    streamer.is_running.wait()
+    for i in range(50):
+        streamer.push(f"queued_{i}", 1.0)
+    streamer.stop()
+    streamer.join(timeout=5)
+    assert not streamer.is_alive() and not streamer.is_running.is_set()
+    assert streamer.stats.pushed == 50 and streamer.queue.qsize() == 0
+
+
+def test_launch_signals_readiness():
+    from reiz._marker.safeguard import _launch
+    from reiz._marker.client import available, kill
+
+    process, ready = _launch(port=7659)
+    try:
+        if os.name == "posix":  # otherwise, there is no pipe to signal
+            assert ready and available(port=7659)
+    finally:
+        kill(port=7659)
+        process.wait(timeout=10)
+
+
+def test_sigterm_pushes_queued_markers(tmp_path):
+    import signal
+    import sys
+    from subprocess import Popen
+    from reiz._marker.client import available, push_many, stats, _Client
+    from reiz._marker.journal import read_journal
+
+    path = str(tmp_path / "markers.journal")
+    process = Popen([sys.executable, "-m", "reiz._marker", "--port", "7660",
+                     "--journal", path])
+    try:
+        assert wait_until(lambda: available(port=7660, verbose=False), 10)
+        markers = [(f"marker-{i}", float(i)) for i in range(1000)]
+        push_many(markers, port=7660)
+        stats(port=7660)  # replied once the batch was queued
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(timeout=10) == 0
+    finally:
+        if process.poll() is None:
+            process.kill()
+        _Client.get(port=7660).close()
+    records = read_journal(path)
+    assert [r[1] for r in records] == [m for m, t in markers]
+    assert all(r[3] for r in records)
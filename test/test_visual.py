@@ -63,3 +63,27 @@ def test_iteration(canvas):
 def test_read_folder(canvas):
     lib = reiz.visual.read_folder()
     assert lib.__dict__.get("logo", None) is not None
+
+
+def test_record_parameters(canvas):
+    from pylsl import resolve_byprop
+
+    ball = reiz._visual.complex.Circle(zoom=1)
+    stream = canvas.record("reiz-test-parameters", chunk_size=2, zoom=(ball, "zoom"))
+    assert resolve_byprop("name", "reiz-test-parameters", timeout=1)
+    for i in range(5):
+        ball.zoom = i / 10
+        canvas.flip()
+    assert len(stream.samples) == 1
+    assert stream.samples[0] == [0.4]
+    canvas.stop_recording(stream)
+    assert stream.samples == [] and stream not in canvas.recorders
+    fps = canvas.fps
+    assert fps is not None and stream.srate == fps
+    again = canvas.record("reiz-test-again", zoom=(ball, "zoom"))
+    assert again.srate == fps  # reused instead of flipping again
+    fixed = canvas.record("reiz-test-fixed", srate=60, zoom=(ball, "zoom"))
+    assert fixed.srate == 60
+    ball.zoom = "large"  # can not be sampled, which stops the recordings
+    canvas.flip()
+    assert canvas.recorders == []